@@ -0,0 +1,511 @@
+__author__ = "Nathan Ward"
+
+"""
+Repeatable benchmarks for the hot paths, on synthetic data.
+
+Generates random walk intraday ticks over a 23,400 second session, opening
+range rows shaped like the greeks query output, and opening ranges shaped
+like organize_opening_range_data output. Times compress_time_series on row
+dicts and its NumPy version on the same days as column arrays, the shape
+pull_intraday_market_arrays returns, organize_opening_range_data and its NumPy version, the
+backtest_redux task body for every engine mode, the reaper's SQL conversion,
+send_task and the bulk enqueue template. Each stage reports throughput,
+latency percentiles and the process peak RSS so far, and every alternative
+engine is checked against the reference engine.
+
+Nothing talks to Redis or MySQL, the backtest_redux stage runs the task body
+against an in-memory dataset like a worker with a warm market data cache. The
+run_local stage does start a process pool and writes to a temporary file.
+
+    python -m backtest.benchmark --days 20 --parameter-sets 100
+"""
+
+import logging
+import resource
+import tempfile
+from os import environ, path
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+import numpy as np
+import ujson
+from backtest import kernel, result_codec
+from backtest.local_runner import run_local
+from backtest.engine import ENGINE_MODES, compress_time_series, compress_time_series_numpy, run_backtest, run_sweep, expand_parameter_grid
+from backtest.market_cache import StagedDataset
+from backtest.reaper import collect_task_results, result_row
+from backtest.task_helper import send_task, TaskTemplate
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+#First day of high resolution data in the DB, a Monday.
+FIRST_DATE = '2023-04-24'
+
+#Regular session, 9:30 to 16:00 Eastern as UTC seconds after midnight.
+MARKET_OPEN_SECONDS = 48600
+MARKET_OPEN_DURATION = 23400
+
+#Engines compared against the reference, sweep runs through run_sweep.
+BENCHMARK_ENGINE_MODES = ENGINE_MODES + ('sweep',)
+
+
+def trading_dates(count: int, first_date: str = FIRST_DATE) -> list:
+    """
+    The first count weekdays starting at first_date.
+    """
+    dates = []
+    day = datetime.strptime(first_date, '%Y-%m-%d')
+
+    while len(dates) < count:
+        if day.weekday() < 5:
+            dates.append(day.strftime('%Y-%m-%d'))
+        day += timedelta(days=1)
+
+    return dates
+
+
+def session_open_epoch(date: str) -> int:
+    return int(datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()) + MARKET_OPEN_SECONDS
+
+
+def generate_intraday_data(
+    dates: list,
+    seed: int = 0,
+    start_price: float = 410.0,
+    tick_volatility: float = 0.02,
+    rows_per_second: int = 2
+) -> dict:
+    """
+    Random walk ticks in cents over the whole session, rows_per_second rows per
+    second so there are repeated timestamps and prices like the raw data has.
+    Returns the same shape as CachedData.load(), {date: [{'timestamp_utc', 'underlying'}]}.
+    """
+    rng = np.random.default_rng(seed)
+    agg_data = {}
+    price = start_price
+
+    for date in dates:
+        row_count = MARKET_OPEN_DURATION * rows_per_second
+        timestamps = session_open_epoch(date) + np.arange(row_count) // rows_per_second
+        prices = np.round(price + np.cumsum(rng.normal(0, tick_volatility, row_count)), 2)
+        price = float(prices[-1])
+
+        agg_data[date] = [
+            {'timestamp_utc': timestamp, 'underlying': underlying}
+            for timestamp, underlying in zip(timestamps.tolist(), prices.tolist())
+        ]
+
+    return agg_data
+
+
+def generate_opening_range_rows(
+    dates: list,
+    ticker_count: int = 25,
+    seed: int = 0,
+    range_duration: int = 30,
+    rows_per_second: int = 5
+) -> list:
+    """
+    Rows like CollectOpeningRanges.get_opening_range_data returns, oldest first.
+    """
+    rng = np.random.default_rng(seed)
+    tickers = ['T{0:03d}'.format(count) for count in range(ticker_count)]
+    base_prices = rng.uniform(20, 500, ticker_count)
+    rows = []
+
+    for date in dates:
+        open_epoch = session_open_epoch(date)
+        for second in range(range_duration + 1):
+            for ticker, base_price in zip(tickers, base_prices):
+                for delta in rng.uniform(-1, 1, rows_per_second).tolist():
+                    rows.append({
+                        'timestamp_utc': open_epoch + second,
+                        'ticker': ticker,
+                        'underlying': round(float(base_price) + rng.normal(0, 0.05), 2),
+                        'delta': delta,
+                        'implied_volatility': rng.uniform(0.1, 0.6)
+                    })
+
+    return rows
+
+
+def opening_ranges_for(agg_data: dict, range_duration: int = 30) -> dict:
+    """
+    Opening ranges of the synthetic intraday data, shaped like one ticker's
+    entry in organize_opening_range_data output.
+    """
+    opening_ranges = {}
+
+    for date, rows in agg_data.items():
+        trading_start = rows[0]['timestamp_utc']
+        in_range = [row for row in rows if row['timestamp_utc'] <= trading_start + range_duration]
+        prices = [row['underlying'] for row in in_range]
+
+        opening_ranges[date] = {
+            'open_price': prices[0],
+            'high': max(prices),
+            'low': min(prices),
+            'count_trades': len(in_range),
+            'trading_start': in_range[-1]['timestamp_utc']
+        }
+
+    return opening_ranges
+
+
+def benchmark_parameter_sets(count: int, seed: int = 0) -> list:
+    """
+    A random sample of the seeder's default grid.
+    """
+    from backtest.startup import default_parameter_grid
+
+    grid = expand_parameter_grid(default_parameter_grid())
+    rng = np.random.default_rng(seed)
+
+    return [grid[ndx] for ndx in sorted(rng.choice(len(grid), min(count, len(grid)), replace=False).tolist())]
+
+
+def peak_rss_mb() -> float:
+    #ru_maxrss is in kilobytes on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def stage_report(stage: str, latencies: list, units: int, unit_name: str) -> dict:
+    """
+    Throughput in units per second over every call, and per call latency percentiles.
+    """
+    total_time = sum(latencies)
+    latencies_ms = np.array(latencies) * 1000
+
+    return {
+        'stage': stage,
+        'calls': len(latencies),
+        'units': units,
+        'unit_name': unit_name,
+        'seconds': round(total_time, 3),
+        'throughput': round(units / total_time, 1) if total_time else 0,
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 3),
+        'p90_ms': round(float(np.percentile(latencies_ms, 90)), 3),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 3),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def comparable_result(result: dict) -> dict:
+    """
+    A result as it looks after the trip through Celery, minus the random id.
+    """
+    if result is None:
+        return None
+
+    result = ujson.loads(ujson.dumps(result))
+    result.pop('backtest_id', None)
+
+    return result
+
+
+def bench_compress_time_series(agg_data: dict, compress_function=compress_time_series) -> tuple:
+    """
+    One call per day, returns the report and the compressed data. Days are
+    row dicts, or (timestamps, prices) column arrays.
+    """
+    cleaned_data = {}
+    latencies = []
+
+    for date, rows in agg_data.items():
+        start = perf_counter()
+        cleaned_data.update(compress_function({date: rows}))
+        latencies.append(perf_counter() - start)
+
+    units = sum(len(rows[1]) if isinstance(rows, tuple) else len(rows) for rows in agg_data.values())
+    stage = compress_function.__name__
+    if any(isinstance(rows, tuple) for rows in agg_data.values()):
+        stage += '[arrays]'
+
+    return stage_report(stage, latencies, units, 'rows'), cleaned_data
+
+
+def bench_organize_opening_range_data(opening_range_rows: list, method: str = 'organize_opening_range_data', repeat: int = 5) -> tuple:
+    """
+    Time one of the CollectOpeningRanges organize methods, returns the report and its output.
+    """
+    #Organizing never queries, but importing data_collection sets up a DatabaseHelper.
+    for var in ('SQL_USERNAME', 'SQL_PASSWORD', 'SQL_HOSTNAME'):
+        environ.setdefault(var, 'benchmark')
+    from backtest.data_collection import CollectOpeningRanges
+
+    organize = getattr(CollectOpeningRanges(), method)
+    latencies = []
+
+    for count in range(repeat):
+        start = perf_counter()
+        organized_data = organize(range_data=opening_range_rows, range_duration_to_test=30)
+        latencies.append(perf_counter() - start)
+
+    return stage_report(method, latencies, len(opening_range_rows) * repeat, 'rows'), organized_data
+
+
+def bench_backtest_redux(dataset: StagedDataset, parameter_sets: list, engine_mode: str, batch_size: int = 100) -> tuple:
+    """
+    The backtest_redux task body per parameter set, or run_sweep per batch for the
+    sweep engine. Returns the report and the encoded results.
+    """
+    #Event indexes are built once per dataset on a worker, keep that out of the timings.
+    dataset.engine_price_data(engine_mode)
+
+    latencies = []
+    results = []
+
+    if engine_mode == 'sweep':
+        for ndx in range(0, len(parameter_sets), batch_size):
+            start = perf_counter()
+            batch_results = run_sweep(
+                dataset.date_list,
+                dataset.opening_range_info,
+                dataset.engine_price_data(engine_mode),
+                parameter_sets[ndx:ndx + batch_size]
+            )
+            results.extend([result_codec.encode_result(result, 'full') for result in batch_results])
+            latencies.append(perf_counter() - start)
+    else:
+        for parameter_set in parameter_sets:
+            start = perf_counter()
+            result = run_backtest(
+                dataset.date_list,
+                dataset.opening_range_info,
+                dataset.engine_price_data(engine_mode),
+                parameter_set['stop_distance'],
+                parameter_set['stop_count_limit'],
+                parameter_set['stop_cooloff_period'],
+                parameter_set['limit_distance'],
+                engine_mode = engine_mode
+            )
+            results.append(result_codec.encode_result(result, 'full'))
+            latencies.append(perf_counter() - start)
+
+    return stage_report('backtest_redux[{0}]'.format(engine_mode), latencies, len(parameter_sets), 'backtests'), results
+
+
+def bench_local_runner(cleaned_data: dict, opening_ranges: dict, parameter_sets: list, engine_mode: str, workers: int = 2) -> tuple:
+    """
+    One run_local sweep, pool start up included. Returns the report and the
+    results read back from the results file, in parameter_sets order.
+    """
+    with tempfile.TemporaryDirectory() as results_dir:
+        results_path = path.join(results_dir, 'results.jsonl')
+
+        start = perf_counter()
+        run_local(
+            cleaned_data,
+            opening_ranges,
+            parameter_sets = parameter_sets,
+            engine_mode = engine_mode,
+            results_path = results_path,
+            workers = workers
+        )
+        latency = perf_counter() - start
+
+        with open(results_path) as results_file:
+            results = [ujson.loads(line) for line in results_file]
+
+    #Chunks are written as they finish, put the results back in the order they were asked for.
+    parameter_names = ('stop_distance', 'stop_count_limit', 'stop_cooloff_period', 'limit_distance')
+    results_by_parameters = {tuple(result[name] for name in parameter_names): result for result in results}
+    results = [
+        results_by_parameters.get(tuple(parameter_set[name] for name in parameter_names))
+        for parameter_set in parameter_sets
+    ]
+
+    return stage_report('run_local[{0}]'.format(engine_mode), [latency], len(parameter_sets), 'backtests'), results
+
+
+def bench_reaper_conversion(results: list, batch_size: int = 1000) -> dict:
+    """
+    collect_task_results and result_row on task meta values like the reaper
+    MGETs, one call per batch of results.
+    """
+    task_meta_values = [
+        ujson.dumps({'status': 'SUCCESS', 'result': result, 'task_id': str(count)})
+        for count, result in enumerate(results)
+    ]
+    latencies = []
+
+    for ndx in range(0, len(task_meta_values), batch_size):
+        start = perf_counter()
+        batch_values = task_meta_values[ndx:ndx + batch_size]
+        for key_task_id, task_results in collect_task_results(range(len(batch_values)), batch_values):
+            rows = [result_row(result_data) for result_data in task_results]
+        latencies.append(perf_counter() - start)
+
+    return stage_report('reaper_sql_conversion', latencies, len(task_meta_values), 'rows')
+
+
+def bench_send_task(parameter_sets: list, repeat: int = 10) -> dict:
+    latencies = []
+
+    for count in range(repeat):
+        for parameter_set in parameter_sets:
+            start = perf_counter()
+            send_task(
+                queue = 'worker_main',
+                task_name = 'backtest.engine.backtest_redux',
+                task_kwargs = parameter_set
+            )
+            latencies.append(perf_counter() - start)
+
+    return stage_report('send_task', latencies, len(latencies), 'messages')
+
+
+def bench_task_template(parameter_sets: list, repeat: int = 10) -> dict:
+    """
+    TaskTemplate.message, what enqueue_tasks builds per message, one call per
+    pass over the parameter sets.
+    """
+    template = TaskTemplate('worker_main', 'backtest.engine.backtest_redux')
+    latencies = []
+
+    for count in range(repeat):
+        start = perf_counter()
+        for parameter_set in parameter_sets:
+            template.message(parameter_set)
+        latencies.append(perf_counter() - start)
+
+    return stage_report('task_template', latencies, len(parameter_sets) * repeat, 'messages')
+
+
+def check_equivalence(reference_results: list, results: list) -> int:
+    """
+    Number of results that differ from the reference.
+    """
+    return sum(
+        comparable_result(reference) != comparable_result(result)
+        for reference, result in zip(reference_results, results)
+    ) + abs(len(reference_results) - len(results))
+
+
+def run_benchmarks(
+    days: int = 20,
+    parameter_set_count: int = 100,
+    engine_modes: tuple = BENCHMARK_ENGINE_MODES,
+    ticker_count: int = 25,
+    seed: int = 0
+) -> dict:
+    """
+    Run every stage and print a report. Returns the stage reports and the number
+    of results each engine got wrong compared to the reference.
+    """
+    dates = trading_dates(days)
+    parameter_sets = benchmark_parameter_sets(parameter_set_count, seed)
+
+    agg_data = generate_intraday_data(dates, seed)
+    opening_ranges = opening_ranges_for(agg_data)
+    opening_range_rows = generate_opening_range_rows(dates, ticker_count, seed)
+
+    reports = []
+
+    report, cleaned_data = bench_compress_time_series(agg_data)
+    reports.append(report)
+    column_data = {date: kernel.raw_day_arrays(rows) for date, rows in agg_data.items()}
+    del agg_data
+    report, numpy_cleaned_data = bench_compress_time_series(column_data, compress_time_series_numpy)
+    reports.append(report)
+    del column_data
+
+    compress_mismatches = sum(
+        list(cleaned_data[date].items()) != list(numpy_cleaned_data.get(date, {}).items()) for date in cleaned_data
+    )
+    del numpy_cleaned_data
+
+    report, organized_data = bench_organize_opening_range_data(opening_range_rows)
+    reports.append(report)
+    report, numpy_organized_data = bench_organize_opening_range_data(opening_range_rows, 'organize_opening_range_data_numpy')
+    reports.append(report)
+    del opening_range_rows
+
+    organize_mismatches = sum(
+        organized_data[ticker] != numpy_organized_data.get(ticker) for ticker in organized_data
+    ) + abs(len(organized_data) - len(numpy_organized_data))
+    del organized_data, numpy_organized_data
+
+    dataset = StagedDataset(
+        None,
+        'benchmark',
+        dates,
+        opening_ranges,
+        {date: kernel.day_arrays({str(k): v for k, v in cleaned_data[date].items()}) for date in dates}
+    )
+
+    engine_results = {}
+    for engine_mode in ('reference',) + tuple(mode for mode in engine_modes if mode != 'reference'):
+        report, engine_results[engine_mode] = bench_backtest_redux(dataset, parameter_sets, engine_mode)
+        reports.append(report)
+
+    local_results = {}
+    for engine_mode in ('reference',) + tuple(mode for mode in engine_modes if mode != 'reference'):
+        report, local_results[engine_mode] = bench_local_runner(cleaned_data, opening_ranges, parameter_sets, engine_mode)
+        reports.append(report)
+
+    mismatches = {
+        'compress_time_series_numpy days': compress_mismatches,
+        'organize_opening_range_data_numpy tickers': organize_mismatches
+    }
+    for engine_mode, results in engine_results.items():
+        if engine_mode != 'reference':
+            mismatches['{0} engine results'.format(engine_mode)] = check_equivalence(engine_results['reference'], results)
+    for engine_mode, results in local_results.items():
+        mismatches['run_local {0} results'.format(engine_mode)] = check_equivalence(engine_results['reference'], results)
+
+    reports.append(bench_reaper_conversion(engine_results['reference']))
+    reports.append(bench_send_task(parameter_sets))
+    reports.append(bench_task_template(parameter_sets))
+
+    print('{0} days, {1} parameter sets, {2} ticks per day after compression.'.format(
+        len(dates),
+        len(parameter_sets),
+        round(sum(len(day) for day in cleaned_data.values()) / len(dates))
+    ))
+    print('{0:<36}{1:>8}{2:>12}{3:>20}{4:>11}{5:>11}{6:>11}{7:>10}'.format(
+        'stage', 'calls', 'seconds', 'throughput', 'p50 ms', 'p90 ms', 'p99 ms', 'rss mb'
+    ))
+    for report in reports:
+        print('{0:<36}{1:>8}{2:>12}{3:>20}{4:>11}{5:>11}{6:>11}{7:>10}'.format(
+            report['stage'],
+            report['calls'],
+            report['seconds'],
+            '{0} {1}/s'.format(report['throughput'], report['unit_name']),
+            report['p50_ms'],
+            report['p90_ms'],
+            report['p99_ms'],
+            report['peak_rss_mb']
+        ))
+
+    print('Mismatches against the reference implementation:')
+    for name, mismatch_count in mismatches.items():
+        print('{0}: {1}'.format(name, 'identical' if not mismatch_count else '{0} differ'.format(mismatch_count)))
+
+    return {
+        'reports': reports,
+        'mismatches': mismatches
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the backtest hot paths on synthetic data.')
+    parser.add_argument('--days', type=int, default=20)
+    parser.add_argument('--parameter-sets', type=int, default=100)
+    parser.add_argument('--tickers', type=int, default=25, help='Tickers in the opening range rows.')
+    parser.add_argument('--engines', nargs='+', default=list(BENCHMARK_ENGINE_MODES), choices=BENCHMARK_ENGINE_MODES)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    benchmark = run_benchmarks(
+        days = args.days,
+        parameter_set_count = args.parameter_sets,
+        engine_modes = tuple(args.engines),
+        ticker_count = args.tickers,
+        seed = args.seed
+    )
+
+    if any(benchmark['mismatches'].values()):
+        raise SystemExit(1)
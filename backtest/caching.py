@@ -1,17 +1,62 @@
-
 __author__ = "Nathan Ward"
 
 import pickle
 import logging
-from os import getcwd, path, environ
-import asyncio
+from os import getcwd, path, environ, listdir, makedirs, replace
+from typing import Iterator
+from hashlib import blake2b
+import numpy as np
 import ujson
 import redis
+from backtest import columnar, kernel
 
 
 _LOGGER = logging.getLogger()
 _LOGGER.setLevel(logging.INFO)
 
+#Redis db holding the dataset manifest, which records the version of what is staged in db 1 and 2.
+MANIFEST_DB = 3
+MANIFEST_KEY = 'manifest'
+
+#Staging uploads are pipelined in batches of about this many bytes.
+STAGING_BATCH_BYTES = 8 * 1024 * 1024
+
+
+def redis_key(date: str, ticker: str = None) -> str:
+    """
+    Staged data is keyed by date, or by ticker and date when namespaced so
+    several tickers can be staged side by side.
+    """
+    if ticker:
+        return '{0}:{1}'.format(ticker, date)
+
+    return date
+
+
+def manifest_key(ticker: str = None) -> str:
+    """
+    Each namespaced ticker has its own manifest.
+    """
+    return redis_key(MANIFEST_KEY, ticker)
+
+
+def staged_dates(r: redis.Redis, ticker: str = None, r_manifest: redis.Redis = None) -> list:
+    """
+    Dates available for a ticker. Read from the manifest in r_manifest when
+    StageRedis recorded them, otherwise SCAN the staging db r. Without a ticker,
+    only the original un-namespaced date keys are returned.
+    """
+    if r_manifest is not None:
+        dates = r_manifest.hget(manifest_key(ticker), 'dates')
+        if dates:
+            return ujson.loads(dates)
+
+    if ticker:
+        prefix = '{0}:'.format(ticker)
+        return [key[len(prefix):] for key in r.scan_iter(match='{0}*'.format(prefix))]
+
+    return [key for key in r.scan_iter() if ':' not in key]
+
 
 class CachedData(object):
     def __init__(self, ticker:str):
@@ -41,65 +86,310 @@ class CachedData(object):
         return
 
 
+class DayCache(object):
+    """
+    Incremental alternative to CachedData. Each day of raw intraday rows is its
+    own pickle in cached_data/<ticker>/, so days can be added as they download
+    without rewriting the whole history.
+    """
+    def __init__(self, ticker:str):
+        self.directory = path.join(getcwd(), 'cached_data', ticker)
+    
+    def days(self) -> set:
+        """
+        Dates already cached.
+        """
+        if not path.isdir(self.directory):
+            return set()
+        
+        return {filename[:-4] for filename in listdir(self.directory) if filename.endswith('.pkl')}
+    
+    def save_day(self, date:str, intraday_data_raw:list) -> None:
+        """
+        Save one day. Written to a temporary file first, so an interrupted run
+        never leaves a partial day behind.
+        """
+        makedirs(self.directory, exist_ok=True)
+        filepath = path.join(self.directory, '{0}.pkl'.format(date))
+
+        with open(filepath + '.tmp', 'wb') as f:
+            pickle.dump(intraday_data_raw, f)
+        replace(filepath + '.tmp', filepath)
+    
+    def iter_days(self, dates:list = None) -> Iterator[tuple]:
+        """
+        Yield (date, rows) one day at a time in date order, e.g. into
+        stream_compress_time_series. Defaults to every cached day.
+        """
+        for date in sorted(self.days() if dates is None else dates):
+            with open(path.join(self.directory, '{0}.pkl'.format(date)), 'rb') as f:
+                yield date, pickle.load(f)
+    
+    def load(self, dates:list = None) -> dict:
+        """
+        Load cached days into the same structure CachedData.load returns.
+        """
+        return dict(self.iter_days(dates))
+
+
+class ColumnarStoreError(Exception):
+    """Exception class if the on-disk columnar store cannot be written."""
+    pass
+
+
+class ColumnarStore(object):
+    """
+    On-disk store of a ticker's compressed price data, replacing the pickles.
+
+    Every day is appended to two contiguous files, int64 timestamps and float64
+    prices, and an index records each date's offset and tick count. Reads are
+    memory mapped, so any date or date range is sliced straight from disk
+    without loading or deserializing the rest of the history.
+
+    Has the same days()/save_day() interface as DayCache, so the bulk downloader
+    can write into it directly. Writes must come from one thread at a time.
+    """
+    def __init__(self, ticker:str, directory:str = None):
+        self.directory = directory or path.join(getcwd(), 'cached_data', '{0}-columnar'.format(ticker))
+        self.timestamps_path = path.join(self.directory, 'timestamps.i8')
+        self.prices_path = path.join(self.directory, 'prices.f8')
+        self.index_path = path.join(self.directory, 'index.json')
+
+        self.index = self.load_index()
+        self.mapped = None
+    
+    def load_index(self) -> dict:
+        """
+        The index maps each date to [offset, count] in ticks, count is the total.
+        """
+        if not path.exists(self.index_path):
+            return {'count': 0, 'dates': {}}
+        
+        with open(self.index_path, 'r') as f:
+            return ujson.load(f)
+    
+    def days(self) -> set:
+        """
+        Dates in the store, including days stored without any ticks.
+        """
+        return set(self.index['dates'])
+    
+    def append_day(self, date:str, timestamps, prices) -> None:
+        """
+        Append one day of compressed (timestamps, prices). Days can't be replaced.
+        """
+        if date in self.index['dates']:
+            raise ColumnarStoreError('{0} is already in the store.'.format(date))
+        
+        timestamps = np.ascontiguousarray(timestamps, dtype='<i8')
+        prices = np.ascontiguousarray(prices, dtype='<f8')
+        if timestamps.shape != prices.shape:
+            raise ColumnarStoreError('{0} has {1} timestamps but {2} prices.'.format(date, timestamps.size, prices.size))
+        
+        makedirs(self.directory, exist_ok=True)
+        count = self.index['count']
+
+        for filepath, values in ((self.timestamps_path, timestamps), (self.prices_path, prices)):
+            with open(filepath, 'ab') as f:
+                #Drop anything an interrupted append left past the end of the index.
+                f.truncate(count * 8)
+                f.write(values.tobytes())
+        
+        #The index is only updated once the data is on disk.
+        self.index['dates'][date] = [count, int(timestamps.size)]
+        self.index['count'] = count + int(timestamps.size)
+
+        with open(self.index_path + '.tmp', 'w') as f:
+            ujson.dump(self.index, f)
+        replace(self.index_path + '.tmp', self.index_path)
+
+        self.mapped = None
+    
+    def save_day(self, date:str, intraday_data_raw:list) -> None:
+        """
+        Compress one day of raw rows, like stream_compress_time_series, and append it.
+        """
+        timestamps, prices = kernel.raw_day_arrays(intraday_data_raw)
+        self.append_day(date, *kernel.compress_day_arrays(timestamps, prices))
+    
+    def import_cleaned_data(self, cleaned_data:dict) -> int:
+        """
+        Append the days of compress_time_series output that aren't stored yet.
+        Returns how many were added.
+        """
+        added = 0
+        for k_date in sorted(cleaned_data):
+            if k_date not in self.index['dates']:
+                self.append_day(k_date, *kernel.day_arrays(cleaned_data[k_date]))
+                added += 1
+        
+        return added
+    
+    def arrays(self) -> tuple:
+        """
+        Memory mapped timestamps and prices for the whole store.
+        """
+        if self.mapped is None:
+            count = self.index['count']
+            if not count:
+                return np.empty(0, dtype='<i8'), np.empty(0, dtype='<f8')
+            
+            self.mapped = (
+                np.memmap(self.timestamps_path, dtype='<i8', mode='r', shape=(count,)),
+                np.memmap(self.prices_path, dtype='<f8', mode='r', shape=(count,))
+            )
+        
+        return self.mapped
+    
+    def read_day(self, date:str) -> tuple:
+        """
+        One day as (timestamps, prices) views over the mapped files.
+        """
+        offset, count = self.index['dates'][date]
+        timestamps, prices = self.arrays()
+
+        return timestamps[offset:offset + count], prices[offset:offset + count]
+    
+    def read_range(self, start_date:str = None, end_date:str = None, include_empty:bool = False) -> dict:
+        """
+        Every day between start_date and end_date inclusive, in date order, as
+        {date: (timestamps, prices)} views. Days without ticks are left out unless
+        include_empty, the same as compress_time_series leaves them out.
+        """
+        return {
+            k_date: self.read_day(k_date) for k_date in sorted(self.index['dates'])
+            if (start_date is None or k_date >= start_date)
+            and (end_date is None or k_date <= end_date)
+            and (include_empty or self.index['dates'][k_date][1])
+        }
+
+
 class StageRedis(object):
-    def __init__(self, ticker_to_investigate:str):
+    def __init__(self, ticker_to_investigate:str, namespaced:bool = False):
+        """
+        namespaced stages under '<ticker>:<date>' keys instead of bare dates, so
+        many tickers can be staged and backtested at the same time.
+        """
         self.ticker = ticker_to_investigate
+        self.namespace = ticker_to_investigate if namespaced else None
         self.redis_endpoint = environ['REDIS_ENDPOINT']
+        self.clients = {}
     
-    async def upload_redis(self, date=str, data=dict, db_num=int):
-        r = redis.asyncio.from_url("redis://{0}:6379".format(self.redis_endpoint), db=db_num, decode_responses=True)
-        try:
-            await r.set(
-                date,
-                ujson.dumps(data)
-            )
-        except Exception as e:
-            _LOGGER.exception(f"action=upload_redis, status=fail, {e}")
+    def redis_client(self, db_num: int) -> redis.Redis:
+        """
+        One client per db for the life of the stager. Uploads run one pipeline at
+        a time, so each pool only ever opens a single connection.
+        """
+        if db_num not in self.clients:
+            self.clients[db_num] = redis.Redis(host=self.redis_endpoint, port=6379, db=db_num)
+
+        return self.clients[db_num]
+
+    def upload_payloads(self, payloads: dict, db_num: int, batch_bytes: int = STAGING_BATCH_BYTES) -> int:
+        """
+        SET each date's payload, pipelined in batches of about batch_bytes so a
+        whole history goes up in a few round trips. Returns the batch count.
+        """
+        batches = 0
+        with self.redis_client(db_num).pipeline(transaction=False) as pipe:
+            pending_bytes = 0
+            for k_date, v_data in payloads.items():
+                pipe.set(redis_key(k_date, self.namespace), v_data)
+                pending_bytes += len(v_data)
+
+                if pending_bytes >= batch_bytes:
+                    pipe.execute()
+                    batches += 1
+                    pending_bytes = 0
+
+            if len(pipe):
+                pipe.execute()
+                batches += 1
 
-    def batch(self, iterable, n=1):
-        l = len(iterable)
-        for ndx in range(0, l, n):
-            yield iterable[ndx:min(ndx + n, l)]
+        return batches
+
+    def serialize(self, data_by_date: dict, encoder=ujson.dumps, content=None) -> tuple:
+        """
+        Serialize each date's data once for upload, and fingerprint the whole set
+        so workers can tell when the staged data changes. content turns a payload
+        into the bytes to fingerprint, by default the payload itself.
+        """
+        payloads = {k_date: encoder(v_data) for k_date, v_data in data_by_date.items()}
+
+        digest = blake2b(digest_size=8)
+        for k_date in sorted(payloads):
+            digest.update(k_date.encode('utf-8'))
+            payload = content(payloads[k_date]) if content else payloads[k_date]
+            digest.update(payload if isinstance(payload, bytes) else payload.encode('utf-8'))
+
+        return payloads, digest.hexdigest()
+
+    def publish_version(self, field: str, digest: str, dates: list = None) -> None:
+        """
+        Record the digest of a staged data set in the manifest, along with the
+        staged dates if given. Done after the upload so workers never see a
+        version before its data, and in one HSET so the dates always match it.
+        """
+        mapping = {field: digest}
+        if dates is not None:
+            mapping['dates'] = ujson.dumps(sorted(dates))
+
+        self.redis_client(MANIFEST_DB).hset(manifest_key(self.namespace), mapping=mapping)
 
     def stage_opening_ranges(self, opening_ranges_organized:dict):
         """
         Stage opening range data in db 1.
         """
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        tasks = []
+        payloads, digest = self.serialize(opening_ranges_organized.get(self.ticker, {}))
+        self.upload_payloads(payloads, 1)
 
-        for k_ticker, v_date in opening_ranges_organized.items():
-            if k_ticker == self.ticker:
-                for k_date, v_data in v_date.items():
-                    tasks.append(
-                        self.upload_redis(
-                            date = k_date,
-                            data = v_data,
-                            db_num = 1
-                        )
-                    )
+        self.publish_version('opening_ranges', digest)
 
-        #Seems to freak out above 500 connections in the pool.
-        for i in self.batch(tasks, 100):
-            result = loop.run_until_complete(asyncio.gather(*i))
-
-    def stage_price_data(self, cleaned_data: dict):
+    def stage_price_data(
+        self,
+        cleaned_data: dict,
+        price_format: str = 'json',
+        price_dtype: str = 'float64',
+        compression: str = None
+    ):
         """
         Stage intra-day price data for the security in db 2.
+
+        price_format 'json' stores each day as a {timestamp: price} dict. 'columnar'
+        stores packed arrays (see backtest.columnar), with price_dtype 'float64' or
+        'float32' and optional 'lz4' or 'zstd' compression. Workers detect the
+        format on read, so both can be staged side by side.
+
+        Days can be compressed dicts, or (timestamps, prices) arrays such as
+        ColumnarStore.read_range returns.
+
+        The version fingerprints the days as workers decode them plus the price
+        dtype, not the encoded bytes, so restaging the same data in another
+        format or compression keeps every backtest id. float32 prices round, so
+        they are a different dataset.
         """
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        tasks = []
-
-        for k_date, v_data in cleaned_data.items():
-            tasks.append(
-                self.upload_redis(
-                    date = k_date,
-                    data = v_data,
-                    db_num = 2
-                )
+        if price_format != 'columnar':
+            price_dtype = 'float64'
+
+        def price_content(payload) -> bytes:
+            timestamps, prices = columnar.decode_any(payload)
+            return price_dtype.encode('utf-8') + timestamps.astype('<i8').tobytes() + prices.astype('<f8').tobytes()
+
+        if price_format == 'columnar':
+            payloads, digest = self.serialize(
+                cleaned_data,
+                encoder = lambda v_data: columnar.encode_day(v_data, price_dtype=price_dtype, compression=compression),
+                content = price_content
             )
+        else:
+            payloads, digest = self.serialize(
+                cleaned_data,
+                encoder = lambda v_data: ujson.dumps(v_data if isinstance(v_data, dict) else dict(zip(v_data[0].tolist(), v_data[1].tolist()))),
+                content = price_content
+            )
+
+        self.upload_payloads(payloads, 2)
 
-        for i in self.batch(tasks, 100):
-            result = loop.run_until_complete(asyncio.gather(*i))
+        #The manifest's date list is what workers backtest, so dates left over
+        #from an earlier, longer staging are ignored without a SCAN.
+        self.publish_version('price_data', digest, dates=payloads.keys())
@@ -0,0 +1,87 @@
+__author__ = "Nathan Ward"
+
+"""
+Batch sizing from measured backtest cost.
+
+A task's run time grows with the staged dates, their ticks and the number of
+parameter sets, so a fixed batch_size either gets tasks killed at the time
+limit as the history grows, or leaves them so short that per-message overhead
+dominates. Workers record how long simulating took per parameter set and
+date, per ticker, engine mode and dataset version, and the seeder sizes
+backtest_batch tasks to take about a target duration.
+"""
+
+import logging
+from celery_worker import app
+from backtest.market_cache import redis_client
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+COST_KEY_PREFIX = 'task_cost:'
+
+#Measurements are only good for the dataset version they were taken on.
+COST_KEY_TTL = 7 * 24 * 3600
+
+#Aim well under the time limit, a worker's first task also loads the dataset.
+DEFAULT_TARGET_FRACTION = 0.25
+
+MAX_BATCH_SIZE = 10000
+
+
+def cost_key(ticker: str, engine_mode: str, dataset_version: str) -> str:
+    return '{0}{1}:{2}:{3}'.format(COST_KEY_PREFIX, ticker or '', engine_mode, dataset_version)
+
+
+def record_cost(ticker: str, engine_mode: str, dataset_version: str, seconds: float, parameter_set_count: int, date_count: int) -> None:
+    """
+    Add a finished task's simulation time to the running totals, in one round trip.
+    """
+    if not dataset_version or not parameter_set_count or not date_count:
+        return
+
+    key = cost_key(ticker, engine_mode, dataset_version)
+    with redis_client(0).pipeline(transaction=False) as pipe:
+        pipe.hincrbyfloat(key, 'seconds', seconds)
+        pipe.hincrby(key, 'units', parameter_set_count * date_count)
+        pipe.expire(key, COST_KEY_TTL)
+        pipe.execute()
+
+
+def measured_cost(ticker: str, engine_mode: str, dataset_version: str) -> float:
+    """
+    Mean seconds to backtest one parameter set over one date, or None before
+    any task has been measured.
+    """
+    seconds, units = redis_client(0).hmget(cost_key(ticker, engine_mode, dataset_version), ['seconds', 'units'])
+    if not seconds or not units or not int(units):
+        return None
+
+    return float(seconds) / int(units)
+
+
+def default_target_seconds() -> float:
+    return (app.conf.task_time_limit or 60) * DEFAULT_TARGET_FRACTION
+
+
+def adaptive_batch_size(
+    ticker: str,
+    engine_mode: str,
+    dataset_version: str,
+    date_count: int,
+    target_seconds: float = None,
+    default_batch_size: int = 100
+) -> int:
+    """
+    Parameter sets per backtest_batch task to take about target_seconds, which
+    defaults to a quarter of the task time limit. Falls back to
+    default_batch_size until there are measurements for this dataset.
+    """
+    target_seconds = target_seconds or default_target_seconds()
+    cost = measured_cost(ticker, engine_mode, dataset_version) if dataset_version else None
+
+    if cost is None or not date_count:
+        _LOGGER.info('No measured cost for {0} {1}, using batches of {2}.'.format(ticker, engine_mode, default_batch_size))
+        return default_batch_size
+
+    return max(1, min(MAX_BATCH_SIZE, int(target_seconds / (cost * date_count))))
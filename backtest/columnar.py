@@ -0,0 +1,155 @@
+__author__ = "Nathan Ward"
+
+"""
+Compact binary columnar format for a day of staged price data.
+
+Each day is stored as a fixed header followed by the packed price column and
+the delta-encoded timestamp column, optionally compressed with lz4 or zstd:
+
+    header  '<4sBBBxIq4x'  magic, format version, compression, price dtype, tick count, first timestamp
+    prices  float64 or float32, one per tick
+    deltas  int32 seconds since the previous tick, the first one is 0
+
+Prices sit right after the 24 byte header so float64 columns stay 8 byte
+aligned and can be read zero-copy with np.frombuffer. Readers detect the
+format from the magic bytes, anything else is treated as the original JSON.
+"""
+
+import logging
+import struct
+import numpy as np
+import ujson
+from backtest import kernel
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+MAGIC = b'NTC1'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sBBBxIq4x')
+
+COMPRESSION_CODES = {None: 0, 'lz4': 1, 'zstd': 2}
+PRICE_DTYPE_CODES = {'float64': 0, 'float32': 1}
+PRICE_DTYPES = {0: np.float64, 1: np.float32}
+
+
+class ColumnarFormatError(Exception):
+    """Exception class if a day cannot be encoded or decoded."""
+    pass
+
+
+def _compress(payload: bytes, compression: str) -> bytes:
+    """
+    Compress with an optional codec. lz4 and zstandard are only needed when used.
+    """
+    if compression is None:
+        return payload
+
+    try:
+        if compression == 'lz4':
+            import lz4.frame
+            return lz4.frame.compress(payload)
+        else:
+            import zstandard
+            return zstandard.ZstdCompressor().compress(payload)
+    except ImportError:
+        raise ColumnarFormatError('Compression {0} requested but its library is not installed.'.format(compression))
+
+
+def _decompress(payload: bytes, compression_code: int) -> bytes:
+    if compression_code == 0:
+        return payload
+
+    try:
+        if compression_code == 1:
+            import lz4.frame
+            return lz4.frame.decompress(payload)
+        elif compression_code == 2:
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(payload)
+    except ImportError:
+        raise ColumnarFormatError('Staged data is compressed but the library to decompress it is not installed.')
+
+    raise ColumnarFormatError('Unknown compression code {0}.'.format(compression_code))
+
+
+def encode_day(day_data, price_dtype: str = 'float64', compression: str = None) -> bytes:
+    """
+    Pack a day of price data, either a compressed {timestamp: price} dict or a
+    (timestamps, prices) tuple, into the binary format.
+
+    float32 halves the price column but rounds prices, so results will no longer
+    match JSON staged data exactly. float64 is lossless.
+    """
+    if compression not in COMPRESSION_CODES:
+        raise ColumnarFormatError('Unknown compression {0}, expected one of {1}.'.format(compression, list(COMPRESSION_CODES)))
+
+    if price_dtype not in PRICE_DTYPE_CODES:
+        raise ColumnarFormatError('Unknown price dtype {0}, expected one of {1}.'.format(price_dtype, list(PRICE_DTYPE_CODES)))
+
+    if isinstance(day_data, dict):
+        timestamps, prices = kernel.day_arrays(day_data)
+    else:
+        timestamps = np.asarray(day_data[0], dtype=np.int64)
+        prices = np.asarray(day_data[1], dtype=np.float64)
+
+    deltas = np.diff(timestamps, prepend=timestamps[:1])
+    if deltas.size and (deltas.min() < np.iinfo(np.int32).min or deltas.max() > np.iinfo(np.int32).max):
+        raise ColumnarFormatError('Timestamp gaps do not fit in int32 deltas.')
+
+    header = HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        COMPRESSION_CODES[compression],
+        PRICE_DTYPE_CODES[price_dtype],
+        len(timestamps),
+        int(timestamps[0]) if len(timestamps) else 0
+    )
+    payload = prices.astype(PRICE_DTYPES[PRICE_DTYPE_CODES[price_dtype]]).tobytes() + deltas.astype(np.int32).tobytes()
+
+    return header + _compress(payload, compression)
+
+
+def is_columnar(value) -> bool:
+    """
+    Check whether a staged value is in the binary format rather than JSON.
+    """
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:4]) == MAGIC
+
+
+def decode_day(value) -> tuple:
+    """
+    Unpack a binary day into (timestamps, prices) arrays.
+
+    Uncompressed float64 prices are a zero-copy view over the buffer. Timestamps
+    are rebuilt from the deltas with one cumulative sum. float32 prices are
+    widened to float64 so the engines compare in the same precision as JSON data.
+    """
+    magic, format_version, compression_code, dtype_code, count, first_timestamp = HEADER.unpack_from(value, 0)
+
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ColumnarFormatError('Not a version {0} columnar day.'.format(FORMAT_VERSION))
+
+    payload = _decompress(memoryview(value)[HEADER.size:], compression_code)
+    price_dtype = PRICE_DTYPES[dtype_code]
+    price_bytes = count * np.dtype(price_dtype).itemsize
+
+    prices = np.frombuffer(payload, dtype=price_dtype, count=count)
+    if price_dtype is not np.float64:
+        prices = prices.astype(np.float64)
+
+    deltas = np.frombuffer(payload, dtype=np.int32, count=count, offset=price_bytes)
+    timestamps = np.cumsum(deltas, dtype=np.int64)
+    timestamps += first_timestamp
+
+    return timestamps, prices
+
+
+def decode_any(value) -> tuple:
+    """
+    Decode a staged day in either format into (timestamps, prices) arrays.
+    """
+    if is_columnar(value):
+        return decode_day(value)
+
+    return kernel.day_arrays(ujson.loads(value))
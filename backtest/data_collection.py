@@ -4,15 +4,26 @@ __author__ = "Nathan Ward"
 import logging
 from statistics import fmean
 from collections import defaultdict
+from operator import itemgetter
+from typing import Iterable, Iterator
 from datetime import datetime, timezone, date
+from time import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
-from dw.natetrade_database import DatabaseHelper
+from dw.natetrade_database import DatabaseHelper, SQLError
 
 _LOGGER = logging.getLogger()
 _LOGGER.setLevel(logging.INFO)
 
 HELPER = DatabaseHelper()
 
+#Columns of the opening range query, in select order.
+OPENING_RANGE_COLUMNS = ('timestamp_utc', 'ticker', 'underlying', 'delta', 'implied_volatility')
+OPENING_RANGE_ROW = itemgetter(*OPENING_RANGE_COLUMNS)
+
+#Intraday price columns as record fields, for pulling days as arrays.
+INTRADAY_DTYPE = [('timestamp_utc', '<i8'), ('underlying', '<f8')]
+
 
 class CollectOpeningRanges(object):
     def __init__(self):
@@ -41,88 +52,140 @@ class CollectOpeningRanges(object):
         
         return epoch_range
     
-    def get_opening_range_data(self, range_data:list) -> list:
+    def opening_range_query(self, range_data:list, include_initial:bool = True) -> str:
         """
-        Queries the database to get a dictionary of 30 second opening range
-        data for all securities.
-
-        Should grab about ~3500 rows per day, runs quickly. Returns data in order from oldest to newest.
-        Returns data like: [{'timestamp_utc': 1684503026, 'ticker': 'MSFT', 'underlying': 316.88}]
+        Build the SQL for the opening range data of every date in range_data.
+        include_initial adds the first high resolution date, which epoch_date_ranges skips.
         """
+        windows = list(range_data)
+        if include_initial:
+            windows.insert(0, self.high_resolution_beginning_date_epoch)
+
         #Build the SQL syntax using the date ranges
-        statement = ''
-        for epoch_time in range_data:
-            statement += 'OR timestamp_utc BETWEEN {open_start} AND {open_end} '.format(
+        statement = ' OR '.join([
+            'timestamp_utc BETWEEN {open_start} AND {open_end}'.format(
                 open_start = epoch_time,
                 open_end = epoch_time + self.opening_range_duration
-            )
+            ) for epoch_time in windows
+        ])
         
         query = """
         SELECT timestamp_utc, ticker, underlying, delta, implied_volatility
         FROM `options`.`greeks`
-        WHERE timestamp_utc BETWEEN {initial_open} AND {initial_end} {statement};
+        WHERE {statement};
         """.format(
-            initial_open = self.high_resolution_beginning_date_epoch,
-            initial_end = self.high_resolution_beginning_date_epoch + self.opening_range_duration,
             statement = statement
         )
 
-        data = HELPER.generic_select_query('options', query)
+        return query
+    
+    def get_opening_range_data(self, range_data:list) -> list:
+        """
+        Queries the database to get a dictionary of 30 second opening range
+        data for all securities.
+
+        Should grab about ~3500 rows per day, runs quickly. Returns data in order from oldest to newest.
+        Returns data like: [{'timestamp_utc': 1684503026, 'ticker': 'MSFT', 'underlying': 316.88}]
+        """
+        data = HELPER.generic_select_query('options', self.opening_range_query(range_data))
+
+        return data
+    
+    def get_opening_range_data_parallel(self, range_data:list, chunk_days:int = 30, max_workers:int = 4) -> list:
+        """
+        Same result as get_opening_range_data, but the dates are split into chunks
+        of chunk_days that are queried concurrently over pooled connections, at
+        most max_workers at a time. Chunks are merged back in date order.
+        """
+        chunks = [range_data[ndx:ndx + chunk_days] for ndx in range(0, len(range_data), chunk_days)] or [[]]
+        queries = [
+            self.opening_range_query(chunk, include_initial = count == 0)
+            for count, chunk in enumerate(chunks)
+        ]
+
+        data = []
+        for chunk_data in HELPER.parallel_select_queries('options', queries, max_workers):
+            data.extend(chunk_data)
 
         return data
     
-    def organize_opening_range_data(self, range_data:list, range_duration_to_test:int) -> dict:
+    def stream_opening_range_data(self, range_data:list, batch_size:int = 10000, as_numpy:bool = False) -> Iterator:
+        """
+        Same query as get_opening_range_data, streamed from the server in batches
+        so the whole result is never held in memory.
+
+        Yields (timestamp_utc, ticker, underlying, delta, implied_volatility)
+        tuples, or NumPy record arrays of batch_size rows with as_numpy. The
+        tuples can be passed straight to organize_opening_range_data.
+        """
+        return HELPER.stream_select_query(
+            'options',
+            self.opening_range_query(range_data),
+            batch_size = batch_size,
+            as_numpy = as_numpy
+        )
+    
+    def organize_opening_range_data(self, range_data:Iterable, range_duration_to_test:int) -> dict:
         """
         Cleans up the data from the database based on the security, and gives the 
         opening range information.
+
+        Works in one pass over range_data, so it can consume stream_opening_range_data
+        as rows arrive. Rows can be dicts from get_opening_range_data, or tuples in
+        the query's column order.
         """
         organized_data = defaultdict(dict)
         vol_data = defaultdict(dict)
 
-        #First pass, populate tickers and initial data structure.
-        for row in range_data:
-            if row['ticker'] not in organized_data:
-                organized_data[row['ticker']] = {datetime.fromtimestamp(row['timestamp_utc']).strftime('%Y-%m-%d'): defaultdict(int)}
-        
-        #Second pass, populate dates and the rest of the data.
         for row in range_data:
-            date = datetime.fromtimestamp(row['timestamp_utc']).strftime('%Y-%m-%d')
-
-            if date not in organized_data[row['ticker']]:
-                organized_data[row['ticker']][date] = {
-                    'open_price': row['underlying'],
-                    'high': row['underlying'],
-                    'low': row['underlying'],
+            if isinstance(row, dict):
+                row = OPENING_RANGE_ROW(row)
+            timestamp_utc, ticker, underlying, delta, implied_volatility = row
+
+            date = datetime.fromtimestamp(timestamp_utc).strftime('%Y-%m-%d')
+
+            #The first date seen for a ticker only starts its entry.
+            if ticker not in organized_data:
+                organized_data[ticker] = {date: defaultdict(int)}
+            ticker_data = organized_data[ticker]
+
+            if date not in ticker_data:
+                ticker_data[date] = {
+                    'open_price': underlying,
+                    'high': underlying,
+                    'low': underlying,
                     'count_trades': 1,
-                    'trading_start': row['timestamp_utc']
+                    'trading_start': timestamp_utc
                 }
 
-                vol_data[row['ticker']][date] = []
+                vol_data[ticker][date] = []
 
                 #Capture close-ish ATM vol, good enough. This removes skewness.
-                if abs(row['delta']) > 0.4 and abs(row['delta']) < 0.6:
-                    vol_data[row['ticker']][date].append(row['implied_volatility'])
+                if abs(delta) > 0.4 and abs(delta) < 0.6:
+                    vol_data[ticker][date].append(implied_volatility)
             else:
+                day_data = ticker_data[date]
+
                 #To support variable opening ranges, skip timestamps after the test range.
-                if row['timestamp_utc'] > range_duration_to_test + organized_data[row['ticker']][date]['trading_start']:
+                if timestamp_utc > range_duration_to_test + day_data['trading_start']:
                     continue
                 else:
-                    organized_data[row['ticker']][date]['count_trades'] += 1
+                    day_data['count_trades'] += 1
 
-                    if row['underlying'] > organized_data[row['ticker']][date]['high']:
-                        organized_data[row['ticker']][date]['high'] = row['underlying']
+                    if underlying > day_data['high']:
+                        day_data['high'] = underlying
                     
-                    if row['underlying'] < organized_data[row['ticker']][date]['low']:
-                        organized_data[row['ticker']][date]['low'] = row['underlying']
+                    if underlying < day_data['low']:
+                        day_data['low'] = underlying
                     
-                    if row['timestamp_utc'] > organized_data[row['ticker']][date]['trading_start']:
-                        organized_data[row['ticker']][date]['trading_start'] = row['timestamp_utc']
+                    if timestamp_utc > day_data['trading_start']:
+                        day_data['trading_start'] = timestamp_utc
                     
                     #Capture close-ish ATM vol, good enough.
-                    if abs(row['delta']) > 0.4 and abs(row['delta']) < 0.6:
-                        vol_data[row['ticker']][date].append(row['implied_volatility'])
+                    if abs(delta) > 0.4 and abs(delta) < 0.6:
+                        vol_data[ticker][date].append(implied_volatility)
 
-        #Third pass, average out vol.
+        #Average out vol.
         #This does not take into account gamme/expiration and the term structure.
         for ticker, date_data in vol_data.items():
             for date, vol_list in date_data.items():
@@ -131,11 +194,142 @@ class CollectOpeningRanges(object):
 
         return organized_data
     
-    def pull_intraday_market_data(self, starting_epoch_range:int, ticker:str) -> list:
+    def opening_range_columns(self, range_data:Iterable, batch_size:int = 100000) -> tuple:
         """
-        Query the DB for intraday price data within the range.
+        Gather opening range rows into one array per column, in row order. Takes
+        the dicts or tuples organize_opening_range_data does, or the NumPy record
+        chunks from stream_opening_range_data(as_numpy=True).
+        """
+        columns = {column: [] for column in OPENING_RANGE_COLUMNS}
+        rows = iter(range_data)
+
+        while True:
+            chunk = next(rows, None)
+            if chunk is None:
+                break
+
+            if isinstance(chunk, np.ndarray):
+                for column in OPENING_RANGE_COLUMNS:
+                    columns[column].append(chunk[column])
+                continue
+
+            #Plain rows, convert them a batch at a time.
+            batch_rows = [chunk]
+            for row in rows:
+                batch_rows.append(row)
+                if len(batch_rows) == batch_size:
+                    break
+            if isinstance(batch_rows[0], dict):
+                batch_rows = list(map(OPENING_RANGE_ROW, batch_rows))
+
+            for column, values in zip(OPENING_RANGE_COLUMNS, zip(*batch_rows)):
+                columns[column].append(np.array(values))
+
+        if not columns['timestamp_utc']:
+            return tuple(np.array([]) for column in OPENING_RANGE_COLUMNS)
+
+        return (
+            np.concatenate(columns['timestamp_utc']).astype(np.int64),
+            np.concatenate(columns['ticker']).astype(str),
+            np.concatenate(columns['underlying']).astype(np.float64),
+            np.concatenate(columns['delta']).astype(np.float64),
+            np.concatenate(columns['implied_volatility']).astype(np.float64)
+        )
+    
+    def organize_opening_range_data_numpy(self, range_data:Iterable, range_duration_to_test:int) -> dict:
+        """
+        Columnar version of organize_opening_range_data with the same output.
+        Groups rows by (ticker, day) with NumPy and computes every opening range
+        in bulk. Takes the same rows, or stream_opening_range_data(as_numpy=True)
+        record chunks.
+
+        The range of a day slides forward with each row inside it, so with rows in
+        time order it ends at the first gap longer than range_duration_to_test.
+        If a day's rows are out of time order, the row by row version is used.
+        """
+        timestamps, tickers, prices, deltas, vols = self.opening_range_columns(range_data)
+
+        if not timestamps.size:
+            return defaultdict(dict)
+
+        #Local dates, looked up once per 15 minute bucket. Every UTC offset is a multiple of 15 minutes.
+        buckets, bucket_index = np.unique(timestamps // 900, return_inverse=True)
+        bucket_dates = np.array([datetime.fromtimestamp(bucket * 900).strftime('%Y-%m-%d') for bucket in buckets.tolist()])
+        date_names, date_codes = np.unique(bucket_dates[bucket_index], return_inverse=True)
+        ticker_names, ticker_codes = np.unique(tickers, return_inverse=True)
+
+        groups = ticker_codes.astype(np.int64) * len(date_names) + date_codes
+
+        #Stable, so rows keep their order within a group.
+        order = np.argsort(groups, kind='stable')
+        sorted_groups = groups[order]
+        sorted_timestamps = timestamps[order]
+        sorted_prices = prices[order]
+
+        same_group = sorted_groups[1:] == sorted_groups[:-1]
+        gaps = sorted_timestamps[1:] - sorted_timestamps[:-1]
+
+        if np.any(gaps[same_group] < 0):
+            _LOGGER.info('Opening range rows are out of time order, organizing them row by row.')
+            rows = zip(timestamps.tolist(), tickers.tolist(), prices.tolist(), deltas.tolist(), vols.tolist())
+            return self.organize_opening_range_data(rows, range_duration_to_test)
+
+        starts = np.flatnonzero(np.concatenate(([True], ~same_group)))
+        group_sizes = np.diff(np.append(starts, sorted_groups.size))
+
+        #A row is in the range until its group's first gap that is too long.
+        breaks = np.concatenate(([0], np.cumsum(same_group & (gaps > range_duration_to_test))))
+        in_range = breaks == np.repeat(breaks[starts], group_sizes)
+
+        count_trades = np.add.reduceat(in_range, starts)
+        highs = np.maximum.reduceat(np.where(in_range, sorted_prices, -np.inf), starts)
+        lows = np.minimum.reduceat(np.where(in_range, sorted_prices, np.inf), starts)
+        trading_starts = np.maximum.reduceat(np.where(in_range, sorted_timestamps, sorted_timestamps.min()), starts)
+
+        #Close-ish ATM vol, good enough. This removes skewness.
+        abs_deltas = np.abs(deltas[order])
+        atm_rows = np.flatnonzero(in_range & (abs_deltas > 0.4) & (abs_deltas < 0.6))
+        atm_groups = np.searchsorted(starts, atm_rows, side='right') - 1
+        split_at = np.flatnonzero(np.diff(atm_groups)) + 1
+        vol_data = dict(zip(
+            atm_groups[np.concatenate(([0], split_at))].tolist() if atm_rows.size else [],
+            np.split(vols[order][atm_rows], split_at)
+        ))
+
+        #Build the output in order of first appearance, like the row by row version.
+        first_rows = order[starts]
+        group_ticker_codes = sorted_groups[starts] // len(date_names)
+        group_date_codes = sorted_groups[starts] % len(date_names)
+        seen_tickers = set()
 
-        Should take about ~2 seconds on average per query, returning a max of 70k rows.
+        organized_data = defaultdict(dict)
+
+        for group in np.argsort(first_rows, kind='stable').tolist():
+            ticker = str(ticker_names[group_ticker_codes[group]])
+            date = str(date_names[group_date_codes[group]])
+
+            #The first date seen for a ticker only starts its entry.
+            if ticker not in seen_tickers:
+                seen_tickers.add(ticker)
+                organized_data[ticker] = {date: defaultdict(int, {'trading_start': 0})}
+                continue
+
+            organized_data[ticker][date] = {
+                'open_price': sorted_prices[starts[group]].item(),
+                'high': highs[group].item(),
+                'low': lows[group].item(),
+                'count_trades': int(count_trades[group]),
+                'trading_start': int(trading_starts[group])
+            }
+
+            if group in vol_data and len(vol_data[group]) > 1:
+                organized_data[ticker][date]['avg_vol'] = fmean(vol_data[group].tolist())
+
+        return organized_data
+    
+    def intraday_query(self, starting_epoch_range:int, ticker:str) -> str:
+        """
+        Build the SQL for a ticker's intraday price data within the range.
         """
         query = """
         SELECT DISTINCT timestamp_utc, underlying
@@ -148,9 +342,97 @@ class CollectOpeningRanges(object):
             ticker = ticker
         )
 
-        data = HELPER.generic_select_query('options', query)
+        return query
+    
+    def pull_intraday_market_data(self, starting_epoch_range:int, ticker:str) -> list:
+        """
+        Query the DB for intraday price data within the range.
+
+        Should take about ~2 seconds on average per query, returning a max of 70k rows.
+        """
+        data = HELPER.generic_select_query('options', self.intraday_query(starting_epoch_range, ticker))
 
         return data
+    
+    def pull_intraday_market_arrays(self, starting_epoch_range:int, ticker:str, batch_size:int = 10000) -> tuple:
+        """
+        pull_intraday_market_data as (timestamps, prices) column arrays, streamed
+        into record chunks so no row dicts are built. This is what
+        compress_time_series_numpy and stream_compress_time_series are fast on.
+        """
+        chunks = list(HELPER.stream_select_query(
+            'options',
+            self.intraday_query(starting_epoch_range, ticker),
+            batch_size = batch_size,
+            as_numpy = True,
+            dtype = INTRADAY_DTYPE
+        ))
+        records = np.concatenate(chunks) if chunks else np.empty(0, dtype=INTRADAY_DTYPE)
+
+        return records['timestamp_utc'], records['underlying']
+    
+    def download_intraday_market_data(self, ticker:str, opening_ranges:dict, cache, max_workers:int = 8) -> list:
+        """
+        Bulk version of pull_intraday_market_data for every day in a ticker's
+        opening_ranges_organized entry. Days are queried concurrently over pooled
+        connections and saved to cache (a caching.DayCache) as each completes.
+        Days already in the cache are skipped, so later runs only fetch new days.
+
+        Days whose session hasn't finished yet are left for a later run, so a
+        partial day is never cached. A failed day is logged and retried next run.
+        Returns the dates downloaded.
+        """
+        cached_days = cache.days()
+        now = int(datetime.now(timezone.utc).timestamp())
+
+        missing_days = {
+            date: day_data['trading_start'] for date, day_data in opening_ranges.items()
+            if day_data.get('trading_start') and date not in cached_days
+            and day_data['trading_start'] + self.market_open_duration < now
+        }
+
+        if not missing_days:
+            _LOGGER.info('All {0} days for {1} are already cached.'.format(len(cached_days), ticker))
+            return []
+
+        #Never run more queries at once than the pool has connections.
+        max_workers = min(max_workers, HELPER.connection_pool('options', max_workers).pool_size)
+
+        downloaded_days = []
+        failed_days = []
+        start_time = time()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(HELPER.pooled_select_query, 'options', self.intraday_query(trading_start, ticker)): date
+                for date, trading_start in missing_days.items()
+            }
+
+            for future in as_completed(futures):
+                date = futures[future]
+                try:
+                    cache.save_day(date, future.result())
+                    downloaded_days.append(date)
+                except SQLError:
+                    failed_days.append(date)
+
+        end_time = time()
+        execution_time = round((end_time - start_time), 3)
+
+        _LOGGER.info('Downloaded {0} new days for {1} in {2} seconds, {3} were already cached.'.format(
+            len(downloaded_days),
+            ticker,
+            execution_time,
+            len(cached_days)
+        ))
+        if failed_days:
+            _LOGGER.warning('Unable to download {0} days for {1}, they will be retried next run: {2}'.format(
+                len(failed_days),
+                ticker,
+                sorted(failed_days)
+            ))
+
+        return sorted(downloaded_days)
 
 
 class StatsAdHoc(object):
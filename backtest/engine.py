@@ -4,17 +4,32 @@ __author__ = "Nathan Ward"
 import logging
 import string
 from random import choice
-from os import environ
 from sys import stdout
 from collections import defaultdict
+from itertools import product
+from hashlib import blake2b
+from time import perf_counter
 from statistics import fmean
-import redis
+from typing import Iterator
 import ujson
+from celery.signals import task_success
 from celery_worker import app
+from backtest import kernel, event_index, market_cache, sweep, result_codec, result_stream, chunk_sizing
+from backtest.instrumentation import span, open_result_span
+from backtest.caching import MANIFEST_DB, staged_dates
 
 _LOGGER = logging.getLogger()
 _LOGGER.setLevel(logging.INFO)
 
+#Strategy parameters that make up a backtest, in the order they are hashed.
+BACKTEST_PARAMETERS = ('stop_distance', 'stop_count_limit', 'stop_cooloff_period', 'limit_distance')
+
+#Redis set in db 0 of backtest ids that are done but not yet reaped into SQL.
+COMPLETED_BACKTESTS_KEY = 'backtests_completed'
+
+#Tasks whose results in the celery backend the reaper picks up.
+REAPED_TASKS = ('backtest.engine.backtest_redux', 'backtest.engine.backtest_batch')
+
 def compress_time_series(agg_data_raw:dict) -> dict:
     """
     Take raw intra-second time series data from the database and compress it by 
@@ -59,6 +74,50 @@ def compress_time_series(agg_data_raw:dict) -> dict:
     return compressed_data
 
 
+def stream_compress_time_series(raw_days, as_arrays: bool = False) -> Iterator[tuple]:
+    """
+    Compress raw intraday data one day at a time as it arrives.
+
+    Takes any iterable of (date, rows) pairs, e.g. a generator pulling one day
+    at a time from the database, and yields (date, compressed_day) in the same
+    format as compress_time_series. Only one day of raw rows needs to be held
+    in memory. Rows are the raw row dicts, a (timestamps, prices) pair of
+    arrays, or a record array with timestamp_utc and underlying fields.
+    Days without rows are skipped.
+
+    as_arrays yields the compressed day as (timestamps, prices) arrays instead
+    of a dict, ready for columnar.encode_day or the NumPy engines.
+
+    Unlike compress_time_series, the duplicate and unchanged price tracking
+    starts over every day, so the first tick of a day is always kept.
+    Out of order rows are sorted into place instead of dropped.
+    """
+    for k_date, v_intraday_data_raw in raw_days:
+        timestamps, prices = kernel.raw_day_arrays(v_intraday_data_raw)
+        if not timestamps.size:
+            continue
+
+        timestamps, prices = kernel.compress_day_arrays(timestamps, prices)
+
+        if as_arrays:
+            yield k_date, (timestamps, prices)
+        else:
+            yield k_date, dict(zip(timestamps.tolist(), prices.tolist()))
+
+
+def compress_time_series_numpy(agg_data_raw: dict) -> dict:
+    """
+    NumPy version of compress_time_series, compressing each day in bulk.
+    Resets per day, see stream_compress_time_series.
+
+    Only faster when the days are already column arrays, (timestamps, prices)
+    pairs from pull_intraday_market_arrays or record arrays from
+    stream_select_query(as_numpy=True). Given the row dicts it spends about as
+    long copying them into arrays as compress_time_series takes.
+    """
+    return dict(stream_compress_time_series(agg_data_raw.items()))
+
+
 def key_gen() -> str:
     """
     Generate random strings to represent a unique backtest from a single time series.
@@ -72,204 +131,288 @@ def key_gen() -> str:
     return (''.join(keylist))
 
 
-def get_available_dates() -> list:
+def backtest_key(
+    parameter_set: dict,
+    dataset_version: str,
+    ticker: str = None,
+    dates: list = None,
+    result_format: str = 'full'
+) -> str:
     """
-    Once data is pre-staged in Redis, get a list of available dates to processes.
+    Content-addressed backtest id, a hash of the strategy parameters, the staged
+    dataset version, the ticker and the result format, plus the dates when only
+    some are backtested. Rerunning the same backtest on the same data gives the
+    same id, so finished work can be recognized and skipped. Parameters are
+    compared as floats, 1 and 1.0 are the same backtest. The format is part of
+    the id as the stored trade_stats differ, a 'summary' run doesn't stand in
+    for a 'full' one.
     """
-    available_dates = []
+    digest = blake2b(digest_size=16)
+    digest.update(ujson.dumps([
+        [float(parameter_set[parameter]) for parameter in BACKTEST_PARAMETERS],
+        dataset_version,
+        ticker or '',
+        sorted(dates) if dates else None,
+        result_format
+    ]).encode('utf-8'))
 
-    r = redis.Redis(host=environ['REDIS_ENDPOINT'], port=6379, db=2, decode_responses=True)
+    return digest.hexdigest()
 
-    for item in r.scan_iter():
-        available_dates.append(item)
 
-    return available_dates
+def mark_completed(results: list, r = None) -> None:
+    """
+    Record finished backtest ids in Redis until the reaper has them in SQL,
+    so the seeder can skip them. Only call this once the results are stored,
+    pass a pipeline as r to mark them in the transaction that stores them.
+    """
+    if r is None:
+        r = market_cache.redis_client(0)
 
+    backtest_ids = [result['backtest_id'] for result in results]
+    if backtest_ids:
+        r.sadd(COMPLETED_BACKTESTS_KEY, *backtest_ids)
 
-@app.task(bind=True)
-def backtest_redux(
-    self,
-    stop_distance = 0.25,
-    stop_count_limit = 4,
-    stop_cooloff_period = 30,
-    limit_distance = 5
-) -> dict:
-    """
-    Using opening range information and intraday price data, perform a backtest.
 
-    Redux: Re-wrote this logic to make it clearer.
+def publish_completed_results(results: list, completed: bool = True) -> None:
     """
-    backtest_stats = defaultdict(dict)
-
-    #Grab keys of available dates in both caches.
-    date_list = get_available_dates()
+    Add results to the result stream and, with completed, mark them completed
+    in the same MULTI/EXEC, so an id is never marked without its results.
+    """
+    with market_cache.redis_client(0).pipeline() as pipe:
+        result_stream.publish_results(results, pipe)
+        if completed:
+            mark_completed(results, pipe)
+        pipe.execute()
 
-    #Opening ranges staged data.
-    r_opening_ranges = redis.Redis(host=environ['REDIS_ENDPOINT'], port=6379, db=1, decode_responses=True)
-    opening_range_info = {}
-    for count, data in enumerate(r_opening_ranges.mget(date_list)):
-        opening_range_info[date_list[count]] = ujson.loads(data)
 
-    #Time series data.
-    r_time_series_agg = redis.Redis(host=environ['REDIS_ENDPOINT'], port=6379, db=2, decode_responses=True)
-    compressed_agg_data = {}
-    for count, data in enumerate(r_time_series_agg.mget(date_list)):
-        compressed_agg_data[date_list[count]] = ujson.loads(data)
+@task_success.connect
+def mark_stored_results_completed(sender = None, result = None, **kwargs) -> None:
+    """
+    Mark backend results completed. Celery sends task_success only after the
+    result is in the backend, so a task killed or failing to store its result
+    never leaves its ids marked. If the reaper was quicker and already has the
+    rows in SQL, the ids linger in the set, which only skips what SQL has.
+    """
+    if sender is None or sender.name not in REAPED_TASKS or not result:
+        return
 
-    for date in date_list:
-        #Per-trade information. Things like holding period, p&l, cost basis.
-        trade_stats = defaultdict(dict)
+    results = [result] if isinstance(result, dict) else result
+    mark_completed([result_item for result_item in results if result_item.get('reap') is not False])
 
-        #Holding object for stop price.
-        stop_price = 0
 
-        #Holding object for limit price.
-        limit_price = 0
+def get_available_dates(ticker: str = None) -> list:
+    """
+    Once data is pre-staged in Redis, get a list of available dates to processes.
+    Pass ticker for data staged with ticker namespaced keys.
+    """
+    return staged_dates(
+        market_cache.redis_client(2),
+        ticker,
+        r_manifest = market_cache.redis_client(MANIFEST_DB)
+    )
 
-        #Count of how many times the stop was hit.
-        stop_triggered_count = 0
 
-        #Count of times trade has initiated.
-        trade_initiated_count = 0
+class EngineError(Exception):
+    """Exception class if a backtest cannot be run with the requested settings."""
+    pass
 
-        #Stop cooloff timestamp, used to time the cooloff period.
-        stop_cooloff_timestamp = 0
 
-        #Indicate if there is an active position on or not.
-        active_position_long = False
-        active_position_short = False
+#Available simulation engines. The reference engine is the original tick by tick
+#loop, every other engine must produce identical results to it.
+ENGINE_MODES = ('reference', 'numpy', 'indexed')
 
-        #Opening range information.
-        range_high = opening_range_info[date]['high']
-        range_low = opening_range_info[date]['low']
-        day_open_price = opening_range_info[date]['open_price']
-
-        #End of the trading day.
-        end_of_trading_day_timestamp = int(list(compressed_agg_data[date].keys())[-1])
-
-        #Map key
-        #top = trade open price
-        #to = timestamp opened
-        #d = direction
-        #tcp = trade close price
-        #p = profit
-        #hp = holding period
-        #tc = timestamp closed
-
-        for k_timestamp_str, v_price in compressed_agg_data[date].items():
-            #JSON keys get converted to strings during transit,
-            #convert back to an int correct data type for comparison.
-            k_timestamp = int(k_timestamp_str)
-
-            #Check to see if the stop has reached the risk limit.
-            #Skip further processing for the day if that is the case.
-            if stop_triggered_count == stop_count_limit:
-                break
-
-            #Check to see if the stop was hit last iteration and needs to cool off.
-            #If the cooldown period is active, skip processing this timestamp.
-            if k_timestamp < stop_cooloff_timestamp:
-                continue
-
-            #No position, check ranges.
-            if not active_position_long and not active_position_short:
-                #Bullish breakout above the opening range.
-                if v_price > range_high:
-                    active_position_long = True
-                    stop_price = v_price - stop_distance
-                    limit_price = v_price + limit_distance
-                    trade_initiated_count += 1
-                    trade_stats[trade_initiated_count] = {
-                        'top': v_price,
-                        'to': k_timestamp,
-                        'd': 'long'
-                    }
-                #Bearish breakdown below the opening range.
-                elif v_price < range_low:
-                    active_position_short = True
-                    stop_price = v_price + stop_distance
-                    limit_price = v_price - limit_distance
-                    trade_initiated_count += 1
-                    trade_stats[trade_initiated_count] = {
-                        'top': v_price,
-                        'to': k_timestamp,
-                        'd': 'short'
-                    }
-            #There is an active position.
-            else:
-                if active_position_long:
-                    if v_price >= limit_price or k_timestamp == end_of_trading_day_timestamp:
-                        #Reached the limit or end of day, take profit and close the position.
-                        trade_stats[trade_initiated_count].update({
-                            'tcp': v_price,
-                            'p': v_price - trade_stats[trade_initiated_count]['top'],
-                            'hp': k_timestamp - trade_stats[trade_initiated_count]['to'],
-                            'tc': k_timestamp
-                        })
-                        #Since this is a trend following strategy, once profit has been achieved, no 
-                        #further trading for the day.
-                        break
-                    elif v_price <= stop_price:
-                        #Stopped out, take the loss and start a cooldown period.
-                        stop_cooloff_timestamp = k_timestamp + stop_cooloff_period
-                        stop_triggered_count += 1
-                        trade_stats[trade_initiated_count].update({
-                            'tcp': v_price,
-                            'p': v_price - trade_stats[trade_initiated_count]['top'],
-                            'hp': k_timestamp - trade_stats[trade_initiated_count]['to'],
-                            'tc': k_timestamp
-                        })
-                        stop_price = 0
-                        limit_price = 0
-                        active_position_long = False
-                elif active_position_short:
-                    if v_price <= limit_price or k_timestamp == end_of_trading_day_timestamp:
-                        #Reached the limit or end of the day, take profit and close the position.
-                        trade_stats[trade_initiated_count].update({
-                            'tcp': v_price,
-                            'p':  v_price - trade_stats[trade_initiated_count]['top'],
-                            'hp': k_timestamp - trade_stats[trade_initiated_count]['to'],
-                            'tc': k_timestamp
-                        })
-                        #Since this is a trend following strategy, once profit has been achieved, no 
-                        #further trading for the day.
-                        break
-                    elif v_price >= stop_price:
-                        #Stopped out, take the loss and start a cooldown period.
-                        stop_cooloff_timestamp = k_timestamp + stop_cooloff_period
-                        stop_triggered_count += 1
-                        trade_stats[trade_initiated_count].update({
-                            'tcp': v_price,
-                            'p': trade_stats[trade_initiated_count]['top'] - v_price,
-                            'hp': k_timestamp - trade_stats[trade_initiated_count]['to'],
-                            'tc': k_timestamp
-                        })
-                        stop_price = 0
-                        limit_price = 0
-                        active_position_short = False
-
-        #Map key
-        #st = stops triggered
-        #tt = trades triggered
-        #ahp = average holding period
-        #snp = sum of net profit
-
-        additional_stats = {}
-        additional_stats['st'] = stop_triggered_count
-        additional_stats['tt'] = trade_initiated_count
-
-        holding_period_data = []
-        for v in trade_stats.values():
-            try:
-                holding_period_data.append(v['hp'])
-            except KeyError:
-                break
-
-        additional_stats['ahp'] = fmean(holding_period_data)
-        additional_stats['snp'] = sum(k['p'] for k in trade_stats.values())
-
-        backtest_stats[date] = trade_stats | additional_stats
 
+def check_task_options(engine_mode: str, result_format: str, engine_modes: tuple = ENGINE_MODES) -> None:
+    """
+    Reject an unknown engine mode or result format before a task loads or
+    derives any price data for it.
+    """
+    if engine_mode not in engine_modes:
+        raise EngineError('Unknown engine mode {0}, expected one of {1}.'.format(engine_mode, engine_modes))
+
+    if result_format not in result_codec.RESULT_FORMATS:
+        raise result_codec.ResultFormatError('Unknown result format {0}, expected one of {1}.'.format(result_format, result_codec.RESULT_FORMATS))
+
+
+def simulate_day(
+    compressed_day: dict,
+    range_high: float,
+    range_low: float,
+    stop_distance: float,
+    stop_count_limit: int,
+    stop_cooloff_period: int,
+    limit_distance: float
+) -> tuple:
+    """
+    Reference engine. Walk every compressed tick of a single day and simulate
+    the strategy. Returns (trade_stats, stop_triggered_count, trade_initiated_count).
+    """
+    #Per-trade information. Things like holding period, p&l, cost basis.
+    trade_stats = defaultdict(dict)
+
+    #Holding object for stop price.
+    stop_price = 0
+
+    #Holding object for limit price.
+    limit_price = 0
+
+    #Count of how many times the stop was hit.
+    stop_triggered_count = 0
+
+    #Count of times trade has initiated.
+    trade_initiated_count = 0
+
+    #Stop cooloff timestamp, used to time the cooloff period.
+    stop_cooloff_timestamp = 0
+
+    #Indicate if there is an active position on or not.
+    active_position_long = False
+    active_position_short = False
+
+    #End of the trading day.
+    end_of_trading_day_timestamp = int(list(compressed_day.keys())[-1])
+
+    #Map key
+    #top = trade open price
+    #to = timestamp opened
+    #d = direction
+    #tcp = trade close price
+    #p = profit
+    #hp = holding period
+    #tc = timestamp closed
+
+    for k_timestamp_str, v_price in compressed_day.items():
+        #JSON keys get converted to strings during transit,
+        #convert back to an int correct data type for comparison.
+        k_timestamp = int(k_timestamp_str)
+
+        #Check to see if the stop has reached the risk limit.
+        #Skip further processing for the day if that is the case.
+        if stop_triggered_count == stop_count_limit:
+            break
+
+        #Check to see if the stop was hit last iteration and needs to cool off.
+        #If the cooldown period is active, skip processing this timestamp.
+        if k_timestamp < stop_cooloff_timestamp:
+            continue
+
+        #No position, check ranges.
+        if not active_position_long and not active_position_short:
+            #Bullish breakout above the opening range.
+            if v_price > range_high:
+                active_position_long = True
+                stop_price = v_price - stop_distance
+                limit_price = v_price + limit_distance
+                trade_initiated_count += 1
+                trade_stats[trade_initiated_count] = {
+                    'top': v_price,
+                    'to': k_timestamp,
+                    'd': 'long'
+                }
+            #Bearish breakdown below the opening range.
+            elif v_price < range_low:
+                active_position_short = True
+                stop_price = v_price + stop_distance
+                limit_price = v_price - limit_distance
+                trade_initiated_count += 1
+                trade_stats[trade_initiated_count] = {
+                    'top': v_price,
+                    'to': k_timestamp,
+                    'd': 'short'
+                }
+        #There is an active position.
+        else:
+            if active_position_long:
+                if v_price >= limit_price or k_timestamp == end_of_trading_day_timestamp:
+                    #Reached the limit or end of day, take profit and close the position.
+                    trade_stats[trade_initiated_count].update({
+                        'tcp': v_price,
+                        'p': v_price - trade_stats[trade_initiated_count]['top'],
+                        'hp': k_timestamp - trade_stats[trade_initiated_count]['to'],
+                        'tc': k_timestamp
+                    })
+                    #Since this is a trend following strategy, once profit has been achieved, no 
+                    #further trading for the day.
+                    break
+                elif v_price <= stop_price:
+                    #Stopped out, take the loss and start a cooldown period.
+                    stop_cooloff_timestamp = k_timestamp + stop_cooloff_period
+                    stop_triggered_count += 1
+                    trade_stats[trade_initiated_count].update({
+                        'tcp': v_price,
+                        'p': v_price - trade_stats[trade_initiated_count]['top'],
+                        'hp': k_timestamp - trade_stats[trade_initiated_count]['to'],
+                        'tc': k_timestamp
+                    })
+                    stop_price = 0
+                    limit_price = 0
+                    active_position_long = False
+            elif active_position_short:
+                if v_price <= limit_price or k_timestamp == end_of_trading_day_timestamp:
+                    #Reached the limit or end of the day, take profit and close the position.
+                    trade_stats[trade_initiated_count].update({
+                        'tcp': v_price,
+                        'p':  v_price - trade_stats[trade_initiated_count]['top'],
+                        'hp': k_timestamp - trade_stats[trade_initiated_count]['to'],
+                        'tc': k_timestamp
+                    })
+                    #Since this is a trend following strategy, once profit has been achieved, no 
+                    #further trading for the day.
+                    break
+                elif v_price >= stop_price:
+                    #Stopped out, take the loss and start a cooldown period.
+                    stop_cooloff_timestamp = k_timestamp + stop_cooloff_period
+                    stop_triggered_count += 1
+                    trade_stats[trade_initiated_count].update({
+                        'tcp': v_price,
+                        'p': trade_stats[trade_initiated_count]['top'] - v_price,
+                        'hp': k_timestamp - trade_stats[trade_initiated_count]['to'],
+                        'tc': k_timestamp
+                    })
+                    stop_price = 0
+                    limit_price = 0
+                    active_position_short = False
+
+    return trade_stats, stop_triggered_count, trade_initiated_count
+
+
+def summarize_day(trade_stats: dict, stop_triggered_count: int, trade_initiated_count: int) -> dict:
+    """
+    Add the per-day aggregate stats to the per-trade information.
+    """
+    #Map key
+    #st = stops triggered
+    #tt = trades triggered
+    #ahp = average holding period
+    #snp = sum of net profit
+
+    additional_stats = {}
+    additional_stats['st'] = stop_triggered_count
+    additional_stats['tt'] = trade_initiated_count
+
+    holding_period_data = []
+    for v in trade_stats.values():
+        try:
+            holding_period_data.append(v['hp'])
+        except KeyError:
+            break
+
+    additional_stats['ahp'] = fmean(holding_period_data)
+    additional_stats['snp'] = sum(k['p'] for k in trade_stats.values())
+
+    return trade_stats | additional_stats
+
+
+def summarize_backtest(
+    backtest_stats: dict,
+    stop_distance: float,
+    stop_count_limit: int,
+    stop_cooloff_period: int,
+    limit_distance: float
+) -> dict:
+    """
+    Roll the per-day stats up into the backtest result.
+    """
     profit_results = []
     holding_period = []
     win_rate = []
@@ -294,3 +437,313 @@ def backtest_redux(
         'trade_stats': backtest_stats
     }
 
+
+def run_backtest(
+    date_list: list,
+    opening_range_info: dict,
+    price_data: dict,
+    stop_distance: float,
+    stop_count_limit: int,
+    stop_cooloff_period: int,
+    limit_distance: float,
+    engine_mode: str = 'reference'
+) -> dict:
+    """
+    Run a single parameter set over already loaded data.
+
+    price_data maps each date to its compressed dict. The numpy engine also
+    accepts (timestamps, prices) tuples from kernel.day_arrays and the indexed
+    engine accepts event_index.DayIndex objects, so callers running many
+    parameter sets can convert once up front.
+    """
+    if engine_mode not in ENGINE_MODES:
+        raise EngineError('Unknown engine mode {0}, expected one of {1}.'.format(engine_mode, ENGINE_MODES))
+
+    backtest_stats = defaultdict(dict)
+
+    for date in date_list:
+        range_high = opening_range_info[date]['high']
+        range_low = opening_range_info[date]['low']
+
+        if engine_mode == 'indexed':
+            day_data = price_data[date]
+            if isinstance(day_data, dict):
+                day_data = kernel.day_arrays(day_data)
+            if not isinstance(day_data, event_index.DayIndex):
+                day_data = event_index.DayIndex(*day_data)
+
+            day_result = event_index.simulate_day(
+                day_data,
+                range_high,
+                range_low,
+                stop_distance,
+                stop_count_limit,
+                stop_cooloff_period,
+                limit_distance
+            )
+        elif engine_mode == 'numpy':
+            day_data = price_data[date]
+            if isinstance(day_data, dict):
+                day_data = kernel.day_arrays(day_data)
+
+            day_result = kernel.simulate_day(
+                day_data[0],
+                day_data[1],
+                range_high,
+                range_low,
+                stop_distance,
+                stop_count_limit,
+                stop_cooloff_period,
+                limit_distance
+            )
+        else:
+            day_result = simulate_day(
+                price_data[date],
+                range_high,
+                range_low,
+                stop_distance,
+                stop_count_limit,
+                stop_cooloff_period,
+                limit_distance
+            )
+
+        backtest_stats[date] = summarize_day(*day_result)
+
+    return summarize_backtest(
+        backtest_stats,
+        stop_distance,
+        stop_count_limit,
+        stop_cooloff_period,
+        limit_distance
+    )
+
+
+@app.task(bind=True)
+def backtest_redux(
+    self,
+    stop_distance = 0.25,
+    stop_count_limit = 4,
+    stop_cooloff_period = 30,
+    limit_distance = 5,
+    engine_mode = 'reference',
+    result_format = 'full',
+    ticker = None,
+    result_channel = 'backend'
+) -> dict:
+    """
+    Using opening range information and intraday price data, perform a backtest.
+
+    Redux: Re-wrote this logic to make it clearer.
+
+    Staged data comes from the worker's market data cache, which only reloads
+    from Redis when the dataset version changes.
+
+    engine_mode picks the simulation engine, 'reference' for the original tick
+    by tick loop, 'numpy' for the array based kernel or 'indexed' to jump from
+    entry to exit with the precomputed per-day event indexes. All return the
+    same result.
+
+    result_format picks how trade_stats are returned, see backtest.result_codec.
+    'full' is the nested per-day dict, 'compact' a packed columnar trade log and
+    'summary' only the net P&L per day.
+
+    ticker selects a dataset staged with ticker namespaced keys, the result
+    records which ticker it is for. Without it the un-namespaced data is used.
+
+    The result's backtest_id is backtest_key() of its parameters, the dataset
+    version, the ticker and result_format. It is recorded as completed for the
+    seeder once the result is stored, see mark_stored_results_completed.
+
+    result_channel 'stream' publishes the result to the Redis result stream and
+    returns None, see backtest.result_stream. Send the task with ignore_result.
+    """
+    check_task_options(engine_mode, result_format)
+
+    with span('redux.dataset'):
+        dataset = market_cache.get_dataset(ticker)
+
+    with span('redux.price_data'):
+        price_data = dataset.engine_price_data(engine_mode)
+
+    with span('redux.simulate'):
+        result = run_backtest(
+            dataset.date_list,
+            dataset.opening_range_info,
+            price_data,
+            stop_distance,
+            stop_count_limit,
+            stop_cooloff_period,
+            limit_distance,
+            engine_mode = engine_mode
+        )
+
+    if ticker:
+        result['ticker'] = ticker
+
+    #Data staged without a manifest has no version, those keep the random id.
+    if dataset.version:
+        result['backtest_id'] = backtest_key(result, dataset.version, ticker, result_format=result_format)
+
+    with span('redux.encode'):
+        result = result_codec.encode_result(result, result_format)
+
+    if result_channel == 'stream':
+        with span('redux.publish_result'):
+            publish_completed_results([result], completed = bool(dataset.version))
+        return None
+
+    open_result_span('redux.store_result')
+
+    return result
+
+
+def run_sweep(date_list: list, opening_range_info: dict, price_data: dict, parameter_sets: list) -> list:
+    """
+    Run many parameter sets over already loaded data with the shared-prefix
+    sweep engine. Returns one result per parameter set, identical to running
+    run_backtest for each of them.
+    """
+    day_indexes = {}
+    for date in date_list:
+        day_data = price_data[date]
+        if isinstance(day_data, dict):
+            day_data = kernel.day_arrays(day_data)
+        if not isinstance(day_data, event_index.DayIndex):
+            day_data = event_index.DayIndex(*day_data)
+        day_indexes[date] = day_data
+
+    results = []
+    for parameter_set, day_results in zip(parameter_sets, sweep.sweep(date_list, opening_range_info, day_indexes, parameter_sets)):
+        backtest_stats = defaultdict(dict)
+        for date in date_list:
+            backtest_stats[date] = summarize_day(*day_results[date])
+
+        results.append(
+            summarize_backtest(
+                backtest_stats,
+                parameter_set['stop_distance'],
+                parameter_set['stop_count_limit'],
+                parameter_set['stop_cooloff_period'],
+                parameter_set['limit_distance']
+            )
+        )
+
+    return results
+
+
+def expand_parameter_grid(parameter_grid: dict) -> list:
+    """
+    Expand a grid like {'stop_distance': [0.1, 0.2], 'limit_distance': [1, 2], ...}
+    into a list of parameter set dicts, one per combination.
+    """
+    keys = list(parameter_grid.keys())
+
+    return [dict(zip(keys, values)) for values in product(*(parameter_grid[k] for k in keys))]
+
+
+@app.task(bind=True)
+def backtest_batch(
+    self,
+    parameter_sets = None,
+    parameter_grid = None,
+    engine_mode = 'numpy',
+    dates = None,
+    reap = True,
+    result_format = 'full',
+    ticker = None,
+    result_channel = 'backend'
+) -> list:
+    """
+    Evaluate many parameter sets against one copy of the staged data.
+
+    Takes a list of parameter set dicts, each with stop_distance, stop_count_limit,
+    stop_cooloff_period and limit_distance, and/or a parameter_grid which is
+    expanded into every combination. The data comes from the worker's market data
+    cache, decoded once for the whole batch. Returns one backtest_redux style
+    result per parameter set, in order.
+
+    engine_mode takes the backtest_redux modes, plus 'sweep' to simulate the
+    whole batch as shared-prefix trees with backtest.sweep.
+
+    dates restricts the backtest to a subset of the staged dates, used by the
+    optimizer to screen parameter sets cheaply. reap=False marks the results so
+    the reaper leaves them in Redis for whoever sent the task to read.
+    result_format, ticker and result_channel work like they do for
+    backtest_redux. Results that aren't reaped always go to the backend.
+    """
+    all_parameter_sets = list(parameter_sets or [])
+    if parameter_grid:
+        all_parameter_sets.extend(expand_parameter_grid(parameter_grid))
+
+    if not all_parameter_sets:
+        return []
+
+    check_task_options(engine_mode, result_format, ENGINE_MODES + ('sweep',))
+
+    with span('batch.dataset'):
+        dataset = market_cache.get_dataset(ticker)
+
+    #Every parameter set reuses the same decoded data.
+    with span('batch.price_data'):
+        price_data = dataset.engine_price_data(engine_mode)
+
+    if dates:
+        requested_dates = set(dates)
+        date_list = [date for date in dataset.date_list if date in requested_dates]
+        if not date_list:
+            raise EngineError('None of the requested dates are staged, missing {0}.'.format(sorted(requested_dates)))
+    else:
+        date_list = dataset.date_list
+
+    simulate_start = perf_counter()
+
+    with span('batch.simulate'):
+        if engine_mode == 'sweep':
+            results = run_sweep(date_list, dataset.opening_range_info, price_data, all_parameter_sets)
+        else:
+            results = []
+            for parameter_set in all_parameter_sets:
+                results.append(
+                    run_backtest(
+                        date_list,
+                        dataset.opening_range_info,
+                        price_data,
+                        parameter_set['stop_distance'],
+                        parameter_set['stop_count_limit'],
+                        parameter_set['stop_cooloff_period'],
+                        parameter_set['limit_distance'],
+                        engine_mode = engine_mode
+                    )
+                )
+
+    with span('batch.encode'):
+        for result in results:
+            result_codec.encode_result(result, result_format)
+            if ticker:
+                result['ticker'] = ticker
+            if dates:
+                result['dates_evaluated'] = len(date_list)
+            if not reap:
+                result['reap'] = False
+            if dataset.version:
+                result['backtest_id'] = backtest_key(result, dataset.version, ticker, dates, result_format)
+
+    #Feeds the seeder's adaptive batch sizing.
+    with span('batch.record_cost'):
+        chunk_sizing.record_cost(
+            ticker,
+            engine_mode,
+            dataset.version,
+            perf_counter() - simulate_start,
+            len(all_parameter_sets),
+            len(date_list)
+        )
+
+    if result_channel == 'stream' and reap:
+        with span('batch.publish_result'):
+            publish_completed_results(results, completed = bool(dataset.version))
+        return None
+
+    open_result_span('batch.store_result')
+
+    return results
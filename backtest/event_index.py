@@ -0,0 +1,220 @@
+__author__ = "Nathan Ward"
+
+"""
+Precomputed per-day event indexes for the opening range breakout strategy.
+
+Once a trade is open the only question is where price first crosses the stop
+or the limit. DayIndex answers "first index at or after i where price >= X"
+(or <= X) in logarithmic time. Prices are split into fixed size blocks, and a
+sparse table over the block maxima/minima finds the first block that can
+contain a crossing. Only that block and the starting one are ever scanned.
+The index is O(n) memory and built once per staged day, which makes a
+backtest's cost scale with its trade count instead of its tick count.
+"""
+
+import logging
+import numpy as np
+from backtest.kernel import first_true
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+#Ticks per block. Small enough that scanning one block is cheap, large enough
+#that the sparse tables stay a small fraction of the price data.
+DEFAULT_BLOCK_SIZE = 64
+
+
+def _sparse_table(block_values: np.ndarray, reducer) -> list:
+    """
+    Level k holds the reduction over 2^k consecutive blocks starting at each block.
+    """
+    table = [block_values]
+    span = 1
+
+    while span * 2 <= len(block_values):
+        previous = table[-1]
+        table.append(reducer(previous[:-span], previous[span:]))
+        span *= 2
+
+    return table
+
+
+class DayIndex(object):
+    """
+    Crossing queries over one day of (timestamps, prices) arrays.
+    """
+    def __init__(self, timestamps: np.ndarray, prices: np.ndarray, block_size: int = DEFAULT_BLOCK_SIZE):
+        self.timestamps = timestamps
+        self.prices = prices
+        self.block_size = block_size
+        self.count = len(prices)
+
+        if self.count:
+            block_starts = np.arange(0, self.count, block_size)
+            self.max_table = _sparse_table(np.maximum.reduceat(prices, block_starts), np.maximum)
+            self.min_table = _sparse_table(np.minimum.reduceat(prices, block_starts), np.minimum)
+        else:
+            self.max_table = [np.empty(0)]
+            self.min_table = [np.empty(0)]
+
+    @property
+    def nbytes(self) -> int:
+        return self.timestamps.nbytes + self.prices.nbytes + sum(level.nbytes for level in self.max_table + self.min_table)
+
+    def _first_crossing(self, start: int, threshold: float, above: bool, strict: bool) -> int:
+        if start >= self.count:
+            return -1
+
+        block_size = self.block_size
+        prices = self.prices
+
+        #Rest of the starting block.
+        first_block_end = (start // block_size + 1) * block_size
+        segment = prices[start:first_block_end]
+        if above:
+            hit = first_true(segment > threshold if strict else segment >= threshold)
+        else:
+            hit = first_true(segment < threshold if strict else segment <= threshold)
+
+        if hit != -1:
+            return start + hit
+
+        #Skip whole runs of blocks that can't contain a crossing, largest runs first.
+        table = self.max_table if above else self.min_table
+        block_count = len(table[0])
+        block = start // block_size + 1
+
+        for level in range(len(table) - 1, -1, -1):
+            if block + (1 << level) > block_count:
+                continue
+
+            value = table[level][block]
+            if above:
+                crossed = value > threshold if strict else value >= threshold
+            else:
+                crossed = value < threshold if strict else value <= threshold
+
+            if not crossed:
+                block += 1 << level
+
+        if block >= block_count:
+            return -1
+
+        segment = prices[block * block_size:(block + 1) * block_size]
+        if above:
+            hit = first_true(segment > threshold if strict else segment >= threshold)
+        else:
+            hit = first_true(segment < threshold if strict else segment <= threshold)
+
+        return block * block_size + hit
+
+    def first_at_or_above(self, start: int, threshold: float, strict: bool = False) -> int:
+        """
+        First index at or after start where price >= threshold (> when strict), or -1.
+        """
+        return self._first_crossing(start, threshold, True, strict)
+
+    def first_at_or_below(self, start: int, threshold: float, strict: bool = False) -> int:
+        """
+        First index at or after start where price <= threshold (< when strict), or -1.
+        """
+        return self._first_crossing(start, threshold, False, strict)
+
+    def first_at_or_after_timestamp(self, timestamp: float) -> int:
+        """
+        First index whose timestamp is at or after the given one.
+        """
+        return int(np.searchsorted(self.timestamps, timestamp, side='left'))
+
+
+def simulate_day(
+    day_index: DayIndex,
+    range_high: float,
+    range_low: float,
+    stop_distance: float,
+    stop_count_limit: int,
+    stop_cooloff_period: int,
+    limit_distance: float
+) -> tuple:
+    """
+    Run the strategy over a single day, jumping from entry to exit with index
+    queries. Returns the same (trade_stats, stop_triggered_count,
+    trade_initiated_count) as the reference and NumPy engines.
+    """
+    trade_stats = {}
+    stop_triggered_count = 0
+    trade_initiated_count = 0
+
+    timestamps = day_index.timestamps
+    prices = day_index.prices
+    last_index = day_index.count - 1
+    position = 0
+
+    while position <= last_index:
+        if stop_triggered_count == stop_count_limit:
+            break
+
+        #Next breakout on either side of the opening range, long wins a tie like the reference.
+        long_entry = day_index.first_at_or_above(position, range_high, strict=True)
+        short_entry = day_index.first_at_or_below(position, range_low, strict=True)
+
+        if long_entry == -1 and short_entry == -1:
+            break
+
+        if short_entry == -1 or (long_entry != -1 and long_entry <= short_entry):
+            entry = long_entry
+            is_long = True
+        else:
+            entry = short_entry
+            is_long = False
+
+        entry_price = prices[entry].item()
+        entry_timestamp = int(timestamps[entry])
+
+        trade_initiated_count += 1
+        trade_stats[trade_initiated_count] = {
+            'top': entry_price,
+            'to': entry_timestamp,
+            'd': 'long' if is_long else 'short'
+        }
+
+        #Opened on the last tick, nothing left to close it with.
+        if entry == last_index:
+            break
+
+        if is_long:
+            limit_hit = day_index.first_at_or_above(entry + 1, entry_price + limit_distance)
+            stop_hit = day_index.first_at_or_below(entry + 1, entry_price - stop_distance)
+        else:
+            limit_hit = day_index.first_at_or_below(entry + 1, entry_price - limit_distance)
+            stop_hit = day_index.first_at_or_above(entry + 1, entry_price + stop_distance)
+
+        #The end of the day closes the trade like the limit does.
+        limit_index = limit_hit if limit_hit != -1 else last_index
+        stop_index = stop_hit if stop_hit != -1 else last_index + 1
+        exit_index = stop_index if stop_index < limit_index else limit_index
+
+        exit_price = prices[exit_index].item()
+        exit_timestamp = int(timestamps[exit_index])
+
+        if exit_index == limit_index or is_long:
+            profit = exit_price - entry_price
+        else:
+            profit = entry_price - exit_price
+
+        trade_stats[trade_initiated_count].update({
+            'tcp': exit_price,
+            'p': profit,
+            'hp': exit_timestamp - entry_timestamp,
+            'tc': exit_timestamp
+        })
+
+        #Trend following, once profit has been achieved no further trading for the day.
+        if exit_index == limit_index:
+            break
+
+        #Stopped out, skip ahead past the cooloff period.
+        stop_triggered_count += 1
+        position = max(exit_index + 1, day_index.first_at_or_after_timestamp(exit_timestamp + stop_cooloff_period))
+
+    return trade_stats, stop_triggered_count, trade_initiated_count
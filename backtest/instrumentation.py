@@ -0,0 +1,232 @@
+__author__ = "Nathan Ward"
+
+"""
+Per-stage timing spans for the backtest and reaper tasks.
+
+Off by default. With BACKTEST_TIMING=1, every span adds its duration to a
+per worker process aggregate of calls, total and max seconds per stage, and
+the aggregate is published at most every BACKTEST_TIMING_INTERVAL seconds
+after a task finishes. When off, span() hands back one shared no-op context
+manager, so an instrumented stage only costs a function call.
+
+BACKTEST_TIMING_SINK picks where aggregates go:
+    redis       A hash per worker process in Redis db 4, expiring an hour
+                after the worker's last publish. fleet_report() sums them up.
+    prometheus  A textfile per worker process for the node_exporter textfile
+                collector, in BACKTEST_TIMING_TEXTFILE_DIR.
+"""
+
+import logging
+import threading
+from os import environ, getpid, replace, path
+from socket import gethostname
+from time import perf_counter, time
+from celery.signals import task_success
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+TIMING_DB = 4
+TIMING_KEY_PREFIX = 'timing:'
+TIMING_KEY_TTL = 3600
+
+ENABLED = environ.get('BACKTEST_TIMING', '0') == '1'
+SINK = environ.get('BACKTEST_TIMING_SINK', 'redis')
+PUBLISH_INTERVAL = float(environ.get('BACKTEST_TIMING_INTERVAL', 10))
+TEXTFILE_DIR = environ.get('BACKTEST_TIMING_TEXTFILE_DIR', '.')
+
+#Stage name to [calls, total seconds, max seconds] for this process.
+_STATS = {}
+_LOCK = threading.Lock()
+_LAST_PUBLISH = [0.0]
+
+#Span left open when a task returns, closed once celery has stored the result.
+_RESULT_SPAN = {}
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.name, perf_counter() - self.start)
+        return False
+
+
+def span(name: str):
+    """
+    Context manager timing one stage, e.g. with span('redux.simulate'): ...
+    """
+    if ENABLED:
+        return _Span(name)
+
+    return _NULL_SPAN
+
+
+def record(name: str, seconds: float) -> None:
+    with _LOCK:
+        stats = _STATS.get(name)
+        if stats is None:
+            _STATS[name] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+
+def open_result_span(name: str) -> None:
+    """
+    Start timing the result's trip to the backend, i.e. serialization and the
+    store. Call right before the task returns, it is closed when celery sends
+    task_success.
+    """
+    if ENABLED:
+        _RESULT_SPAN['pending'] = (name, perf_counter())
+
+
+def snapshot() -> dict:
+    """
+    Copy of this process's aggregates.
+    """
+    with _LOCK:
+        return {
+            name: {'calls': calls, 'seconds': seconds, 'max': max_seconds}
+            for name, (calls, seconds, max_seconds) in _STATS.items()
+        }
+
+
+def worker_id() -> str:
+    return '{0}:{1}'.format(gethostname(), getpid())
+
+
+def publish(force: bool = False) -> None:
+    """
+    Publish the aggregates to the configured sink, at most once per interval.
+    Failures are only logged, timing must never fail a task.
+    """
+    if not ENABLED or (not force and time() - _LAST_PUBLISH[0] < PUBLISH_INTERVAL):
+        return
+
+    _LAST_PUBLISH[0] = time()
+    stats = snapshot()
+
+    try:
+        if SINK == 'prometheus':
+            _publish_textfile(stats)
+        else:
+            _publish_redis(stats)
+    except Exception as e:
+        _LOGGER.exception('Unable to publish stage timings. {0}'.format(e))
+
+
+def _publish_redis(stats: dict) -> None:
+    #Imported here, market_cache itself is instrumented.
+    from backtest.market_cache import redis_client
+
+    key = '{0}{1}'.format(TIMING_KEY_PREFIX, worker_id())
+    mapping = {}
+    for name, stage in stats.items():
+        mapping['{0}|calls'.format(name)] = stage['calls']
+        mapping['{0}|seconds'.format(name)] = stage['seconds']
+        mapping['{0}|max'.format(name)] = stage['max']
+
+    if mapping:
+        with redis_client(TIMING_DB).pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, TIMING_KEY_TTL)
+            pipe.execute()
+
+
+def _publish_textfile(stats: dict) -> None:
+    worker = worker_id()
+    lines = [
+        '# HELP backtest_stage_seconds_total Time spent in each backtest stage.',
+        '# TYPE backtest_stage_seconds_total counter',
+    ]
+    lines.extend([
+        'backtest_stage_seconds_total{{stage="{0}",worker="{1}"}} {2}'.format(name, worker, stage['seconds'])
+        for name, stage in stats.items()
+    ])
+    lines.extend([
+        '# HELP backtest_stage_calls_total Times each backtest stage ran.',
+        '# TYPE backtest_stage_calls_total counter',
+    ])
+    lines.extend([
+        'backtest_stage_calls_total{{stage="{0}",worker="{1}"}} {2}'.format(name, worker, stage['calls'])
+        for name, stage in stats.items()
+    ])
+    lines.extend([
+        '# HELP backtest_stage_max_seconds Slowest single run of each backtest stage.',
+        '# TYPE backtest_stage_max_seconds gauge',
+    ])
+    lines.extend([
+        'backtest_stage_max_seconds{{stage="{0}",worker="{1}"}} {2}'.format(name, worker, stage['max'])
+        for name, stage in stats.items()
+    ])
+
+    #Write then rename, so the collector never reads a partial file.
+    filepath = path.join(TEXTFILE_DIR, 'backtest_timing_{0}.prom'.format(getpid()))
+    with open(filepath + '.tmp', 'w') as f:
+        f.write('\n'.join(lines))
+        f.write('\n')
+    replace(filepath + '.tmp', filepath)
+
+
+def fleet_report() -> list:
+    """
+    Sum every worker's published aggregates from Redis, slowest stage first.
+    """
+    from backtest.market_cache import redis_client
+
+    r = redis_client(TIMING_DB)
+    totals = {}
+
+    for key in r.scan_iter(match='{0}*'.format(TIMING_KEY_PREFIX)):
+        for field, value in r.hgetall(key).items():
+            name, measure = field.rsplit('|', 1)
+            stage = totals.setdefault(name, {'stage': name, 'calls': 0, 'seconds': 0.0, 'max': 0.0})
+            if measure == 'calls':
+                stage['calls'] += int(value)
+            elif measure == 'seconds':
+                stage['seconds'] += float(value)
+            else:
+                stage['max'] = max(stage['max'], float(value))
+
+    for stage in totals.values():
+        stage['mean_ms'] = round(stage['seconds'] / stage['calls'] * 1000, 3) if stage['calls'] else 0
+
+    return sorted(totals.values(), key=lambda stage: stage['seconds'], reverse=True)
+
+
+def _close_result_span(**kwargs):
+    pending = _RESULT_SPAN.pop('pending', None)
+    if pending is not None:
+        name, start = pending
+        record(name, perf_counter() - start)
+
+    publish()
+
+
+#Only hook into celery when timing is on.
+if ENABLED:
+    task_success.connect(_close_result_span, weak=False)
@@ -0,0 +1,205 @@
+__author__ = "Nathan Ward"
+
+"""
+NumPy simulation kernel for the opening range breakout strategy.
+
+Works on per-day timestamp/price arrays instead of the JSON dicts staged in
+Redis. Rather than visiting every tick, it jumps from breakout to exit with
+array searches, producing the same per-day trade_stats as the reference loop
+in backtest.engine.
+"""
+
+import logging
+from operator import itemgetter
+import numpy as np
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+
+def day_arrays(compressed_day: dict) -> tuple:
+    """
+    Convert one day of compressed price data into (timestamps, prices) arrays.
+
+    Takes data that looks like {'1682343030': 411.99, '1682343032': 411.98}, with
+    keys in ascending order the way compress_time_series emits them.
+    """
+    timestamps = np.fromiter(
+        (int(k) for k in compressed_day.keys()),
+        dtype = np.int64,
+        count = len(compressed_day)
+    )
+    prices = np.fromiter(compressed_day.values(), dtype=np.float64, count=len(compressed_day))
+
+    return timestamps, prices
+
+
+def raw_day_arrays(intraday_data_raw) -> tuple:
+    """
+    Pull the timestamps and prices out of one day of raw rows as arrays.
+    A (timestamps, prices) pair of arrays is passed through, and a record
+    array is split into its timestamp_utc and underlying fields.
+    """
+    if isinstance(intraday_data_raw, tuple):
+        return np.asarray(intraday_data_raw[0], dtype=np.int64), np.asarray(intraday_data_raw[1], dtype=np.float64)
+
+    if isinstance(intraday_data_raw, np.ndarray):
+        return (
+            intraday_data_raw['timestamp_utc'].astype(np.int64, copy=False),
+            intraday_data_raw['underlying'].astype(np.float64, copy=False)
+        )
+
+    timestamps = np.fromiter(
+        map(itemgetter('timestamp_utc'), intraday_data_raw),
+        dtype = np.int64,
+        count = len(intraday_data_raw)
+    )
+    prices = np.fromiter(
+        map(itemgetter('underlying'), intraday_data_raw),
+        dtype = np.float64,
+        count = len(intraday_data_raw)
+    )
+
+    return timestamps, prices
+
+
+def compress_day_arrays(timestamps: np.ndarray, prices: np.ndarray) -> tuple:
+    """
+    Compress one day of raw ticks the way compress_time_series does, in bulk.
+
+    Ticks are put in time order first, then a tick is kept only if its price
+    differs from the tick before it, and a repeated timestamp keeps its last
+    kept price. Returns (timestamps, prices) arrays.
+    """
+    if timestamps.size and np.any(timestamps[1:] < timestamps[:-1]):
+        order = np.argsort(timestamps, kind='stable')
+        timestamps = timestamps[order]
+        prices = prices[order]
+
+    changed = np.empty(prices.size, dtype=bool)
+    changed[:1] = True
+    np.not_equal(prices[1:], prices[:-1], out=changed[1:])
+    timestamps = timestamps[changed]
+    prices = prices[changed]
+
+    last_of_timestamp = np.empty(timestamps.size, dtype=bool)
+    last_of_timestamp[-1:] = True
+    np.not_equal(timestamps[1:], timestamps[:-1], out=last_of_timestamp[:-1])
+
+    return timestamps[last_of_timestamp], prices[last_of_timestamp]
+
+
+def first_true(mask: np.ndarray) -> int:
+    """
+    Index of the first True value in a boolean array, or -1 if there isn't one.
+    """
+    if not mask.size:
+        return -1
+
+    index = int(mask.argmax())
+
+    return index if mask[index] else -1
+
+
+def simulate_day(
+    timestamps: np.ndarray,
+    prices: np.ndarray,
+    range_high: float,
+    range_low: float,
+    stop_distance: float,
+    stop_count_limit: int,
+    stop_cooloff_period: int,
+    limit_distance: float
+) -> tuple:
+    """
+    Run the strategy over a single day of price arrays.
+
+    Returns (trade_stats, stop_triggered_count, trade_initiated_count) with
+    trade_stats keyed the same way as backtest.engine.simulate_day. Matches the
+    reference loop tick for tick, including its quirks: the limit/end of day
+    check wins over the stop on the same tick, a short closed at the limit
+    records price minus open price, and a trade opened on the final tick is
+    left open.
+    """
+    trade_stats = {}
+    stop_triggered_count = 0
+    trade_initiated_count = 0
+
+    last_index = len(prices) - 1
+    position = 0
+
+    #Breakouts only depend on the opening range, so find the candidates once.
+    breakout_indexes = np.flatnonzero((prices > range_high) | (prices < range_low))
+
+    while position <= last_index:
+        if stop_triggered_count == stop_count_limit:
+            break
+
+        #Jump straight to the next breakout at or after the current position.
+        candidate = int(np.searchsorted(breakout_indexes, position))
+        if candidate == len(breakout_indexes):
+            break
+
+        entry = int(breakout_indexes[candidate])
+        entry_price = prices[entry].item()
+        entry_timestamp = int(timestamps[entry])
+        is_long = entry_price > range_high
+
+        trade_initiated_count += 1
+        trade_stats[trade_initiated_count] = {
+            'top': entry_price,
+            'to': entry_timestamp,
+            'd': 'long' if is_long else 'short'
+        }
+
+        #Opened on the last tick, nothing left to close it with.
+        if entry == last_index:
+            break
+
+        window = prices[entry + 1:]
+
+        if is_long:
+            limit_price = entry_price + limit_distance
+            stop_price = entry_price - stop_distance
+            limit_hit = first_true(window >= limit_price)
+            stop_hit = first_true(window <= stop_price)
+        else:
+            limit_price = entry_price - limit_distance
+            stop_price = entry_price + stop_distance
+            limit_hit = first_true(window <= limit_price)
+            stop_hit = first_true(window >= stop_price)
+
+        #The end of the day closes the trade like the limit does.
+        limit_index = entry + 1 + limit_hit if limit_hit != -1 else last_index
+        stop_index = entry + 1 + stop_hit if stop_hit != -1 else last_index + 1
+
+        if stop_index < limit_index:
+            exit_index = stop_index
+        else:
+            exit_index = limit_index
+
+        exit_price = prices[exit_index].item()
+        exit_timestamp = int(timestamps[exit_index])
+
+        if exit_index == limit_index or is_long:
+            profit = exit_price - entry_price
+        else:
+            profit = entry_price - exit_price
+
+        trade_stats[trade_initiated_count].update({
+            'tcp': exit_price,
+            'p': profit,
+            'hp': exit_timestamp - entry_timestamp,
+            'tc': exit_timestamp
+        })
+
+        #Trend following, once profit has been achieved no further trading for the day.
+        if exit_index == limit_index:
+            break
+
+        #Stopped out, skip ahead past the cooloff period.
+        stop_triggered_count += 1
+        cooloff_index = int(np.searchsorted(timestamps, exit_timestamp + stop_cooloff_period, side='left'))
+        position = max(exit_index + 1, cooloff_index)
+
+    return trade_stats, stop_triggered_count, trade_initiated_count
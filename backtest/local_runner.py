@@ -0,0 +1,206 @@
+__author__ = "Nathan Ward"
+
+"""
+Local multi-core backtest runner, no Celery worker, Redis or reaper needed.
+
+Takes the compressed price data from CachedData/compress_time_series and the
+organized opening ranges for a ticker. The price arrays are packed once into
+shared memory, a process pool sized to the cores attaches to them, and the
+parameter grid is fanned out in chunks. Results are written straight to a
+local JSON lines file as chunks finish. Good for laptop/CI iteration, and as
+a baseline for the distributed setup.
+"""
+
+import logging
+from os import cpu_count
+from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import ujson
+from backtest import kernel, event_index, result_codec
+from backtest.engine import run_backtest, run_sweep, expand_parameter_grid
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+#Per worker process view of the shared data, set up by _attach_shared_data.
+_WORKER_DATA = {}
+
+
+def _attach_shared_data(
+    timestamps_name: str,
+    prices_name: str,
+    tick_count: int,
+    day_offsets: list,
+    date_list: list,
+    opening_range_info: dict,
+    engine_mode: str,
+    result_format: str
+) -> None:
+    """
+    Process pool initializer. Maps the shared arrays and slices them into per-day views.
+    """
+    timestamps_shm = shared_memory.SharedMemory(name=timestamps_name)
+    prices_shm = shared_memory.SharedMemory(name=prices_name)
+    timestamps = np.ndarray((tick_count,), dtype=np.int64, buffer=timestamps_shm.buf)
+    prices = np.ndarray((tick_count,), dtype=np.float64, buffer=prices_shm.buf)
+
+    price_data = {}
+    for date, start, end in zip(date_list, day_offsets[:-1], day_offsets[1:]):
+        day_arrays = (timestamps[start:end], prices[start:end])
+        if engine_mode in ('indexed', 'sweep'):
+            price_data[date] = event_index.DayIndex(*day_arrays)
+        elif engine_mode == 'reference':
+            #The reference engine walks {'<timestamp>': price} dicts, built per process.
+            price_data[date] = dict(zip(map(str, day_arrays[0].tolist()), day_arrays[1].tolist()))
+        else:
+            price_data[date] = day_arrays
+
+    _WORKER_DATA.update({
+        'shared_memory': (timestamps_shm, prices_shm),
+        'date_list': date_list,
+        'opening_range_info': opening_range_info,
+        'price_data': price_data,
+        'engine_mode': engine_mode,
+        'result_format': result_format
+    })
+
+
+def _run_chunk(parameter_sets: list) -> list:
+    """
+    Backtest a chunk of parameter sets against the shared data.
+    """
+    date_list = _WORKER_DATA['date_list']
+    opening_range_info = _WORKER_DATA['opening_range_info']
+    price_data = _WORKER_DATA['price_data']
+    engine_mode = _WORKER_DATA['engine_mode']
+
+    if engine_mode == 'sweep':
+        results = run_sweep(date_list, opening_range_info, price_data, parameter_sets)
+    else:
+        results = [
+            run_backtest(
+                date_list,
+                opening_range_info,
+                price_data,
+                parameter_set['stop_distance'],
+                parameter_set['stop_count_limit'],
+                parameter_set['stop_cooloff_period'],
+                parameter_set['limit_distance'],
+                engine_mode = engine_mode
+            ) for parameter_set in parameter_sets
+        ]
+
+    return [result_codec.encode_result(result, _WORKER_DATA['result_format']) for result in results]
+
+
+def run_local(
+    cleaned_data: dict,
+    opening_ranges: dict,
+    parameter_grid: dict = None,
+    parameter_sets: list = None,
+    engine_mode: str = 'numpy',
+    result_format: str = 'full',
+    results_path: str = 'local_results.jsonl',
+    workers: int = None,
+    chunk_size: int = None
+) -> dict:
+    """
+    Run a parameter sweep on this machine.
+
+    cleaned_data is compress_time_series output for one ticker, or (timestamps,
+    prices) days from ColumnarStore.read_range, and opening_ranges is that
+    ticker's entry from organize_opening_range_data. Only dates with both
+    price data and an opening range are backtested. Parameters come from
+    parameter_grid and/or parameter_sets, defaulting to the seeder's grid.
+    Results are written as one JSON object per line to results_path.
+    """
+    if not parameter_grid and not parameter_sets:
+        from backtest.startup import default_parameter_grid
+        parameter_grid = default_parameter_grid()
+
+    all_parameter_sets = list(parameter_sets or [])
+    if parameter_grid:
+        all_parameter_sets.extend(expand_parameter_grid(parameter_grid))
+
+    date_list = [
+        date for date in cleaned_data
+        if len(cleaned_data[date][0] if isinstance(cleaned_data[date], tuple) else cleaned_data[date])
+        and 'high' in opening_ranges.get(date, {})
+    ]
+
+    #Lay every day end to end, the offsets mark where each day starts.
+    day_arrays = [
+        cleaned_data[date] if isinstance(cleaned_data[date], tuple) else kernel.day_arrays(cleaned_data[date])
+        for date in date_list
+    ]
+    day_offsets = [0]
+    for timestamps, prices in day_arrays:
+        day_offsets.append(day_offsets[-1] + len(prices))
+    tick_count = day_offsets[-1]
+
+    workers = workers or cpu_count() or 1
+    if not chunk_size:
+        #A few chunks per worker keeps every core busy through the tail of the sweep.
+        chunk_size = max(1, len(all_parameter_sets) // (workers * 4))
+
+    timestamps_shm = shared_memory.SharedMemory(create=True, size=max(1, tick_count * 8))
+    prices_shm = shared_memory.SharedMemory(create=True, size=max(1, tick_count * 8))
+
+    start_time = time()
+    results_written = 0
+
+    try:
+        if day_arrays:
+            np.concatenate([timestamps for timestamps, prices in day_arrays], out=np.ndarray((tick_count,), dtype=np.int64, buffer=timestamps_shm.buf))
+            np.concatenate([prices for timestamps, prices in day_arrays], out=np.ndarray((tick_count,), dtype=np.float64, buffer=prices_shm.buf))
+        del day_arrays
+
+        with ProcessPoolExecutor(
+            max_workers = workers,
+            initializer = _attach_shared_data,
+            initargs = (
+                timestamps_shm.name,
+                prices_shm.name,
+                tick_count,
+                day_offsets,
+                date_list,
+                {date: opening_ranges[date] for date in date_list},
+                engine_mode,
+                result_format
+            )
+        ) as executor, open(results_path, 'w') as results_file:
+            futures = [
+                executor.submit(_run_chunk, all_parameter_sets[ndx:ndx + chunk_size])
+                for ndx in range(0, len(all_parameter_sets), chunk_size)
+            ]
+
+            for future in as_completed(futures):
+                for result in future.result():
+                    results_file.write(ujson.dumps(result))
+                    results_file.write('\n')
+                    results_written += 1
+    finally:
+        timestamps_shm.close()
+        timestamps_shm.unlink()
+        prices_shm.close()
+        prices_shm.unlink()
+
+    execution_time = round((time() - start_time), 3)
+
+    print('Ran {0} backtests over {1} dates on {2} workers in {3} seconds.'.format(
+        results_written,
+        len(date_list),
+        workers,
+        execution_time
+    ))
+
+    return {
+        'backtests': results_written,
+        'dates': len(date_list),
+        'workers': workers,
+        'duration': execution_time,
+        'backtests_per_second': round(results_written / execution_time, 1) if execution_time else 0,
+        'results_path': results_path
+    }
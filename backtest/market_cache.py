@@ -0,0 +1,340 @@
+__author__ = "Nathan Ward"
+
+"""
+Worker-resident cache of the staged market data.
+
+The staged opening ranges and price series never change during a sweep, so
+each worker process downloads and decodes them once and keeps them in memory
+keyed by the dataset version StageRedis records in the manifest. A task only
+pays for one round trip to check the version, and reloads when it changes.
+"""
+
+import logging
+import threading
+from os import environ
+from sys import getsizeof
+from collections import OrderedDict
+import redis
+import ujson
+from celery.signals import worker_process_init
+from backtest import columnar, event_index
+from backtest.instrumentation import span
+from backtest.caching import MANIFEST_DB, manifest_key, redis_key, staged_dates
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+#Memory cap for cached datasets per worker process, in megabytes.
+DEFAULT_CACHE_MAX_MB = 2048
+
+#Redis clients are reused for the life of the worker process, one per db and decoding mode.
+_REDIS_CLIENTS = {}
+
+
+def redis_client(db_num: int, decode_responses: bool = True) -> redis.Redis:
+    """
+    Get the process-wide Redis client for a db, creating it on first use. Staged
+    price data may be binary, so it is read with decode_responses off.
+    """
+    if (db_num, decode_responses) not in _REDIS_CLIENTS:
+        _REDIS_CLIENTS[(db_num, decode_responses)] = redis.Redis(
+            host = environ['REDIS_ENDPOINT'],
+            port = 6379,
+            db = db_num,
+            decode_responses = decode_responses
+        )
+
+    return _REDIS_CLIENTS[(db_num, decode_responses)]
+
+
+def get_dataset_version(ticker: str = None) -> str:
+    """
+    Get the version of the staged dataset from the manifest. Returns None if the
+    data was staged without one.
+    """
+    opening_ranges_digest, price_data_digest = redis_client(MANIFEST_DB).hmget(
+        manifest_key(ticker),
+        ['opening_ranges', 'price_data']
+    )
+
+    if not opening_ranges_digest or not price_data_digest:
+        return None
+
+    return '{0}-{1}'.format(opening_ranges_digest, price_data_digest)
+
+
+def dict_nbytes(day_dict: dict) -> int:
+    """
+    Rough size of a {'<timestamp>': price} dict, the table plus its str keys
+    and float values, all keys being the same length.
+    """
+    if not day_dict:
+        return getsizeof(day_dict)
+
+    return getsizeof(day_dict) + len(day_dict) * (getsizeof(next(iter(day_dict))) + getsizeof(0.0))
+
+
+class StagedDataset(object):
+    """
+    Decoded copy of the staged data. Price series are kept as per-day
+    (timestamps, prices) arrays, which are far smaller than the JSON dicts.
+    """
+    def __init__(self, ticker: str, version: str, date_list: list, opening_range_info: dict, price_arrays: dict):
+        self.ticker = ticker
+        self.version = version
+        self.date_list = date_list
+        self.opening_range_info = opening_range_info
+        self.price_arrays = price_arrays
+
+        #Event indexes and the reference engine's dicts are built the first time
+        #an engine asks for them, then kept with the dataset if the cache holding
+        #it has room for them.
+        self.day_indexes = None
+        self.day_dicts = None
+        self.day_dicts_bytes = 0
+        self.cache = None
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        #Arrays dominate, opening ranges are a handful of numbers per day.
+        if self.day_indexes is not None:
+            price_bytes = sum(day_index.nbytes for day_index in self.day_indexes.values())
+        else:
+            price_bytes = sum(ts.nbytes + px.nbytes for ts, px in self.price_arrays.values())
+
+        return price_bytes + self.day_dicts_bytes + 512 * len(self.date_list)
+
+    def keep(self, extra_bytes: int) -> bool:
+        """
+        Whether a structure derived from the data can be kept with the dataset,
+        making room for it in the cache holding the dataset if there is one.
+        """
+        if self.cache is None:
+            return True
+
+        if self.cache.make_room(self, extra_bytes):
+            return True
+
+        _LOGGER.warning('No room in the market data cache for {0} more bytes of {1} {2}, rebuilding per task.'.format(
+            extra_bytes,
+            self.ticker,
+            self.version
+        ))
+        return False
+
+    def event_indexes(self) -> dict:
+        """
+        Build the per-day event indexes once, they share the price arrays.
+        """
+        with self.lock:
+            if self.day_indexes is not None:
+                return self.day_indexes
+
+            with span('dataset.event_indexes'):
+                day_indexes = {
+                    date: event_index.DayIndex(ts, px) for date, (ts, px) in self.price_arrays.items()
+                }
+
+            #Only the extremum tables are new, the arrays are already counted.
+            extra_bytes = sum(day_index.nbytes for day_index in day_indexes.values()) - sum(
+                ts.nbytes + px.nbytes for ts, px in self.price_arrays.values()
+            )
+            if self.keep(extra_bytes):
+                self.day_indexes = day_indexes
+
+        return day_indexes
+
+    def price_dicts(self) -> dict:
+        """
+        Build the {'<timestamp>': price} dicts the reference engine walks once.
+        They are many times the size of the arrays, which nbytes accounts for.
+        """
+        with self.lock:
+            if self.day_dicts is not None:
+                return self.day_dicts
+
+            with span('dataset.price_dicts'):
+                day_dicts = {
+                    date: dict(zip(map(str, ts.tolist()), px.tolist()))
+                    for date, (ts, px) in self.price_arrays.items()
+                }
+
+            day_dicts_bytes = sum(dict_nbytes(day_dict) for day_dict in day_dicts.values())
+            if self.keep(day_dicts_bytes):
+                self.day_dicts_bytes = day_dicts_bytes
+                self.day_dicts = day_dicts
+
+        return day_dicts
+
+    def engine_price_data(self, engine_mode: str) -> dict:
+        """
+        Price data in the shape the chosen engine works on.
+        """
+        if engine_mode in ('indexed', 'sweep'):
+            return self.event_indexes()
+        elif engine_mode == 'numpy':
+            return self.price_arrays
+        else:
+            return self.price_dicts()
+
+
+def load_dataset(ticker: str = None, version: str = None) -> StagedDataset:
+    """
+    Download and decode the whole staged dataset for a ticker from Redis db 1
+    and 2. Price data in either the JSON or binary columnar format is detected
+    per day.
+    """
+    with span('dataset.scan_dates'):
+        date_list = staged_dates(redis_client(2), ticker, r_manifest=redis_client(MANIFEST_DB))
+    keys = [redis_key(date, ticker) for date in date_list]
+
+    with span('dataset.mget_opening_ranges'):
+        raw_opening_ranges = redis_client(1).mget(keys)
+
+    with span('dataset.decode_opening_ranges'):
+        opening_range_info = {}
+        for count, data in enumerate(raw_opening_ranges):
+            opening_range_info[date_list[count]] = ujson.loads(data)
+
+    with span('dataset.mget_price_data'):
+        raw_price_data = redis_client(2, decode_responses=False).mget(keys)
+
+    with span('dataset.decode_price_data'):
+        price_arrays = {}
+        for count, data in enumerate(raw_price_data):
+            price_arrays[date_list[count]] = columnar.decode_any(data)
+
+    return StagedDataset(ticker, version, date_list, opening_range_info, price_arrays)
+
+
+class MarketDataCache(object):
+    """
+    Least recently used cache of staged datasets, bounded by memory.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.datasets = OrderedDict()
+
+        #Serializes loads, so a task arriving during the pre-warm waits for it
+        #instead of downloading the data a second time.
+        self.load_lock = threading.Lock()
+
+        #Guards the datasets, also taken while a cached dataset grows.
+        self.lock = threading.Lock()
+
+    def cached_bytes(self) -> int:
+        return sum(dataset.nbytes for dataset in self.datasets.values())
+
+    def evict(self, incoming_bytes: int, keep_key: tuple = None) -> None:
+        """
+        Drop least recently used datasets until the incoming bytes fit, never
+        the dataset under keep_key.
+        """
+        while self.datasets and self.cached_bytes() + incoming_bytes > self.max_bytes:
+            if next(iter(self.datasets)) == keep_key:
+                break
+            (ticker, version), dataset = self.datasets.popitem(last=False)
+            _LOGGER.info('Evicted dataset {0} {1} from the market data cache, freed {2} bytes.'.format(ticker, version, dataset.nbytes))
+
+    def admit(self, dataset: StagedDataset) -> bool:
+        """
+        Cache a freshly loaded dataset, evicting others to fit it. Returns
+        False if it is larger than the whole cache.
+        """
+        with self.lock:
+            #A newer version supersedes everything loaded before it for the same ticker.
+            for key in [key for key in self.datasets if key[0] == dataset.ticker]:
+                del self.datasets[key]
+
+            if dataset.nbytes > self.max_bytes:
+                _LOGGER.warning('Dataset {0} {1} is {2} bytes, larger than the cache limit. Not caching.'.format(dataset.ticker, dataset.version, dataset.nbytes))
+                return False
+
+            self.evict(dataset.nbytes)
+            self.datasets[(dataset.ticker, dataset.version)] = dataset
+            dataset.cache = self
+
+            return True
+
+    def make_room(self, dataset: StagedDataset, extra_bytes: int) -> bool:
+        """
+        Make room for a cached dataset to grow by extra_bytes, evicting other
+        datasets least recently used first. Returns False, evicting nothing, if
+        the dataset would outgrow the cache on its own. A dataset that has
+        already left the cache is only held by running tasks, it can grow.
+        """
+        key = (dataset.ticker, dataset.version)
+
+        with self.lock:
+            if self.datasets.get(key) is not dataset:
+                return True
+
+            if dataset.nbytes + extra_bytes > self.max_bytes:
+                return False
+
+            self.datasets.move_to_end(key)
+            self.evict(extra_bytes, keep_key=key)
+
+            return True
+
+    def get(self, ticker: str = None) -> StagedDataset:
+        """
+        Get the currently staged dataset for a ticker, loading it if the version changed.
+        """
+        with span('dataset.version'):
+            version = get_dataset_version(ticker)
+
+        #Without a version there is no way to know when the data changes, so don't cache it.
+        if version is None:
+            _LOGGER.warning('No dataset version in the manifest, loading staged data without caching.')
+            return load_dataset(ticker)
+
+        with self.load_lock:
+            with self.lock:
+                if (ticker, version) in self.datasets:
+                    self.datasets.move_to_end((ticker, version))
+                    return self.datasets[(ticker, version)]
+
+            dataset = load_dataset(ticker, version)
+            self.admit(dataset)
+
+            return dataset
+
+
+_CACHE = MarketDataCache(int(environ.get('BACKTEST_CACHE_MAX_MB', DEFAULT_CACHE_MAX_MB)) * 1024 * 1024)
+
+
+def get_dataset(ticker: str = None) -> StagedDataset:
+    """
+    Get the staged dataset for a ticker through this worker process's cache.
+    Without a ticker, the original un-namespaced dataset is used.
+    """
+    return _CACHE.get(ticker)
+
+
+def prewarm(tickers: list) -> None:
+    """
+    Load the staged datasets into the cache. Failures are only logged, the first
+    task will retry the load.
+    """
+    for ticker in tickers:
+        try:
+            dataset = get_dataset(ticker)
+            _LOGGER.info('Pre-warmed market data cache for {0} with {1} dates.'.format(ticker, len(dataset.date_list)))
+        except Exception as e:
+            _LOGGER.exception('Unable to pre-warm market data cache for {0}. {1}'.format(ticker, e))
+
+
+@worker_process_init.connect
+def prewarm_on_process_init(**kwargs):
+    """
+    Pre-warm the cache in each new worker process. Runs in a background thread
+    because celery kills child processes that take too long to initialize.
+
+    BACKTEST_CACHE_PREWARM_TICKERS is a comma separated list of namespaced
+    tickers to load, by default only the un-namespaced dataset is.
+    """
+    if environ.get('BACKTEST_CACHE_PREWARM', '1') == '1':
+        tickers = [ticker.strip() or None for ticker in environ.get('BACKTEST_CACHE_PREWARM_TICKERS', '').split(',')]
+        threading.Thread(target=prewarm, args=(tickers,), daemon=True).start()
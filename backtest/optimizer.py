@@ -0,0 +1,235 @@
+__author__ = "Nathan Ward"
+
+"""
+Adaptive parameter search, an alternative to seeding the exhaustive grid.
+
+Runs successive halving on top of the regular send_task/Celery path. Each
+rung backtests the surviving parameter sets on a random subset of dates and
+keeps the best 1/eta of them, and every rung uses eta times more dates than
+the one before. The last rung runs on every staged date, so its results are
+real backtests and are written to SQL like reaped results. Compute goes to
+promising regions of the grid, and the report shows how many full backtests
+were saved compared to the grid.
+"""
+
+import logging
+from os import environ
+from math import ceil
+from random import Random
+from time import time, sleep
+from uuid import uuid4
+import redis
+import ujson
+from mysql.connector import Error
+from backtest.engine import expand_parameter_grid, get_available_dates
+from backtest.reaper import ResultSink, result_row, sql_credentials, sql_connection, discard_sql_connections
+from backtest.startup import default_parameter_grid
+from backtest.task_helper import send_task
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+
+class OptimizerError(Exception):
+    """Exception class if the parameter search cannot complete."""
+    pass
+
+
+class SuccessiveHalvingSearch(object):
+    def __init__(
+        self,
+        parameter_grid: dict = None,
+        sample_size: int = 0,
+        eta: int = 3,
+        min_dates: int = 10,
+        batch_size: int = 100,
+        engine_mode: str = 'sweep',
+        metric: str = 'backtest_profit',
+        seed: int = None,
+        ticker: str = None
+    ):
+        """
+        sample_size limits the first rung to a random sample of the grid, 0 starts
+        from every parameter set. Higher values of metric are better. ticker
+        searches a dataset staged with namespaced keys.
+        """
+        self.parameter_grid = parameter_grid or default_parameter_grid()
+        self.sample_size = sample_size
+        self.eta = eta
+        self.min_dates = min_dates
+        self.batch_size = batch_size
+        self.engine_mode = engine_mode
+        self.metric = metric
+        self.random = Random(seed)
+        self.ticker = ticker
+
+        #Seconds between checks for finished tasks, and how long to wait for a rung.
+        self.poll_interval = 2
+        self.rung_timeout = 3600
+
+        self.redis_client = redis.Redis(host=environ['REDIS_ENDPOINT'], port=6379, db=0, decode_responses=True)
+
+    def rung_date_counts(self, total_dates: int) -> list:
+        """
+        Dates used by each rung, growing by eta until the last rung uses them all.
+        """
+        counts = []
+        count = min(self.min_dates, total_dates)
+
+        while count < total_dates:
+            counts.append(count)
+            count *= self.eta
+
+        counts.append(total_dates)
+
+        return counts
+
+    def store_results(self, results: dict) -> None:
+        """
+        Insert each task's results into SQL the way the reaper would.
+        """
+        sql_user, sql_pw, sql_endpoint, sql_dbname, sql_tablename = sql_credentials()
+
+        try:
+            sink = ResultSink(sql_connection(sql_user, sql_pw, sql_endpoint, sql_dbname), sql_tablename)
+            for key_task_id, task_results in results.items():
+                sink.add_task(key_task_id, [result_row(result_data) for result_data in task_results])
+            sink.flush()
+        except Error as e:
+            discard_sql_connections()
+            raise OptimizerError('Unable to store the final rung results. {0}'.format(e))
+
+    def evaluate(self, parameter_sets: list, dates: list, store: bool = False) -> list:
+        """
+        Send the parameter sets as backtest_batch tasks and wait for the results.
+        Results are held back from the reaper and deleted once read, or once
+        the rung fails. store inserts them into SQL before they are deleted.
+        """
+        task_ids = []
+
+        with self.redis_client.pipeline() as pipe:
+            for ndx in range(0, len(parameter_sets), self.batch_size):
+                task_id = str(uuid4())
+                task_ids.append(task_id)
+                pipe.lpush(
+                    'worker_main',
+                    send_task(
+                        queue = 'worker_main',
+                        task_name = 'backtest.engine.backtest_batch',
+                        task_kwargs = {
+                            'parameter_sets': parameter_sets[ndx:ndx + self.batch_size],
+                            'engine_mode': self.engine_mode,
+                            'dates': dates,
+                            'reap': False,
+                            'ticker': self.ticker
+                        },
+                        task_id = task_id
+                    )
+                )
+            pipe.execute()
+
+        results = {}
+        pending = ['celery-task-meta-{0}'.format(task_id) for task_id in task_ids]
+        deadline = time() + self.rung_timeout
+
+        try:
+            while pending:
+                if time() > deadline:
+                    raise OptimizerError('Timed out waiting for {0} optimizer tasks.'.format(len(pending)))
+
+                still_pending = []
+                for key, data in zip(pending, self.redis_client.mget(pending)):
+                    if data is None:
+                        still_pending.append(key)
+                        continue
+
+                    meta = ujson.loads(data)
+                    if meta['status'] == 'SUCCESS':
+                        results[key] = meta['result']
+                    elif meta['status'] in ('FAILURE', 'REVOKED'):
+                        raise OptimizerError('Optimizer task {0} failed. {1}'.format(meta['task_id'], meta['result']))
+                    else:
+                        still_pending.append(key)
+
+                pending = still_pending
+                if pending:
+                    sleep(self.poll_interval)
+
+            if store:
+                self.store_results(results)
+        finally:
+            #The reaper never picks these up, so clear them out even when the rung fails.
+            #Tasks still running store theirs later, celery expires those.
+            if results or pending:
+                self.redis_client.delete(*results.keys(), *pending)
+
+        ordered_results = []
+        for task_id in task_ids:
+            ordered_results.extend(results['celery-task-meta-{0}'.format(task_id)])
+
+        return ordered_results
+
+    def run(self) -> dict:
+        """
+        Run the search. Returns the final rung's results, best first, and a report
+        of how many backtests it took compared to the full grid.
+        """
+        all_dates = sorted(get_available_dates(self.ticker))
+        if not all_dates:
+            raise OptimizerError('No staged dates available to backtest.')
+
+        grid = expand_parameter_grid(self.parameter_grid)
+        if self.sample_size and self.sample_size < len(grid):
+            candidates = self.random.sample(grid, self.sample_size)
+        else:
+            candidates = grid
+
+        rung_date_counts = self.rung_date_counts(len(all_dates))
+        backtests_run = 0
+        day_backtests_run = 0
+
+        for rung, date_count in enumerate(rung_date_counts):
+            last_rung = rung == len(rung_date_counts) - 1
+            dates = all_dates if last_rung else sorted(self.random.sample(all_dates, date_count))
+
+            print('Rung {0}: {1} parameter sets on {2} dates.'.format(rung, len(candidates), len(dates)))
+            results = self.evaluate(candidates, None if last_rung else dates, store = last_rung)
+            backtests_run += len(candidates)
+            day_backtests_run += len(candidates) * len(dates)
+
+            results.sort(key=lambda result: result[self.metric], reverse=True)
+
+            if last_rung:
+                break
+
+            keep = max(1, ceil(len(results) / self.eta))
+            candidates = [
+                {
+                    'stop_distance': result['stop_distance'],
+                    'stop_count_limit': result['stop_count_limit'],
+                    'stop_cooloff_period': result['stop_cooloff_period'],
+                    'limit_distance': result['limit_distance'],
+                } for result in results[:keep]
+            ]
+
+        #One full backtest covers every date, compare in those units.
+        full_backtest_equivalents = day_backtests_run / len(all_dates)
+        report = {
+            'grid_size': len(grid),
+            'backtests_run': backtests_run,
+            'full_backtest_equivalents': round(full_backtest_equivalents, 1),
+            'backtests_saved': round(len(grid) - full_backtest_equivalents, 1),
+            'percent_saved': round((1 - full_backtest_equivalents / len(grid)) * 100, 1),
+            'rungs': len(rung_date_counts)
+        }
+
+        print('Ran the equivalent of {0} full backtests instead of {1}, saving {2}%.'.format(
+            report['full_backtest_equivalents'],
+            report['grid_size'],
+            report['percent_saved']
+        ))
+
+        return {
+            'results': results,
+            'report': report
+        }
@@ -0,0 +1,169 @@
+__author__ = "Nathan Ward"
+
+"""
+Declarative parameter spaces for sweeps, expanded lazily.
+
+A space is a dict of dimensions plus optional constraints. Each dimension is
+a list of values, or a range given as {'start': 0.1, 'stop': 2, 'step': 0.1}
+which expands the same way frange does. Iterating a space walks the grid
+like expand_parameter_grid, first dimension outermost, one parameter set
+dict at a time, so even a space of millions of points is never held in
+memory. Constraints are callables taking a parameter set and returning
+False to skip it.
+
+sample() and latin_hypercube() draw a subset instead. They return seeded
+samples, so iterating them again, e.g. once per ticker, gives the same points.
+"""
+
+import random
+from itertools import islice, product
+from typing import Iterable, Iterator
+from frange import frange
+
+
+class ParameterSpaceError(Exception):
+    """Exception class if a parameter space is specified wrong."""
+    pass
+
+
+def dimension_values(spec) -> list:
+    """
+    Expand one dimension's spec into its list of values.
+    """
+    if isinstance(spec, dict):
+        try:
+            values = list(frange(spec['start'], spec['stop'], spec.get('step', 1)))
+        except KeyError:
+            raise ParameterSpaceError('Ranges need a start and a stop, got {0}.'.format(spec))
+    else:
+        values = list(spec)
+
+    if not values:
+        raise ParameterSpaceError('Dimension {0} has no values.'.format(spec))
+
+    return values
+
+
+def chunked(parameter_sets: Iterable[dict], size: int) -> Iterator[list]:
+    """
+    Group parameter sets into lists of up to size, e.g. one per backtest_batch task.
+    """
+    parameter_sets = iter(parameter_sets)
+    while True:
+        chunk = list(islice(parameter_sets, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ParameterSpace(object):
+    def __init__(self, dimensions: dict, constraints: list = None):
+        self.names = list(dimensions)
+        self.values = [dimension_values(spec) for spec in dimensions.values()]
+        self.constraints = list(constraints or [])
+
+    def size(self) -> int:
+        """
+        Points in the grid, before constraints.
+        """
+        size = 1
+        for values in self.values:
+            size *= len(values)
+
+        return size
+
+    def accepts(self, parameter_set: dict) -> bool:
+        return all(constraint(parameter_set) for constraint in self.constraints)
+
+    def point(self, index: int) -> dict:
+        """
+        The index'th point of the grid, in iteration order.
+        """
+        point_values = []
+        for values in reversed(self.values):
+            index, value_index = divmod(index, len(values))
+            point_values.append(values[value_index])
+
+        return dict(zip(self.names, reversed(point_values)))
+
+    def __iter__(self) -> Iterator[dict]:
+        for point_values in product(*self.values):
+            parameter_set = dict(zip(self.names, point_values))
+            if self.accepts(parameter_set):
+                yield parameter_set
+
+    def chunks(self, size: int) -> Iterator[list]:
+        return chunked(self, size)
+
+    def sample(self, n: int, seed: int = None) -> 'ParameterSample':
+        """
+        n distinct grid points picked uniformly at random, fewer if the
+        constraints leave fewer.
+        """
+        return ParameterSample(self, n, 'random', seed)
+
+    def latin_hypercube(self, n: int, seed: int = None) -> 'ParameterSample':
+        """
+        n points by Latin hypercube sampling, every dimension's values are
+        split into n strata and each stratum is used once. Dimensions with
+        fewer than n values repeat values, and points failing a constraint
+        are dropped.
+        """
+        return ParameterSample(self, n, 'lhs', seed)
+
+
+class ParameterSample(object):
+    """
+    Seeded sample of a ParameterSpace, the same points every time it is iterated.
+    """
+    def __init__(self, space: ParameterSpace, n: int, method: str, seed: int = None):
+        if method not in ('random', 'lhs'):
+            raise ParameterSpaceError('Unknown sampling method {0}.'.format(method))
+
+        self.space = space
+        self.n = n
+        self.method = method
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+
+    def __iter__(self) -> Iterator[dict]:
+        rng = random.Random(self.seed)
+
+        if self.method == 'lhs':
+            return self._latin_hypercube(rng)
+
+        return self._random(rng)
+
+    def chunks(self, size: int) -> Iterator[list]:
+        return chunked(self, size)
+
+    def _random(self, rng: random.Random) -> Iterator[dict]:
+        size = self.space.size()
+
+        #Asking for most of the grid, walking it is cheaper than rejection sampling.
+        if self.n >= size:
+            yield from self.space
+            return
+
+        seen = set()
+        count = 0
+        while count < self.n and len(seen) < size:
+            index = rng.randrange(size)
+            if index in seen:
+                continue
+            seen.add(index)
+
+            parameter_set = self.space.point(index)
+            if self.space.accepts(parameter_set):
+                count += 1
+                yield parameter_set
+
+    def _latin_hypercube(self, rng: random.Random) -> Iterator[dict]:
+        strata = [rng.sample(range(self.n), self.n) for values in self.space.values]
+
+        for count in range(self.n):
+            parameter_set = {
+                name: values[int((dimension_strata[count] + rng.random()) * len(values) / self.n)]
+                for name, values, dimension_strata in zip(self.space.names, self.space.values, strata)
+            }
+            if self.space.accepts(parameter_set):
+                yield parameter_set
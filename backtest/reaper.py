@@ -9,18 +9,47 @@ Reaper to lifecycle result data out of Redis and into SQL.
 
 import logging
 from os import environ
-from io import StringIO
 from time import time
 import mysql.connector
 from mysql.connector import Error
-import redis
 import ujson
 from celery_worker import app
+from backtest.instrumentation import span, open_result_span, worker_id
+from backtest.market_cache import redis_client
+from backtest import result_stream
+from backtest.engine import COMPLETED_BACKTESTS_KEY
 
 _LOGGER = logging.getLogger()
 _LOGGER.setLevel(logging.INFO)
 
 
+#Columns written for each result, in INSERT order.
+RESULT_COLUMNS = (
+    'backtest_profit',
+    'average_holding_period',
+    'win_rate_percent',
+    'stop_distance',
+    'stop_count_limit',
+    'stop_cooloff_period',
+    'limit_distance',
+    'backtest_id',
+    'ticker',
+    'trade_stats'
+)
+
+BACKTEST_ID_COLUMN = RESULT_COLUMNS.index('backtest_id')
+
+#Inserts are sent in batches of about this many bytes, well under max_allowed_packet.
+DEFAULT_INSERT_BATCH_BYTES = 4 * 1024 * 1024
+DEFAULT_INSERT_BATCH_ROWS = 5000
+
+#Rough size of a row's columns besides trade_stats, for sizing batches.
+ROW_OVERHEAD_BYTES = 128
+
+#The reaper's MySQL connection is reused for the life of the worker process.
+_SQL_CONNECTIONS = {}
+
+
 class SQLError(Exception):
     """Exception class if there is a problem talking to the SQL DB."""
     pass
@@ -33,131 +62,394 @@ def batch(iterable, n=1):
         yield iterable[ndx:min(ndx + n, l)]
 
 
-@app.task(bind=True)
-def lifecycle_result_data(self) -> None:
+def collect_task_results(matching_keys: list, task_meta_values: list) -> list:
     """
-    Regularly scan Redis for task worker result data, and
-    lifecycle that data to MySQL.
+    Pick the backtest results out of raw celery-task-meta values, keeping each
+    finished task's results with its key as [(key, [result, ...]), ...], so
+    the key can be deleted as soon as the task's rows are committed.
     """
-    start_time = time()
+    finished_tasks = []
 
-    try:
-        sql_user = environ['DB_USERNAME']
-        sql_pw = environ['DB_PASSWORD']
-        sql_endpoint = environ['DB_ENDPOINT']
-        sql_dbname = environ['DB_NAME']
-        sql_tablename = environ['DB_TABLE']
-    except KeyError:
-        _LOGGER.exception('Error: Missing database credentials.')
-        raise SQLError('Error: Missing database credentials.')
+    for key_task_id, value in zip(matching_keys, task_meta_values):
+        #Gone between the SCAN and the MGET.
+        if value is None:
+            continue
+
+        data = ujson.loads(value)
+        if data['status'] != 'SUCCESS':
+            continue
+
+        #Batch tasks return a list of results, one per parameter set.
+        if isinstance(data['result'], list):
+            #Results held for the sender to read, like optimizer screening runs, are left alone.
+            if any(item.get('reap') is False for item in data['result']):
+                continue
+            task_results = [result_item for result_item in data['result'] if 'backtest_profit' in result_item]
+        elif data['result'] is not None and 'backtest_profit' in data['result']:
+            task_results = [data['result']]
+        else:
+            task_results = []
+
+        finished_tasks.append((key_task_id, task_results))
+
+    return finished_tasks
 
-    r = redis.Redis(
-        host = environ['REDIS_ENDPOINT'],
-        port = 6379,
-        db = 0,
-        decode_responses=True
+
+def result_row(result_data: dict) -> tuple:
+    """
+    Convert a backtest result to a row of parameters for insert_query, in
+    RESULT_COLUMNS order. The driver does the quoting.
+    """
+    return (
+        result_data['backtest_profit'],
+        result_data['average_holding_period'],
+        result_data['win_rate_percent'],
+        result_data['stop_distance'],
+        result_data['stop_count_limit'],
+        result_data['stop_cooloff_period'],
+        result_data['limit_distance'],
+        result_data['backtest_id'],
+        result_data.get('ticker', ''),
+        ujson.dumps(result_data['trade_stats'])
     )
 
-    #Iterate through available keys, load them into memory.
-    matching_keys = []
-    celery_task_ids_to_delete = []
-    results = {}
 
-    #Limit batch size for DB performance and to prevent task from timing out.
-    redis_download_batch_size = 20000
-    db_upload_batch_size = 1000
-    count = 0
+def insert_query(sql_tablename: str) -> str:
+    """
+    Parameterized INSERT IGNORE for executemany, which the driver sends as
+    multi-row inserts.
+    """
+    return 'INSERT IGNORE INTO {0} ({1}) VALUES ({2})'.format(
+        sql_tablename,
+        ','.join(RESULT_COLUMNS),
+        ','.join(['%s'] * len(RESULT_COLUMNS))
+    )
 
-    #Only dig up completed task ids, using non-blocking search.
-    for key_task_id in r.scan_iter('celery-task-meta-*'):
-        if count < redis_download_batch_size:
-            matching_keys.append(key_task_id)
-            count += 1
-        else:
-            break
-
-    #Bulk get keys and filter.
-    for key_task_id in r.mget(matching_keys):
-        data = ujson.loads(key_task_id)
-        if data['status'] == 'SUCCESS':
-            celery_task_ids_to_delete.append(''.join(['celery-task-meta-', data['task_id']]))
-            if data['result'] is not None:
-                if 'backtest_profit' in data['result']:
-                    results[data['task_id']] = data['result']
-
-    sql_converted_data = []
-
-    #Convert data in preperation for upload.
-    for result_key, result_data in results.items():
-        #Convert the data types to SQl data types defined in the schema.
-        #Makes it easier to do searching and sorting in SQL.
-        #VARCHAR, DATETIME, DATE needs to be in double quotes.
-        #JSON data type needs to be in single quotes.
-        sql_converted_data.append(
-            {
-                'backtest_profit': result_data['backtest_profit'],
-                'average_holding_period': result_data['average_holding_period'],
-                'win_rate_percent': result_data['win_rate_percent'],
-                'stop_distance': result_data['stop_distance'],
-                'stop_count_limit': result_data['stop_count_limit'],
-                'stop_cooloff_period': result_data['stop_cooloff_period'],
-                'limit_distance': result_data['limit_distance'],
-                'backtest_id': '"{0}"'.format(result_data['backtest_id']),
-                'trade_stats': "'{0}'".format(ujson.dumps(result_data['trade_stats']))
-            }
-        )
 
+def sql_credentials() -> tuple:
+    """
+    (user, password, endpoint, db name, table) from env.
+    """
     try:
+        return (
+            environ['DB_USERNAME'],
+            environ['DB_PASSWORD'],
+            environ['DB_ENDPOINT'],
+            environ['DB_NAME'],
+            environ['DB_TABLE']
+        )
+    except KeyError:
+        _LOGGER.exception('Error: Missing database credentials.')
+        raise SQLError('Error: Missing database credentials.')
+
+
+def sql_connection(sql_user: str, sql_pw: str, sql_endpoint: str, sql_dbname: str):
+    """
+    Get the process-wide MySQL connection, connecting on first use or when the
+    previous one dropped.
+    """
+    key = (sql_user, sql_endpoint, sql_dbname)
+    cnx = _SQL_CONNECTIONS.get(key)
+
+    if cnx is None or not cnx.is_connected():
         cnx = mysql.connector.connect(
             user = sql_user,
             password = sql_pw,
             host = sql_endpoint,
             database = sql_dbname
         )
-        
-        for batch_rows in batch(sql_converted_data, db_upload_batch_size):
-            statement = StringIO()
-            #Ignore errors, just write.
-            statement.write('INSERT IGNORE INTO {0} ('.format(sql_tablename))
-            statement.write(','.join([k for k in sql_converted_data[0].keys()]))
-            statement.write(') VALUES ')
-            
-            for index, row in enumerate(batch_rows):
-                statement.write('(')
-                #For manually prepared statements, need to convert the object to string for stringio.
-                statement.write(','.join([str(v) for v in row.values()]))
-                
-                #Trailing commas cause a syntax error in SQL.
-                if index != len(batch_rows) - 1:
-                    statement.write('), ')
-                else:
-                    statement.write(');')
-            
-            if cnx.is_connected():
-                cursor = cnx.cursor()
-                cursor.execute(statement.getvalue())
-                cnx.commit()
-    except Error as e:
-        _LOGGER.exception('Problem inserting results data from Redis into SQL. {0}'.format(e))
-    finally:
-        if cnx.is_connected():
+        _SQL_CONNECTIONS[key] = cnx
+
+    return cnx
+
+
+def discard_sql_connections() -> None:
+    """
+    Forget the cached connections after an error, the next run reconnects.
+    """
+    for cnx in _SQL_CONNECTIONS.values():
+        try:
             cnx.close()
+        except Error:
+            pass
+    _SQL_CONNECTIONS.clear()
+
+
+def forget_completed(r, committed_keys: list, backtest_ids_by_key: dict) -> None:
+    """
+    Drop committed backtests from the completed set, SQL has them now.
+    """
+    backtest_ids = []
+    for key in committed_keys:
+        backtest_ids.extend(backtest_ids_by_key.pop(key, []))
+
+    if backtest_ids:
+        r.srem(COMPLETED_BACKTESTS_KEY, *backtest_ids)
+
+
+def completed_backtest_ids(r, backtest_ids: list, cnx = None, sql_tablename: str = None) -> set:
+    """
+    Which of backtest_ids are done, either waiting in Redis to be reaped or
+    already in SQL. SQL is only checked when given a connection.
+    """
+    if not backtest_ids:
+        return set()
+
+    completed = {
+        backtest_id for backtest_id, is_member
+        in zip(backtest_ids, r.smismember(COMPLETED_BACKTESTS_KEY, backtest_ids))
+        if is_member
+    }
+
+    remaining = [backtest_id for backtest_id in backtest_ids if backtest_id not in completed]
+    if cnx is not None and remaining:
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(
+                'SELECT backtest_id FROM {0} WHERE backtest_id IN ({1})'.format(sql_tablename, ','.join(['%s'] * len(remaining))),
+                remaining
+            )
+            completed.update(row[0] for row in cursor.fetchall())
+        finally:
+            cursor.close()
+
+    return completed
+
+
+class ResultSink(object):
+    """
+    Bulk writer of result rows into SQL over one connection.
+
+    Rows are added a whole task at a time and sent with a parameterized
+    executemany once about batch_bytes or batch_rows are pending. Every flush
+    is its own transaction, and hands back the keys of the tasks whose rows it
+    committed, so only those are deleted from Redis.
+    """
+    def __init__(
+        self,
+        cnx,
+        sql_tablename: str,
+        batch_bytes: int = DEFAULT_INSERT_BATCH_BYTES,
+        batch_rows: int = DEFAULT_INSERT_BATCH_ROWS
+    ):
+        self.cnx = cnx
+        self.query = insert_query(sql_tablename)
+        self.batch_bytes = batch_bytes
+        self.batch_rows = batch_rows
 
-    #Clear out any successfully completed tasks from Redis.
-    if celery_task_ids_to_delete:
-        r.delete(*celery_task_ids_to_delete)
+        self.rows = []
+        self.pending_keys = []
+        self.pending_bytes = 0
+        self.rows_committed = 0
+
+    def add_task(self, key_task_id: str, rows: list) -> list:
+        """
+        Queue a task's rows. Returns the keys committed if this filled a batch.
+        """
+        self.rows.extend(rows)
+        self.pending_keys.append(key_task_id)
+        self.pending_bytes += sum(len(row[-1]) for row in rows) + ROW_OVERHEAD_BYTES * len(rows)
+
+        if self.pending_bytes >= self.batch_bytes or len(self.rows) >= self.batch_rows:
+            return self.flush()
+
+        return []
+
+    def flush(self) -> list:
+        """
+        Insert and commit the pending rows. Returns the committed task keys.
+        Raises the driver's Error after rolling back, leaving the rows pending.
+        """
+        if self.rows:
+            cursor = self.cnx.cursor()
+            try:
+                cursor.executemany(self.query, self.rows)
+                self.cnx.commit()
+            except Error:
+                try:
+                    self.cnx.rollback()
+                except Error:
+                    pass
+                raise
+            finally:
+                cursor.close()
+
+        committed_keys = self.pending_keys
+        self.rows_committed += len(self.rows)
+
+        self.rows = []
+        self.pending_keys = []
+        self.pending_bytes = 0
+
+        return committed_keys
+
+
+@app.task(bind=True)
+def lifecycle_result_data(self) -> None:
+    """
+    Regularly scan Redis for task worker result data, and
+    lifecycle that data to MySQL.
+    """
+    start_time = time()
+
+    sql_user, sql_pw, sql_endpoint, sql_dbname, sql_tablename = sql_credentials()
+
+    r = redis_client(0)
+
+    #Limit the keys handled per run to prevent the task from timing out.
+    redis_download_batch_size = 20000
+    redis_mget_batch_size = 1000
+    matching_keys = []
+
+    #Only dig up completed task ids, using non-blocking search.
+    with span('reaper.scan'):
+        for key_task_id in r.scan_iter('celery-task-meta-*', count=redis_mget_batch_size):
+            matching_keys.append(key_task_id)
+            if len(matching_keys) >= redis_download_batch_size:
+                break
+
+    #Backtest ids per pending task, dropped from the completed set once in SQL.
+    backtest_ids_by_key = {}
+
+    def delete_committed(committed_keys: list) -> None:
+        #Only tasks whose rows are committed are cleared out of Redis.
+        if committed_keys:
+            with span('reaper.delete'):
+                r.delete(*committed_keys)
+                forget_completed(r, committed_keys, backtest_ids_by_key)
+
+    sink = None
+    try:
+        sink = ResultSink(sql_connection(sql_user, sql_pw, sql_endpoint, sql_dbname), sql_tablename)
+
+        #Stream the results through a batch of keys at a time, rather than holding them all.
+        for key_batch in batch(matching_keys, redis_mget_batch_size):
+            with span('reaper.mget'):
+                task_meta_values = r.mget(key_batch)
+
+            with span('reaper.collect'):
+                finished_tasks = collect_task_results(key_batch, task_meta_values)
+
+            with span('reaper.convert'):
+                task_rows = [
+                    (key_task_id, [result_row(result_data) for result_data in task_results])
+                    for key_task_id, task_results in finished_tasks
+                ]
+
+            for key_task_id, rows in task_rows:
+                backtest_ids_by_key[key_task_id] = [row[BACKTEST_ID_COLUMN] for row in rows]
+                with span('reaper.insert'):
+                    committed_keys = sink.add_task(key_task_id, rows)
+                delete_committed(committed_keys)
+
+        with span('reaper.insert'):
+            committed_keys = sink.flush()
+        delete_committed(committed_keys)
+    except Error as e:
+        _LOGGER.exception('Problem inserting results data from Redis into SQL. {0}'.format(e))
+        discard_sql_connections()
 
     tasks_processed_count = r.dbsize()
     tasks_remaining_count = r.llen('worker_main')
     end_time = time()
     execution_time = round((end_time - start_time), 3)
 
+    open_result_span('reaper.store_result')
+
     return {
         'status': 'SUCCESS',
         'message': 'Reaper successfully lifecycled {count_moved} rows to MySQL. {count_rem} completed tasks still need to be lifecycled. {count_queued} tasks are queued but have not been executed yet.'.format(
-            count_moved = len(results),
+            count_moved = sink.rows_committed if sink is not None else 0,
             count_rem = tasks_processed_count,
             count_queued = tasks_remaining_count
         ),
         'duration': execution_time
-    }
\ No newline at end of file
+    }
+
+@app.task(bind=True)
+def lifecycle_stream_results(self) -> dict:
+    """
+    Drain the result stream (backtest.result_stream) into MySQL through the
+    reapers' consumer group. Any number of these can run side by side, each
+    entry is acknowledged only once its rows are committed.
+    """
+    start_time = time()
+
+    sql_user, sql_pw, sql_endpoint, sql_dbname, sql_tablename = sql_credentials()
+
+    r = redis_client(0)
+    result_stream.ensure_group(r)
+    consumer = worker_id()
+
+    #Limit the entries handled per run to prevent the task from timing out.
+    stream_download_batch_size = 20000
+    stream_read_batch_size = 1000
+    entries_read = 0
+
+    backtest_ids_by_key = {}
+
+    def acknowledge_committed(committed_ids: list) -> None:
+        if committed_ids:
+            with span('reaper.delete'):
+                result_stream.acknowledge(r, committed_ids)
+                forget_completed(r, committed_ids, backtest_ids_by_key)
+
+    sink = None
+    try:
+        sink = ResultSink(sql_connection(sql_user, sql_pw, sql_endpoint, sql_dbname), sql_tablename)
+
+        with span('reaper.read_stream'):
+            entries, deleted_ids = result_stream.claim_abandoned(r, consumer, stream_read_batch_size)
+
+        #Nothing left to store for these, acknowledge them so they stop being claimed.
+        if deleted_ids:
+            with span('reaper.delete'):
+                result_stream.acknowledge(r, deleted_ids)
+
+        if not entries:
+            with span('reaper.read_stream'):
+                entries = result_stream.read_new(r, consumer, stream_read_batch_size)
+
+        while entries:
+            entries_read += len(entries)
+
+            with span('reaper.convert'):
+                entry_rows = [
+                    (entry_id, [result_row(result_data) for result_data in results if 'backtest_profit' in result_data])
+                    for entry_id, results in entries
+                ]
+
+            for entry_id, rows in entry_rows:
+                backtest_ids_by_key[entry_id] = [row[BACKTEST_ID_COLUMN] for row in rows]
+                with span('reaper.insert'):
+                    committed_ids = sink.add_task(entry_id, rows)
+                acknowledge_committed(committed_ids)
+
+            if entries_read >= stream_download_batch_size:
+                break
+
+            with span('reaper.read_stream'):
+                entries = result_stream.read_new(r, consumer, stream_read_batch_size)
+
+        with span('reaper.insert'):
+            committed_ids = sink.flush()
+        acknowledge_committed(committed_ids)
+    except Error as e:
+        _LOGGER.exception('Problem inserting stream results into SQL. {0}'.format(e))
+        discard_sql_connections()
+
+    stream_remaining_count = r.xlen(result_stream.RESULT_STREAM)
+    tasks_remaining_count = r.llen('worker_main')
+    execution_time = round((time() - start_time), 3)
+
+    open_result_span('reaper.store_result')
+
+    return {
+        'status': 'SUCCESS',
+        'message': 'Reaper successfully lifecycled {count_moved} rows from the result stream to MySQL. {count_rem} stream entries still need to be lifecycled. {count_queued} tasks are queued but have not been executed yet.'.format(
+            count_moved = sink.rows_committed if sink is not None else 0,
+            count_rem = stream_remaining_count,
+            count_queued = tasks_remaining_count
+        ),
+        'duration': execution_time
+    }
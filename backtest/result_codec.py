@@ -0,0 +1,160 @@
+__author__ = "Nathan Ward"
+
+"""
+Encodings for the trade_stats part of a backtest result.
+
+'full' is the original nested per-day dict with a string key per trade.
+'compact' packs every trade into one binary columnar log, zlib compressed
+and base64 encoded so it still travels through the ujson Celery serializer
+and fits in the MySQL JSON column. The per-day aggregates stay as plain
+lists. 'summary' drops the trades and keeps only the net P&L per day, for
+sweeps where only the aggregate stats matter.
+"""
+
+import logging
+import zlib
+import numpy as np
+from pybase64 import b64encode, b64decode
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+RESULT_FORMATS = ('full', 'compact', 'summary')
+
+#One row per trade. Trades opened on the last tick of the day are never closed.
+TRADE_DTYPE = np.dtype([
+    ('day', '<u4'),
+    ('number', '<u2'),
+    ('long', 'u1'),
+    ('closed', 'u1'),
+    ('to', '<i8'),
+    ('tc', '<i8'),
+    ('top', '<f8'),
+    ('tcp', '<f8'),
+    ('p', '<f8')
+])
+
+DAY_STATS = ('st', 'tt', 'ahp', 'snp')
+
+
+class ResultFormatError(Exception):
+    """Exception class if a result cannot be encoded or decoded."""
+    pass
+
+
+def encode_compact(backtest_stats: dict) -> dict:
+    """
+    Pack per-day trade_stats into a columnar trade log.
+    """
+    dates = list(backtest_stats.keys())
+    rows = []
+
+    for day, date in enumerate(dates):
+        for key, trade in backtest_stats[date].items():
+            if str(key) in DAY_STATS:
+                continue
+
+            closed = 'tc' in trade
+            rows.append((
+                day,
+                int(key),
+                trade['d'] == 'long',
+                closed,
+                trade['to'],
+                trade['tc'] if closed else 0,
+                trade['top'],
+                trade['tcp'] if closed else 0.0,
+                trade['p'] if closed else 0.0
+            ))
+
+    trade_log = np.array(rows, dtype=TRADE_DTYPE)
+
+    return {
+        'format': 'compact',
+        'dates': dates,
+        'days': {stat: [backtest_stats[date][stat] for date in dates] for stat in DAY_STATS},
+        'trades': b64encode(zlib.compress(trade_log.tobytes())).decode('utf-8')
+    }
+
+
+def decode_compact(encoded: dict) -> dict:
+    """
+    Unpack a compact trade log into the same structure the full format has after
+    a trip through JSON, i.e. trade numbers as string keys.
+    """
+    dates = encoded['dates']
+    trade_log = np.frombuffer(zlib.decompress(b64decode(encoded['trades'])), dtype=TRADE_DTYPE)
+
+    backtest_stats = {date: {} for date in dates}
+
+    for row in trade_log.tolist():
+        day, number, is_long, closed, opened, closed_at, open_price, close_price, profit = row
+        trade = {
+            'top': open_price,
+            'to': opened,
+            'd': 'long' if is_long else 'short'
+        }
+        if closed:
+            trade.update({
+                'tcp': close_price,
+                'p': profit,
+                'hp': closed_at - opened,
+                'tc': closed_at
+            })
+        backtest_stats[dates[day]][str(number)] = trade
+
+    for stat in DAY_STATS:
+        for date, value in zip(dates, encoded['days'][stat]):
+            backtest_stats[date][stat] = value
+
+    return backtest_stats
+
+
+def encode_summary(backtest_stats: dict) -> dict:
+    """
+    Keep only the net P&L per day.
+    """
+    return {
+        'format': 'summary',
+        'daily_pnl': {date: day_stats['snp'] for date, day_stats in backtest_stats.items()}
+    }
+
+
+def encode_result(result: dict, result_format: str = 'full') -> dict:
+    """
+    Re-encode the trade_stats of a backtest result in place, aggregate stats are untouched.
+    """
+    if result_format not in RESULT_FORMATS:
+        raise ResultFormatError('Unknown result format {0}, expected one of {1}.'.format(result_format, RESULT_FORMATS))
+
+    if result_format == 'compact':
+        result['trade_stats'] = encode_compact(result['trade_stats'])
+    elif result_format == 'summary':
+        result['trade_stats'] = encode_summary(result['trade_stats'])
+
+    return result
+
+
+def result_format_of(trade_stats: dict) -> str:
+    """
+    Detect which format stored trade_stats are in.
+    """
+    if isinstance(trade_stats.get('format'), str):
+        return trade_stats['format']
+
+    return 'full'
+
+
+def decode_trade_stats(trade_stats: dict) -> dict:
+    """
+    Get per-day trade_stats back in the full structure. Summary results have no
+    trades, so each day only carries its net profit as 'snp'.
+    """
+    result_format = result_format_of(trade_stats)
+
+    if result_format == 'compact':
+        return decode_compact(trade_stats)
+    elif result_format == 'summary':
+        return {date: {'snp': snp} for date, snp in trade_stats['daily_pnl'].items()}
+
+    return trade_stats
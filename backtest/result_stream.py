@@ -0,0 +1,98 @@
+__author__ = "Nathan Ward"
+
+"""
+Redis Stream result channel, an alternative to the celery result backend.
+
+Tasks sent with result_channel='stream' add their results to one stream in
+db 0 instead of returning them, and are sent with the ignore_result header so
+celery stores no task meta. Reapers drain the stream through a consumer group,
+so any number of them can run side by side without SCANning the keyspace.
+Entries are acknowledged only once their rows are committed to SQL, and
+entries a crashed reaper left pending are claimed by the next one after
+RESULT_CLAIM_IDLE_MS, so every result is delivered at least once.
+"""
+
+import logging
+import redis
+import ujson
+from backtest.market_cache import redis_client
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+RESULT_STREAM = 'backtest_results'
+RESULT_GROUP = 'reapers'
+
+#Pending entries idle this long belong to a reaper that died, and are claimed.
+RESULT_CLAIM_IDLE_MS = 300000
+
+
+def publish_results(results: list, r: redis.Redis = None) -> str:
+    """
+    Add one task's results to the stream. Returns the entry id. Pass a
+    pipeline as r to add them as part of its transaction.
+    """
+    if r is None:
+        r = redis_client(0)
+
+    return r.xadd(RESULT_STREAM, {'results': ujson.dumps(results)})
+
+
+def ensure_group(r: redis.Redis) -> None:
+    """
+    Create the stream and the reapers' consumer group if they don't exist yet.
+    """
+    try:
+        r.xgroup_create(RESULT_STREAM, RESULT_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def _decode_entries(entries: list) -> tuple:
+    """
+    Split entries into [(entry_id, results), ...] and the ids of entries that
+    were deleted while pending, which come back without fields.
+    """
+    decoded = []
+    deleted_ids = []
+
+    for entry_id, fields in entries:
+        if fields:
+            decoded.append((entry_id, ujson.loads(fields['results'])))
+        else:
+            deleted_ids.append(entry_id)
+
+    return decoded, deleted_ids
+
+
+def claim_abandoned(r: redis.Redis, consumer: str, count: int) -> tuple:
+    """
+    Take over up to count entries another reaper read but never acknowledged.
+    Returns ([(entry_id, results), ...], deleted_ids), the deleted ones are
+    still pending and need acknowledging. Call once per run, before read_new.
+    """
+    return _decode_entries(r.xautoclaim(RESULT_STREAM, RESULT_GROUP, consumer, RESULT_CLAIM_IDLE_MS, count=count)[1])
+
+
+def read_new(r: redis.Redis, consumer: str, count: int) -> list:
+    """
+    Read up to count entries no reaper has seen yet, as [(entry_id, results), ...].
+    Doesn't block, an empty list means the stream is drained.
+    """
+    messages = r.xreadgroup(RESULT_GROUP, consumer, {RESULT_STREAM: '>'}, count=count)
+
+    #Only new entries are delivered here, none of them can be deleted yet.
+    return _decode_entries(messages[0][1] if messages else [])[0]
+
+
+def acknowledge(r: redis.Redis, entry_ids: list) -> None:
+    """
+    Acknowledge committed entries and delete them, so the stream only holds
+    results that still need to be reaped.
+    """
+    if entry_ids:
+        with r.pipeline(transaction=False) as pipe:
+            pipe.xack(RESULT_STREAM, RESULT_GROUP, *entry_ids)
+            pipe.xdel(RESULT_STREAM, *entry_ids)
+            pipe.execute()
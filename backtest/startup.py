@@ -6,46 +6,206 @@ Functionality to start the backtesting system.
 """
 
 import logging
+from typing import Iterable, Iterator
 from os import environ
 import redis
-from frange import frange
-from backtest.task_helper import send_task
+from backtest.task_helper import enqueue_tasks
+from backtest.parameter_space import ParameterSpace, chunked
+from backtest.engine import backtest_key, get_available_dates
+from backtest.chunk_sizing import adaptive_batch_size
+from backtest.market_cache import get_dataset_version
+from backtest.reaper import completed_backtest_ids, sql_credentials, sql_connection
 
 _LOGGER = logging.getLogger()
 _LOGGER.setLevel(logging.INFO)
 
 
-def seed_backtest_requests():
-    task_args = []
+def default_parameter_grid() -> dict:
+    """
+    The parameter grid swept by default, as lists of values. Expands with the
+    limit outermost and the stop distance innermost.
+    """
+    parameter_space = default_parameter_space()
 
-    for limit in frange(1, 20):
-        for stopiteration in frange(1, 4):
-            for cooloff in frange(30, 300, 30):
-                for stop_distance in frange(0.1, 2, 0.1):
-                    task_args.append([limit, stopiteration, cooloff, stop_distance])
+    return dict(zip(parameter_space.names, parameter_space.values))
 
-    print('Sending {0} backtest tasks to be processed.'.format(len(task_args)))
 
-    count = 0
+def default_parameter_space() -> ParameterSpace:
+    """
+    The default grid as a lazily expanded ParameterSpace.
+    """
+    return ParameterSpace({
+        'limit_distance': {'start': 1, 'stop': 20},
+        'stop_count_limit': {'start': 1, 'stop': 4},
+        'stop_cooloff_period': {'start': 30, 'stop': 300, 'step': 30},
+        'stop_distance': {'start': 0.1, 'stop': 2, 'step': 0.1},
+    })
+
+
+def skip_completed_parameter_sets(
+    parameter_sets: Iterable[dict],
+    ticker: str,
+    dataset_version: str,
+    r: redis.Redis,
+    cnx = None,
+    sql_tablename: str = None,
+    skipped_count: list = None,
+    check_size: int = 1000,
+    result_format: str = 'full'
+) -> Iterator[dict]:
+    """
+    Yield the parameter sets whose backtests aren't completed yet, looking up
+    their backtest_key ids check_size at a time.
+    """
+    for parameter_sets_chunk in chunked(parameter_sets, check_size):
+        backtest_ids = [
+            backtest_key(parameter_set, dataset_version, ticker, result_format=result_format)
+            for parameter_set in parameter_sets_chunk
+        ]
+        completed = completed_backtest_ids(r, backtest_ids, cnx, sql_tablename)
+
+        if skipped_count is not None:
+            skipped_count[0] += len(completed)
+
+        for parameter_set, backtest_id in zip(parameter_sets_chunk, backtest_ids):
+            if backtest_id not in completed:
+                yield parameter_set
+
+
+def seed_backtest_requests(
+    batch_size: int = 0,
+    engine_mode: str = 'reference',
+    result_format: str = 'full',
+    tickers: list = None,
+    result_channel: str = 'backend',
+    parameter_space: Iterable[dict] = None,
+    skip_completed: bool = True,
+    target_task_seconds = None
+) -> dict:
+    """
+    Enqueue the parameter sweep. Returns enqueue_tasks' throughput stats.
+
+    parameter_space is what gets swept, a ParameterSpace, a sample of one, or
+    any re-iterable of parameter set dicts, defaulting to
+    default_parameter_space(). Parameter sets are generated and chunked as the
+    tasks are sent, so sending starts right away and memory stays flat however
+    big the space is.
+
+    With the default batch_size of 0, every parameter set is sent as its own
+    backtest_redux task. Otherwise parameter sets are grouped into backtest_batch
+    tasks of up to batch_size each, so the staged data is loaded once per batch.
+
+    result_format is passed to every task, 'compact' or 'summary' shrink what
+    the sweep leaves in Redis and MySQL, see backtest.result_codec.
+
+    tickers enqueues the sweep for every ticker staged with namespaced keys
+    (StageRedis(ticker, namespaced=True)). Each ticker's tasks are queued
+    together, so workers keep one ticker's data cached at a time while the
+    fleet works through the universe. Without tickers, the un-namespaced data
+    is backtested.
+
+    result_channel 'stream' has the tasks publish their results to the Redis
+    result stream for lifecycle_stream_results to reap, and sends them with
+    ignore_result so celery stores no task meta.
+
+    skip_completed leaves out parameter sets already backtested against the
+    currently staged dataset, whether their results are still in Redis or
+    already in MySQL, so an interrupted or extended sweep only sends what is
+    missing. MySQL is checked when DB_ENDPOINT is set. Needs the dataset
+    version from the manifest, without one everything is sent. Backtests only
+    count as completed in the same result_format.
+
+    target_task_seconds sizes each ticker's backtest_batch tasks to take about
+    that long, from the per parameter set and date cost workers measured on
+    the staged dataset (see backtest.chunk_sizing). 'auto' targets a quarter of
+    the task time limit. batch_size, or 100, is used until there are
+    measurements, so a first run with a small batch_size calibrates the next.
+    """
+    if parameter_space is None:
+        parameter_space = default_parameter_space()
+
+    common_kwargs = {
+        'engine_mode': engine_mode,
+        'result_format': result_format
+    }
+    if result_channel != 'backend':
+        common_kwargs['result_channel'] = result_channel
+
+    task_name = 'backtest.engine.backtest_batch' if batch_size or target_task_seconds else 'backtest.engine.backtest_redux'
+    batch_sizes = {}
+    backtest_count = [0]
+    skipped_count = [0]
+
     r = redis.Redis(host=environ['REDIS_ENDPOINT'], port=6379, db=0, decode_responses=True)
 
-    #https://redis-py.readthedocs.io/en/stable/advanced_features.html#default-pipelines
-    with r.pipeline() as pipe:
-        for item in task_args:
-            count += 1
-            message_to_send = send_task(
-                queue = 'worker_main',
-                task_name = 'backtest.engine.backtest_redux',
-                task_kwargs = {
-                    'stop_distance': item[3],
-                    'stop_count_limit': item[1],
-                    'stop_cooloff_period': item[2],
-                    'limit_distance': item[0],
-                }
-            )
-            pipe.lpush('worker_main', message_to_send)
-
-            #Limit pipeline batches to 1000 to reduce risk of deadlock.
-            if count % 1000 == 0:
-                print('sent {0} tasks to redis'.format(count))
-                pipe.execute()
\ No newline at end of file
+    cnx = None
+    sql_tablename = None
+    if skip_completed and environ.get('DB_ENDPOINT'):
+        sql_user, sql_pw, sql_endpoint, sql_dbname, sql_tablename = sql_credentials()
+        cnx = sql_connection(sql_user, sql_pw, sql_endpoint, sql_dbname)
+
+    def ticker_batch_size(ticker: str, dataset_version: str) -> int:
+        if not target_task_seconds:
+            return batch_size
+
+        return adaptive_batch_size(
+            ticker,
+            engine_mode,
+            dataset_version,
+            len(get_available_dates(ticker)),
+            target_seconds = None if target_task_seconds == 'auto' else target_task_seconds,
+            default_batch_size = batch_size or 100
+        )
+
+    def pending_parameter_sets(ticker: str, dataset_version: str) -> Iterable[dict]:
+        if not skip_completed or not dataset_version:
+            if skip_completed:
+                _LOGGER.warning('No dataset version staged for {0}, sending every parameter set.'.format(ticker))
+            return parameter_space
+
+        return skip_completed_parameter_sets(
+            parameter_space,
+            ticker,
+            dataset_version,
+            r,
+            cnx,
+            sql_tablename,
+            skipped_count,
+            result_format = result_format
+        )
+
+    def task_kwargs_stream() -> Iterator[dict]:
+        for ticker in tickers or [None]:
+            ticker_kwargs = dict(common_kwargs, ticker=ticker) if ticker else common_kwargs
+            dataset_version = get_dataset_version(ticker) if skip_completed or target_task_seconds else None
+            ticker_parameter_sets = pending_parameter_sets(ticker, dataset_version)
+
+            if task_name == 'backtest.engine.backtest_batch':
+                batch_sizes[ticker] = ticker_batch_size(ticker, dataset_version)
+                for parameter_sets in chunked(ticker_parameter_sets, batch_sizes[ticker]):
+                    backtest_count[0] += len(parameter_sets)
+                    yield dict(ticker_kwargs, parameter_sets=parameter_sets)
+            else:
+                for parameter_set in ticker_parameter_sets:
+                    backtest_count[0] += 1
+                    yield dict(parameter_set, **ticker_kwargs)
+
+    stats = enqueue_tasks(
+        r,
+        'worker_main',
+        task_name,
+        task_kwargs_stream(),
+        ignore_result = result_channel == 'stream'
+    )
+    stats['backtests'] = backtest_count[0]
+    stats['skipped'] = skipped_count[0]
+    if target_task_seconds:
+        stats['batch_sizes'] = batch_sizes
+
+    print('Sent {0} backtests in {1} tasks to be processed, skipped {2} already completed.'.format(
+        stats['backtests'],
+        stats['tasks'],
+        stats['skipped']
+    ))
+
+    return stats
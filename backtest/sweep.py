@@ -0,0 +1,203 @@
+__author__ = "Nathan Ward"
+
+"""
+Shared-prefix parameter sweep engine.
+
+Parameter sets only diverge at specific events. The trade path of a day
+depends on stop_distance and limit_distance from the first tick. But
+stop_count_limit and stop_cooloff_period only matter once a stop fires:
+stop_count_limit decides whether trading ends, and stop_cooloff_period
+decides where the next entry search starts. So for each day and each
+(stop_distance, limit_distance) pair, every (stop_count_limit,
+stop_cooloff_period) combination is simulated as one tree. A trade is
+simulated once per branch and only splits at a stop, and only into as many
+branches as there are distinct re-entry points. Branches whose cooloff lands
+on the same tick are merged. Results are identical to running each parameter
+set on its own.
+"""
+
+import logging
+from collections import defaultdict
+from backtest.event_index import DayIndex
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+
+class _DayState(object):
+    """
+    Per-day query memo shared by every branch of every parameter set.
+    """
+    def __init__(self, day_index: DayIndex, range_high: float, range_low: float):
+        self.day_index = day_index
+        self.range_high = range_high
+        self.range_low = range_low
+        self.entries = {}
+
+    def entry_at(self, position: int) -> tuple:
+        """
+        First breakout at or after position as (index, is_long), or (-1, False).
+        Breakouts don't depend on any parameter, so they are only searched once.
+        """
+        if position not in self.entries:
+            long_entry = self.day_index.first_at_or_above(position, self.range_high, strict=True)
+            short_entry = self.day_index.first_at_or_below(position, self.range_low, strict=True)
+
+            if long_entry == -1 and short_entry == -1:
+                self.entries[position] = (-1, False)
+            elif short_entry == -1 or (long_entry != -1 and long_entry <= short_entry):
+                self.entries[position] = (long_entry, True)
+            else:
+                self.entries[position] = (short_entry, False)
+
+        return self.entries[position]
+
+
+def _trade_stats(trades: tuple) -> dict:
+    """
+    Build a branch's own trade_stats from the shared trade prefix.
+    """
+    return {count + 1: dict(trade) for count, trade in enumerate(trades)}
+
+
+def sweep_day(
+    day_state: _DayState,
+    stop_distance: float,
+    limit_distance: float,
+    branch_parameters: list
+) -> dict:
+    """
+    Simulate every (stop_count_limit, stop_cooloff_period) pair for one day and
+    one (stop_distance, limit_distance) pair. Returns a dict mapping each pair to
+    (trade_stats, stop_triggered_count, trade_initiated_count).
+    """
+    day_index = day_state.day_index
+    timestamps = day_index.timestamps
+    prices = day_index.prices
+    last_index = day_index.count - 1
+
+    results = {}
+
+    #Each branch is (position, stop count, trades so far, parameter pairs following it).
+    branches = [(0, 0, (), list(branch_parameters))]
+
+    while branches:
+        position, stop_triggered_count, trades, parameters = branches.pop()
+
+        #Stop count limit reached, these parameter sets stop trading for the day.
+        active = []
+        for stop_count_limit, stop_cooloff_period in parameters:
+            if stop_triggered_count == stop_count_limit:
+                results[(stop_count_limit, stop_cooloff_period)] = (_trade_stats(trades), stop_triggered_count, len(trades))
+            else:
+                active.append((stop_count_limit, stop_cooloff_period))
+
+        if not active:
+            continue
+
+        entry, is_long = day_state.entry_at(position) if position <= last_index else (-1, False)
+
+        if entry == -1:
+            for parameter in active:
+                results[parameter] = (_trade_stats(trades), stop_triggered_count, len(trades))
+            continue
+
+        entry_price = prices[entry].item()
+        entry_timestamp = int(timestamps[entry])
+        trade = {
+            'top': entry_price,
+            'to': entry_timestamp,
+            'd': 'long' if is_long else 'short'
+        }
+
+        #Opened on the last tick, nothing left to close it with.
+        if entry == last_index:
+            for parameter in active:
+                results[parameter] = (_trade_stats(trades + (trade,)), stop_triggered_count, len(trades) + 1)
+            continue
+
+        if is_long:
+            limit_hit = day_index.first_at_or_above(entry + 1, entry_price + limit_distance)
+            stop_hit = day_index.first_at_or_below(entry + 1, entry_price - stop_distance)
+        else:
+            limit_hit = day_index.first_at_or_below(entry + 1, entry_price - limit_distance)
+            stop_hit = day_index.first_at_or_above(entry + 1, entry_price + stop_distance)
+
+        limit_index = limit_hit if limit_hit != -1 else last_index
+        stop_index = stop_hit if stop_hit != -1 else last_index + 1
+        exit_index = stop_index if stop_index < limit_index else limit_index
+
+        exit_price = prices[exit_index].item()
+        exit_timestamp = int(timestamps[exit_index])
+
+        if exit_index == limit_index or is_long:
+            profit = exit_price - entry_price
+        else:
+            profit = entry_price - exit_price
+
+        trade.update({
+            'tcp': exit_price,
+            'p': profit,
+            'hp': exit_timestamp - entry_timestamp,
+            'tc': exit_timestamp
+        })
+        trades = trades + (trade,)
+
+        #Limit or end of day, trading is over for every parameter set on this branch.
+        if exit_index == limit_index:
+            for parameter in active:
+                results[parameter] = (_trade_stats(trades), stop_triggered_count, len(trades))
+            continue
+
+        #Stopped out. Only the cooloff decides where each parameter set resumes,
+        #so branch once per distinct re-entry position.
+        resume_positions = defaultdict(list)
+        for stop_count_limit, stop_cooloff_period in active:
+            resume = max(exit_index + 1, day_index.first_at_or_after_timestamp(exit_timestamp + stop_cooloff_period))
+            resume_positions[resume].append((stop_count_limit, stop_cooloff_period))
+
+        for resume, resume_parameters in resume_positions.items():
+            branches.append((resume, stop_triggered_count + 1, trades, resume_parameters))
+
+    return results
+
+
+def sweep(date_list: list, opening_range_info: dict, day_indexes: dict, parameter_sets: list) -> list:
+    """
+    Simulate many parameter sets over every date as shared-prefix trees.
+
+    Returns a list in the same order as parameter_sets, each entry a dict mapping
+    date to (trade_stats, stop_triggered_count, trade_initiated_count) just like
+    the per-day engines return.
+    """
+    #Group parameter sets by the parameters that shape a trade from its first tick.
+    groups = defaultdict(list)
+    for parameter_set in parameter_sets:
+        groups[(parameter_set['stop_distance'], parameter_set['limit_distance'])].append(
+            (parameter_set['stop_count_limit'], parameter_set['stop_cooloff_period'])
+        )
+
+    day_results = [{} for parameter_set in parameter_sets]
+
+    for date in date_list:
+        day_state = _DayState(
+            day_indexes[date],
+            opening_range_info[date]['high'],
+            opening_range_info[date]['low']
+        )
+
+        group_results = {}
+        for (stop_distance, limit_distance), branch_parameters in groups.items():
+            group_results[(stop_distance, limit_distance)] = sweep_day(
+                day_state,
+                stop_distance,
+                limit_distance,
+                list(dict.fromkeys(branch_parameters))
+            )
+
+        for count, parameter_set in enumerate(parameter_sets):
+            day_results[count][date] = group_results[(parameter_set['stop_distance'], parameter_set['limit_distance'])][
+                (parameter_set['stop_count_limit'], parameter_set['stop_cooloff_period'])
+            ]
+
+    return day_results
@@ -7,22 +7,37 @@ Helpers to access low level implimentation of celery send task.
 
 import os
 import socket
+from itertools import count
+from operator import itemgetter
+from time import perf_counter
 from uuid import uuid4
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional
+import redis
 import ujson
 from pybase64 import b64encode
 
+#enqueue_tasks sends a pipeline once about this many bytes of messages are queued up.
+ENQUEUE_BATCH_BYTES = 8 * 1024 * 1024
+
+#Messages per LPUSH within a pipeline.
+ENQUEUE_LPUSH_SIZE = 1000
+
 
 def send_task(
     queue: str,
     task_name: str,
     task_args: Optional[List] = None,
     task_kwargs: Optional[Dict] = None,
-) -> None:
+    task_id: Optional[str] = None,
+    ignore_result: bool = False,
+) -> str:
     """
     Low level helper to inject new tasks into celery by directly talking to Redis.
     This allows increased task injection performance by mimicking the message
     format.
+
+    Pass task_id to pick the id up front, e.g. to read the result back later.
+    ignore_result tells the worker not to store the result in the backend.
     """
     if not task_args:
         task_args = []
@@ -30,7 +45,9 @@ def send_task(
     if not task_kwargs:
         task_kwargs = {}
     
-    task_id = str(uuid4())
+    if not task_id:
+        task_id = str(uuid4())
+
     delivery_tag = str(uuid4())
     reply_to_id = str(uuid4())
     body = b64encode(ujson.dumps((task_args, task_kwargs, {})).encode("utf-8")).decode("utf-8")
@@ -56,7 +73,7 @@ def send_task(
             "argsrepr": repr(task_args),
             "kwargsrepr": repr(task_kwargs),
             "origin": f"{os.getpid()}@{socket.gethostname()}",
-            "ignore_result": False,
+            "ignore_result": ignore_result,
             "replaced_task_nesting": 0,
             "stamped_headers": None,
             "stamps": {}
@@ -72,4 +89,133 @@ def send_task(
         },
     }
 
-    return ujson.dumps(message)
\ No newline at end of file
+    return ujson.dumps(message)
+
+
+class TaskTemplate(object):
+    """
+    The send_task message for one queue and task, precomputed for sending many
+    tasks. Only the body, ids and argument reprs change between messages, so a
+    message costs one ujson dump, a base64 and a string format.
+
+    Ids are a random uuid4 prefix per template plus a counter, unique without a
+    uuid4 call per message. reply_to is shared by every message, like it is for
+    messages from one celery producer. argsrepr/kwargsrepr are the JSON of the
+    arguments rather than their repr, they are only used for display.
+    """
+    def __init__(self, queue: str, task_name: str, ignore_result: bool = False):
+        self.id_prefix = str(uuid4())[:24]
+        self.delivery_tag_prefix = str(uuid4())[:24]
+        self.counter = count()
+
+        message = ujson.loads(send_task(queue, task_name, task_id='@@TASK_ID@@', ignore_result=ignore_result))
+        message['body'] = '@@BODY@@'
+        message['headers']['argsrepr'] = '@@ARGSREPR@@'
+        message['headers']['kwargsrepr'] = '@@KWARGSREPR@@'
+        message['properties']['delivery_tag'] = '@@DELIVERY_TAG@@'
+
+        #Split the message around the placeholders, per message the values are
+        #slotted in between the fixed segments and joined.
+        placeholders = ('"@@TASK_ID@@"', '"@@BODY@@"', '"@@ARGSREPR@@"', '"@@KWARGSREPR@@"', '"@@DELIVERY_TAG@@"')
+        template = ujson.dumps(message)
+        self.parts = []
+        slots = []
+        while True:
+            found = [(template.find(placeholder), index) for index, placeholder in enumerate(placeholders)]
+            found = [(position, index) for position, index in found if position != -1]
+            if not found:
+                break
+            position, index = min(found)
+            self.parts.extend([template[:position], None])
+            slots.append(index)
+            template = template[position + len(placeholders[index]):]
+        self.parts.append(template)
+        self.pick_slots = itemgetter(*slots)
+
+    def message(
+        self,
+        task_kwargs: Optional[Dict] = None,
+        task_args: Optional[List] = None,
+        task_id: Optional[str] = None
+    ) -> str:
+        """
+        Same message send_task builds, ready to LPUSH onto the queue.
+        """
+        sequence = '%012x' % next(self.counter)
+        args_json = ujson.dumps(task_args) if task_args else '[]'
+        kwargs_json = ujson.dumps(task_kwargs) if task_kwargs else '{}'
+
+        parts = self.parts.copy()
+        parts[1::2] = self.pick_slots((
+            '"' + (task_id or self.id_prefix + sequence) + '"',
+            '"' + b64encode(('[' + args_json + ',' + kwargs_json + ',{}]').encode('utf-8')).decode('utf-8') + '"',
+            ujson.dumps(args_json),
+            ujson.dumps(kwargs_json),
+            '"' + self.delivery_tag_prefix + sequence + '"'
+        ))
+
+        return ''.join(parts)
+
+
+def enqueue_tasks(
+    r: redis.Redis,
+    queue: str,
+    task_name: str,
+    task_kwargs_list: Iterable[Dict],
+    ignore_result: bool = False,
+    batch_bytes: int = ENQUEUE_BATCH_BYTES
+) -> dict:
+    """
+    Bulk enqueue one task per kwargs dict, in order. Messages come from a
+    TaskTemplate and are sent with multi-value LPUSHes in pipelines of about
+    batch_bytes, and whatever is left at the end is always sent. Takes any
+    iterable, so tasks can be generated lazily. Returns throughput stats.
+    """
+    template = TaskTemplate(queue, task_name, ignore_result=ignore_result)
+    start_time = perf_counter()
+    stats = {'tasks': 0, 'bytes': 0, 'pipelines': 0}
+
+    with r.pipeline(transaction=False) as pipe:
+        messages = []
+        pending_bytes = 0
+
+        for task_kwargs in task_kwargs_list:
+            message = template.message(task_kwargs)
+            messages.append(message)
+            pending_bytes += len(message)
+
+            if len(messages) == ENQUEUE_LPUSH_SIZE:
+                pipe.lpush(queue, *messages)
+                stats['tasks'] += len(messages)
+                messages = []
+
+            if pending_bytes >= batch_bytes:
+                if messages:
+                    pipe.lpush(queue, *messages)
+                    stats['tasks'] += len(messages)
+                    messages = []
+                pipe.execute()
+                stats['bytes'] += pending_bytes
+                stats['pipelines'] += 1
+                pending_bytes = 0
+
+        #The final partial pipeline.
+        if messages:
+            pipe.lpush(queue, *messages)
+            stats['tasks'] += len(messages)
+        if len(pipe):
+            pipe.execute()
+            stats['bytes'] += pending_bytes
+            stats['pipelines'] += 1
+
+    stats['duration'] = round(perf_counter() - start_time, 3)
+    stats['tasks_per_second'] = round(stats['tasks'] / stats['duration']) if stats['duration'] else 0
+
+    print('Enqueued {0} tasks in {1} pipelines in {2} seconds, {3} tasks/s.'.format(
+        stats['tasks'],
+        stats['pipelines'],
+        stats['duration'],
+        stats['tasks_per_second']
+    ))
+
+    return stats
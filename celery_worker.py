@@ -8,12 +8,16 @@ Celery application.
 from os import environ
 from celery import Celery
 
+#Creating the app doesn't connect, so default the endpoint to let code that
+#only needs the engine, like the local runner, import it without Redis.
+REDIS_ENDPOINT = environ.get('REDIS_ENDPOINT', 'localhost')
+
 app = Celery(
     'celery_worker',
     #Redis broker/queue.
-    broker='redis://{0}:6379/0'.format(environ['REDIS_ENDPOINT']),
+    broker='redis://{0}:6379/0'.format(REDIS_ENDPOINT),
     #Redis backend for task result info.
-    backend='redis://{0}:6379/0'.format(environ['REDIS_ENDPOINT']),
+    backend='redis://{0}:6379/0'.format(REDIS_ENDPOINT),
     #Modules to pre-import so the worker can be ready.
     include=[
         'backtest.engine',
@@ -21,5 +25,16 @@ app = Celery(
     ]
 )
 
+app.conf.update(
+    #Keep in step with --time-limit in backtest.Dockerfile, batch sizing targets a fraction of it.
+    task_time_limit = 60,
+    #Each worker process reserves only the task it is running, so a fast worker
+    #isn't left idle while tasks sit prefetched behind a slow one.
+    worker_prefetch_multiplier = 1,
+    #Ack once done, so a task on a worker that dies is redelivered. Results are
+    #content addressed, a rerun writes the same rows.
+    task_acks_late = True
+)
+
 if __name__ == '__main__':
     app.start()
\ No newline at end of file
@@ -1,5 +1,6 @@
 CREATE TABLE `results` (
-    `backtest_id` VARCHAR(5) NOT NULL DEFAULT '0' COLLATE 'utf8mb4_general_ci',
+    `backtest_id` VARCHAR(32) NOT NULL DEFAULT '0' COLLATE 'utf8mb4_general_ci',
+    `ticker` VARCHAR(10) NOT NULL DEFAULT '' COLLATE 'utf8mb4_general_ci',
     `backtest_profit` FLOAT NOT NULL DEFAULT '0',
     `average_holding_period` FLOAT NOT NULL DEFAULT '0',
     `win_rate_percent` INT(3) NOT NULL DEFAULT '0',
@@ -9,7 +10,8 @@ CREATE TABLE `results` (
     `limit_distance` FLOAT NOT NULL DEFAULT '0',
     `trade_stats` JSON,
     PRIMARY KEY (backtest_id),
-    INDEX `ProfitIndex` (`backtest_profit`) USING BTREE
+    INDEX `ProfitIndex` (`backtest_profit`) USING BTREE,
+    INDEX `TickerIndex` (`ticker`) USING BTREE
 )
 COMMENT='Stores backtest results for trades.'
 COLLATE='utf8mb4_general_ci'
@@ -11,6 +11,7 @@ from mysql.connector import Error
 import ujson
 import plotly.express as px
 import pandas as pd
+from backtest.result_codec import decode_trade_stats, result_format_of
 
 
 class SQLError(Exception):
@@ -62,7 +63,11 @@ def pull_data(backtest_id: str, table_name: str) -> dict:
 def display(backtest_id: str, table_name: str):
     result = pull_data(backtest_id=backtest_id, table_name=table_name)
     if result:
-        columns = ['date', 'stock_price_change', 'cumulative_profit']
+        #Summary results only have the net profit per day, there are no trades to chart the stock price with.
+        has_trades = result_format_of(result) != 'summary'
+        result = decode_trade_stats(result)
+
+        columns = ['date', 'stock_price_change', 'cumulative_profit'] if has_trades else ['date', 'cumulative_profit']
         data = []
         cumulative_profit = []
         cumlative_stock_price_change = []
@@ -71,7 +76,9 @@ def display(backtest_id: str, table_name: str):
         for k, v in result.items():
             cumulative_profit.append(v['snp'])
 
-            if not last_price:
+            if not has_trades:
+                data.append((k, sum(cumulative_profit)))
+            elif not last_price:
                 last_price = v['1']['top']
                 cumlative_stock_price_change.append(v['1']['top'] - last_price)
                 data.append((k, sum(cumlative_stock_price_change), sum(cumulative_profit)))
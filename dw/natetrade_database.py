@@ -5,8 +5,10 @@ import logging
 from sys import stdout
 from os import environ
 from time import time
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, pooling
 
 _LOGGER = logging.getLogger()
 _LOGGER.setLevel(logging.INFO)
@@ -47,6 +49,12 @@ class DatabaseHelper(object):
         self.sql_user = environ['SQL_USERNAME']
         self.sql_pw = environ['SQL_PASSWORD']
         self.sql_endpoint = environ['SQL_HOSTNAME']
+
+        #Optional, e.g. to point at a local MySQL stand-in on another port.
+        self.sql_port = int(environ.get('SQL_PORT', 3306))
+
+        #Connection pools for parallel queries, one per database.
+        self.pools = {}
     
     def generic_select_query(self, db: str, query_string: str) -> list:
         """
@@ -57,6 +65,7 @@ class DatabaseHelper(object):
                 user = self.sql_user,
                 password = self.sql_pw,
                 host = self.sql_endpoint,
+                port = self.sql_port,
                 database = db
             )
         except Error as e:
@@ -85,4 +94,140 @@ class DatabaseHelper(object):
             if cnx.is_connected():
                 cursor.close()
                 cnx.close()
+    
+    def stream_select_query(
+        self,
+        db: str,
+        query_string: str,
+        batch_size: int = 10000,
+        as_numpy: bool = False,
+        dtype: list = None
+    ) -> Iterator:
+        """
+        Generator version of generic_select_query for large results. Uses an
+        unbuffered cursor, so rows are pulled from the server batch_size at a
+        time with fetchmany instead of all at once.
+
+        Yields each row as a tuple in the select's column order. With as_numpy,
+        yields one NumPy record array per batch instead, with fields named after
+        the columns. dtype overrides the record dtype, e.g. [('ticker', 'U10')].
+        """
+        if as_numpy:
+            #Only needed for record chunks.
+            import numpy as np
+
+        try:
+            cnx = mysql.connector.connect(
+                user = self.sql_user,
+                password = self.sql_pw,
+                host = self.sql_endpoint,
+                port = self.sql_port,
+                database = db
+            )
+        except Error as e:
+            _LOGGER.exception('Problem accessing natetrade SQL database. {0}'.format(e))
+            raise SQLError('Problem accessing natetrade SQL database. {0}'.format(e))
+        
+        row_count = 0
+        start_time = time()
+
+        try:
+            cursor = cnx.cursor(buffered=False)
+            cursor.execute(query_string)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                row_count += len(rows)
+
+                if as_numpy:
+                    if dtype:
+                        yield np.array(rows, dtype=dtype)
+                    else:
+                        yield np.rec.fromrecords(rows, names=cursor.column_names)
+                else:
+                    yield from rows
+            
+            end_time = time()
+            execution_time = round((end_time - start_time), 3)
+
+            _LOGGER.info('Streamed {0} rows of data in {1} seconds.'.format(row_count, execution_time))
+        except Error as e:
+            _LOGGER.exception('Problem streaming query results. {0}'.format(e))
+            raise SQLError('Problem streaming query results. {0}'.format(e))
+        finally:
+            #Stopping early leaves rows on the wire, drop the connection instead of reading them.
+            if cnx.unread_result:
+                cnx.shutdown()
+            elif cnx.is_connected():
+                cursor.close()
+                cnx.close()
+    
+    def connection_pool(self, db: str, pool_size: int = 4) -> pooling.MySQLConnectionPool:
+        """
+        Get the connection pool for a database, creating it on first use.
+        """
+        if db not in self.pools:
+            try:
+                self.pools[db] = pooling.MySQLConnectionPool(
+                    pool_name = 'natetrade_{0}'.format(db),
+                    pool_size = pool_size,
+                    user = self.sql_user,
+                    password = self.sql_pw,
+                    host = self.sql_endpoint,
+                    port = self.sql_port,
+                    database = db
+                )
+            except Error as e:
+                _LOGGER.exception('Problem creating natetrade SQL connection pool. {0}'.format(e))
+                raise SQLError('Problem creating natetrade SQL connection pool. {0}'.format(e))
+        
+        return self.pools[db]
+    
+    def pooled_select_query(self, db: str, query_string: str) -> list:
+        """
+        generic_select_query on a connection borrowed from the database's pool.
+        """
+        try:
+            cnx = self.connection_pool(db).get_connection()
+        except Error as e:
+            _LOGGER.exception('Problem accessing natetrade SQL database. {0}'.format(e))
+            raise SQLError('Problem accessing natetrade SQL database. {0}'.format(e))
+        
+        try:
+            cursor = cnx.cursor(dictionary=True)
+            cursor.execute(query_string)
+            return cursor.fetchall()
+        except Error as e:
+            _LOGGER.exception('Problem getting greek data. {0}'.format(e))
+            raise SQLError('Problem getting greek data. {0}'.format(e))
+        finally:
+            #Hands the connection back to the pool.
+            cnx.close()
+    
+    def parallel_select_queries(self, db: str, query_strings: list, max_workers: int = 4) -> list:
+        """
+        Run select queries concurrently, at most max_workers at a time, each on
+        its own pooled connection. Returns a list of dicts per query, in the same
+        order as query_strings.
+        """
+        #Never run more queries at once than the pool has connections.
+        max_workers = min(max_workers, self.connection_pool(db, max_workers).pool_size)
+
+        start_time = time()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda query_string: self.pooled_select_query(db, query_string), query_strings))
+        
+        end_time = time()
+        execution_time = round((end_time - start_time), 3)
+
+        _LOGGER.info('Returned {0} rows of data from {1} queries in {2} seconds.'.format(
+            sum(len(result) for result in results),
+            len(query_strings),
+            execution_time
+        ))
 
+        return results
@@ -0,0 +1,69 @@
+__author__ = "Nathan Ward"
+
+"""
+Memory cap of the worker market data cache, on synthetic datasets.
+
+    python -m unittest discover tests
+"""
+
+import unittest
+import numpy as np
+from backtest.market_cache import MarketDataCache, StagedDataset
+
+
+def synthetic_dataset(ticker: str, days: int = 3, ticks: int = 20000) -> StagedDataset:
+    rng = np.random.default_rng(0)
+    date_list = ['2023-04-{0:02d}'.format(24 + day) for day in range(days)]
+    price_arrays = {
+        date: (
+            1682343000 + 86400 * day + np.arange(ticks, dtype=np.int64),
+            np.round(410 + np.cumsum(rng.normal(0, 0.02, ticks)), 2)
+        ) for day, date in enumerate(date_list)
+    }
+    opening_range_info = {date: {'high': 411.0, 'low': 409.0} for date in date_list}
+
+    return StagedDataset(ticker, 'v1', date_list, opening_range_info, price_arrays)
+
+
+class MarketDataCacheTest(unittest.TestCase):
+    def test_reference_dicts_stay_within_the_cap(self):
+        probe = synthetic_dataset('SPY')
+        probe.price_dicts()
+
+        #Room for both datasets' arrays, or one dataset with its dicts, but not all of it.
+        first = synthetic_dataset('SPY')
+        cache = MarketDataCache(first.nbytes * 3 // 2 + probe.day_dicts_bytes)
+        self.assertTrue(cache.admit(first))
+        self.assertTrue(cache.admit(synthetic_dataset('QQQ')))
+
+        #The dicts are several times the arrays, the other dataset makes way for them.
+        price_dicts = first.engine_price_data('reference')
+        self.assertEqual(len(price_dicts), len(first.date_list))
+        self.assertLessEqual(cache.cached_bytes(), cache.max_bytes)
+        self.assertTrue(first.day_dicts is price_dicts)
+        self.assertEqual(list(cache.datasets), [('SPY', 'v1')])
+
+    def test_derived_data_larger_than_the_cap_is_not_kept(self):
+        dataset = synthetic_dataset('SPY')
+        cache = MarketDataCache(dataset.nbytes * 2)
+        self.assertTrue(cache.admit(dataset))
+
+        price_dicts = dataset.engine_price_data('reference')
+        self.assertEqual(len(price_dicts), len(dataset.date_list))
+        self.assertIsNone(dataset.day_dicts)
+        self.assertLessEqual(cache.cached_bytes(), cache.max_bytes)
+
+    def test_event_indexes_evict_least_recently_used(self):
+        datasets = [synthetic_dataset(ticker) for ticker in ('SPY', 'QQQ', 'IWM')]
+        cache = MarketDataCache(sum(dataset.nbytes for dataset in datasets))
+        for dataset in datasets:
+            self.assertTrue(cache.admit(dataset))
+
+        datasets[-1].engine_price_data('indexed')
+        self.assertIsNotNone(datasets[-1].day_indexes)
+        self.assertLessEqual(cache.cached_bytes(), cache.max_bytes)
+        self.assertNotIn(('SPY', 'v1'), cache.datasets)
+
+
+if __name__ == '__main__':
+    unittest.main()